@@ -0,0 +1,99 @@
+"""
+Benchmark the import and startup time of the mapshader entry points.
+
+Every measurement runs in a fresh interpreter, so nothing is cached in
+``sys.modules``, and the median of the runs is reported along with the
+time of an interpreter doing nothing, for reference::
+
+    python benchmarks/startup.py --repeat 5 --json startup.json
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+
+# entry point name -> (statement importing it, expression of its click command)
+ENTRY_POINTS = {
+    'mapshader': ('from mapshader.commands import main', 'main'),
+    'build_raster_overviews': (
+        'from mapshader.commands.build_raster_overviews import build_raster_overviews',
+        'build_raster_overviews',
+    ),
+    'examples': ('from mapshader.commands.examples import examples', 'examples'),
+    'serve': ('from mapshader.commands.serve import serve', 'serve'),
+    'spatial_sort': ('from mapshader.commands.spatial_sort import spatial_sort', 'spatial_sort'),
+    'tif_to_netcdf': ('from mapshader.commands.tif_to_netcdf import tif_to_netcdf',
+                      'tif_to_netcdf'),
+    'tile': ('from mapshader.commands.tile import tile', 'tile'),
+}
+
+# modules loaded by the code paths behind the commands, e.g. by the server
+CODE_PATHS = {
+    'serve app': 'import mapshader.flask_app',
+    'sources': 'import mapshader.sources',
+    'tiling': 'import mapshader.tile_utils',
+}
+
+
+def _run(statement):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-W', 'ignore', '-c', statement],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def _median(statement, repeat):
+    return statistics.median(_run(statement) for _ in range(repeat))
+
+
+def _help_statement(import_statement, command):
+    return (f'{import_statement}\n'
+            f'try:\n'
+            f'    {command}(["--help"])\n'
+            f'except SystemExit:\n'
+            f'    pass\n')
+
+
+def benchmark(repeat=5):
+    """
+    Measure the median import and ``--help`` time of every entry point,
+    and the import time of the code paths behind them, in seconds.
+    """
+    results = dict(interpreter=_median('pass', repeat), entry_points={}, code_paths={})
+    for name, (import_statement, command) in ENTRY_POINTS.items():
+        results['entry_points'][name] = dict(
+            import_seconds=_median(import_statement, repeat),
+            help_seconds=_median(_help_statement(import_statement, command), repeat),
+        )
+    for name, statement in CODE_PATHS.items():
+        results['code_paths'][name] = dict(import_seconds=_median(statement, repeat))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Number of runs of every measurement')
+    parser.add_argument('--json', help='Also write the results to this JSON file')
+    args = parser.parse_args()
+
+    results = benchmark(args.repeat)
+
+    print(f'{"interpreter":<24}{results["interpreter"]:>10.3f}s')
+    print(f'{"entry point":<24}{"import":>10} {"--help":>10}')
+    for name, times in results['entry_points'].items():
+        print(f'{name:<24}{times["import_seconds"]:>9.3f}s {times["help_seconds"]:>9.3f}s')
+    print(f'{"code path":<24}{"import":>10}')
+    for name, times in results['code_paths'].items():
+        print(f'{name:<24}{times["import_seconds"]:>9.3f}s')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
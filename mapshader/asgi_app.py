@@ -0,0 +1,398 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
+import re
+
+try:
+    from starlette.applications import Starlette
+    from starlette.concurrency import run_in_threadpool
+    from starlette.middleware import Middleware
+    from starlette.middleware.cors import CORSMiddleware
+    from starlette.responses import HTMLResponse, JSONResponse, Response
+    from starlette.routing import Route
+except ImportError:
+    raise ImportError('You must install starlette `pip install starlette` to use this module')
+
+from mapshader import hello
+from mapshader.cache import LRUCache
+from mapshader.core import InvalidStyleError
+from mapshader.core import parse_style
+from mapshader.core import render_map
+from mapshader.core import render_geojson
+from mapshader.core import render_legend
+from mapshader.core import render_services
+from mapshader.flask_app import ensure_loaded, index_page, service_page, source_readiness
+from mapshader.services import get_services, MapService
+from mapshader.singleflight import AsyncSingleFlight
+from mapshader.sources import MapSource, SourceNotReadyError
+from mapshader.utils import psutil_fetching
+
+
+EXECUTOR_TYPES = ('thread', 'process')
+
+# Sources of the current process, looked up by key by process pool workers.
+_worker_sources = {}
+
+# Aggregate cache of a process pool worker.
+_worker_agg_cache = None
+
+
+def render_png(source: MapSource, load_timeout=None, **kwargs):
+    """
+    Render a map and encode it as PNG.
+
+    Parameters
+    ----------
+    source : mapshader.sources.MapSource
+        The input datasource.
+    load_timeout : float, optional
+        Maximum number of seconds to wait for a load in progress.
+    **kwargs
+        Extent, tile and size arguments passed to ``render_map``.
+
+    Returns
+    -------
+    png : bytes
+        The encoded image.
+    """
+    ensure_loaded(source, load_timeout)
+
+    img = render_map(source, **kwargs)
+    return img.to_bytesio().getvalue()
+
+
+def _init_worker(user_source_filepath, contains, sources, shared_data_dir=None,
+                 warm_up=False, agg_cache_size=0):
+    # Runs once in every process pool worker to build its own sources,
+    # attached to the data published by the server process if shared.
+    global _worker_agg_cache
+    _worker_agg_cache = LRUCache(agg_cache_size)
+    for service in get_services(config_path=user_source_filepath,
+                                contains=contains, sources=sources,
+                                shared_data_dir=shared_data_dir, warm_up=warm_up):
+        _worker_sources[service.source.key] = service.source
+
+
+def _render_png_by_key(key, load_timeout, kwargs):
+    return render_png(_worker_sources[key], load_timeout, agg_cache=_worker_agg_cache, **kwargs)
+
+
+class RenderPool:
+    """
+    Offload ``render_map`` and PNG encoding from the event loop to a
+    pool of threads or processes.
+
+    Process workers cannot share the sources of the server process, so
+    each one builds its own from the same configuration and renders
+    them by source key. With a ``shared_data_dir``, the workers attach
+    to the source data published by the server process rather than
+    loading their own copy.
+
+    Parameters
+    ----------
+    executor : str, default=thread
+        Pool type, either ``thread`` or ``process``.
+    max_workers : int, optional
+        Number of pool workers, defaults to the executor default.
+    user_source_filepath, contains, sources
+        Configuration used to build the sources of process workers.
+    load_timeout : float, optional
+        Maximum number of seconds a render waits for a source load in
+        progress before failing with ``SourceNotReadyError``.
+    shared_data_dir : str, optional
+        Directory the source data is shared with process workers through.
+    warm_up : bool, default=False
+        Compile the renderers of process workers when they start.
+    agg_cache_size : int, default=0
+        Number of tile aggregates each worker process, or the thread
+        pool, keeps to restyle them, see ``mapshader.core.cached_agg``.
+    """
+
+    def __init__(self, executor='thread', max_workers=None,
+                 user_source_filepath=None, contains=None, sources=None, load_timeout=None,
+                 shared_data_dir=None, warm_up=False, agg_cache_size=0):
+        if executor not in EXECUTOR_TYPES:
+            raise ValueError(f'Invalid executor {executor}, must be one of {EXECUTOR_TYPES}')
+
+        self.executor_type = executor
+        self.load_timeout = load_timeout
+        self.agg_cache = LRUCache(agg_cache_size)
+        if executor == 'process':
+            self.executor = ProcessPoolExecutor(
+                max_workers=max_workers,
+                initializer=_init_worker,
+                initargs=(user_source_filepath, contains, sources, shared_data_dir, warm_up,
+                          agg_cache_size),
+            )
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                               thread_name_prefix='mapshader-render')
+
+    async def render(self, source: MapSource, **kwargs):
+        """
+        Render a map to PNG bytes in the pool without blocking the loop.
+        """
+        loop = asyncio.get_running_loop()
+        if self.executor_type == 'process':
+            func = partial(_render_png_by_key, source.key, self.load_timeout, kwargs)
+        else:
+            func = partial(render_png, source, self.load_timeout, agg_cache=self.agg_cache,
+                           **kwargs)
+        return await loop.run_in_executor(self.executor, func)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+def _to_route_path(flask_url):
+    # Flask style ``/<z>/<x>`` to Starlette style ``/{z}/{x}``.
+    return re.sub(r'<(\w+)>', r'{\1}', flask_url)
+
+
+async def _limited(limit, coro):
+    if limit is None:
+        return await coro
+    async with limit:
+        return await coro
+
+
+def _png_response(png):
+    return Response(png, media_type='image/png')
+
+
+async def asgi_to_tile(request, source: MapSource, pool: RenderPool, limit=None, cache=None,
+                       flight: AsyncSingleFlight = None):
+    z = int(request.path_params['z'])
+    x = int(request.path_params['x'])
+    y = int(request.path_params['y'])
+    style = parse_style(request.query_params)
+
+    # cache hits are answered straight from the event loop
+    key = (source.key, z, x, y, tuple(sorted(style.items())))
+    png = cache.get(key) if cache is not None else None
+    if png is None:
+        def render():
+            return _limited(limit, pool.render(source, x=x, y=y, z=z, height=256, width=256,
+                                               style=style))
+
+        # concurrent requests for the same tile share a single render
+        png = await (flight.do(key, render) if flight is not None else render())
+        if cache is not None:
+            cache.put(key, png)
+
+    return _png_response(png)
+
+
+async def asgi_to_image(request, source: MapSource, pool: RenderPool, limit=None):
+    params = request.path_params
+    png = await _limited(limit, pool.render(source,
+                                            xmin=float(params['xmin']),
+                                            ymin=float(params['ymin']),
+                                            xmax=float(params['xmax']),
+                                            ymax=float(params['ymax']),
+                                            height=int(params['height']),
+                                            width=int(params['width']),
+                                            style=parse_style(request.query_params)))
+    return _png_response(png)
+
+
+async def asgi_to_wms(request, source: MapSource, pool: RenderPool, limit=None):
+    height = request.query_params.get('height')
+    width = request.query_params.get('width')
+    bbox = request.query_params.get('bbox')
+    xmin, ymin, xmax, ymax = bbox.split(',')
+    png = await _limited(limit, pool.render(source,
+                                            xmin=float(xmin), ymin=float(ymin),
+                                            xmax=float(xmax), ymax=float(ymax),
+                                            height=int(height), width=int(width),
+                                            style=parse_style(request.query_params)))
+    return _png_response(png)
+
+
+def _load_and_render_geojson(source: MapSource, load_timeout=None):
+    ensure_loaded(source, load_timeout)
+    return render_geojson(source)
+
+
+async def asgi_to_geojson(request, source: MapSource, pool: RenderPool, limit=None):
+    resp = await _limited(limit, run_in_threadpool(_load_and_render_geojson, source,
+                                                   pool.load_timeout))
+    return Response(resp, media_type='application/json')
+
+
+async def asgi_to_legend(request, source: MapSource):
+    return Response(render_legend(source), media_type='application/json')
+
+
+async def asgi_to_services(request, services: list):
+    return Response(render_services(services), media_type='application/json')
+
+
+async def asgi_to_service_page(request, service: MapService):
+    html = await run_in_threadpool(service_page, service)
+    return HTMLResponse(html)
+
+
+async def asgi_to_index_page(request, services: list):
+    return HTMLResponse(index_page(services))
+
+
+async def asgi_to_psutil(request):
+    log = await run_in_threadpool(psutil_fetching)
+    return JSONResponse(log)
+
+
+async def asgi_to_ready(request, sources: list, pool: RenderPool = None):
+    # process workers load their own sources, which are not queried, so
+    # the states are the ones of the server process in either executor
+    ready, states = source_readiness(sources)
+    executor = pool.executor_type if pool is not None else 'thread'
+    return JSONResponse(dict(ready=ready, sources=states, executor=executor),
+                        status_code=200 if ready else 503)
+
+
+async def asgi_source_not_ready(request, error, retry_after=5):
+    return Response(str(error), status_code=503, headers={'Retry-After': str(retry_after)})
+
+
+async def asgi_invalid_style(request, error):
+    return Response(str(error), status_code=400)
+
+
+async def asgi_to_stats(request, cache: LRUCache, flight: AsyncSingleFlight,
+                        pool: RenderPool = None):
+    stats = dict(coalescing=flight.stats(), tile_cache=cache.stats())
+    if pool is not None and pool.executor_type == 'thread':
+        stats['agg_cache'] = pool.agg_cache.stats()
+    return JSONResponse(stats)
+
+
+def create_asgi_app(user_source_filepath=None, contains=None, sources=None,
+                    executor='thread', max_workers=None, concurrency=None,
+                    tile_cache_size=1024, load_timeout=None, retry_after=5,
+                    load_workers=None, background_load=False, shared_data_dir=None,
+                    warm_up=False, agg_cache_size=0):
+    """
+    Create an ASGI application serving the same routes as the Flask app.
+
+    Parameters
+    ----------
+    user_source_filepath : str
+        Relative path to the config file.
+    contains : str
+        Skip the service type creation that contains this route.
+    sources : list of dict
+        The map source objects.
+    executor : str, default=thread
+        Run renders in a ``thread`` or ``process`` pool. Process workers
+        load their own sources, and ``/ready`` only reports the load
+        state of the sources of the server process, along with the
+        ``executor``. A source failing to load in a worker fails the
+        renders sent to it instead.
+    max_workers : int, optional
+        Number of render pool workers.
+    concurrency : dict, optional
+        Maximum number of concurrent requests per service type, e.g.
+        ``{'wms': 2}``. Service types not listed are only limited by
+        the render pool.
+    tile_cache_size : int, default=1024
+        Number of encoded tiles kept in memory. Use 0 to disable.
+    load_timeout : float, optional
+        Maximum number of seconds a request waits for a source that is
+        loading before getting a 503 response.
+    retry_after : int, default=5
+        Value of the ``Retry-After`` header of 503 responses.
+    load_workers : int, optional
+        Maximum number of sources loading at once at startup.
+    background_load : bool, default=False
+        Start serving without waiting for the startup loads to finish.
+    shared_data_dir : str, optional
+        Directory the data of the preloaded sources is published to and
+        attached from by process workers, see ``mapshader.shared_data``.
+    warm_up : bool, default=False
+        Compile the renderers of the preloaded sources once they are
+        loaded, in the server process and in every process worker.
+    agg_cache_size : int, default=0
+        Number of tile aggregates kept by the thread pool, or by every
+        process worker, so requests restyling them with the ``cmap``,
+        ``span`` and ``how`` query parameters only shade them. Disabled
+        by default.
+
+    Returns
+    -------
+    app : starlette.applications.Starlette
+    """
+    pool = RenderPool(executor, max_workers, user_source_filepath, contains, sources,
+                      load_timeout, shared_data_dir, warm_up, agg_cache_size)
+    tile_cache = LRUCache(tile_cache_size)
+    tile_flight = AsyncSingleFlight()
+    limits = {service_type: asyncio.Semaphore(limit)
+              for service_type, limit in (concurrency or {}).items()}
+
+    view_func_creators = {
+        'tile': partial(asgi_to_tile, cache=tile_cache, flight=tile_flight),
+        'image': asgi_to_image,
+        'wms': asgi_to_wms,
+        'geojson': asgi_to_geojson,
+    }
+
+    routes = []
+    services = []
+    for service in get_services(
+            config_path=user_source_filepath, contains=contains, sources=sources,
+            load_workers=load_workers, background_load=background_load,
+            shared_data_dir=shared_data_dir, warm_up=warm_up):
+        services.append(service)
+
+        view_func = view_func_creators[service.service_type]
+
+        # add operational endpoint
+        routes.append(Route(_to_route_path(service.service_url),
+                            partial(view_func, source=service.source, pool=pool,
+                                    limit=limits.get(service.service_type)),
+                            name=service.name))
+        # add legend endpoint
+        routes.append(Route(service.legend_url,
+                            partial(asgi_to_legend, source=service.source),
+                            name=service.legend_name))
+        # add service page endpoint
+        routes.append(Route(service.service_page_url,
+                            partial(asgi_to_service_page, service=service),
+                            name=service.service_page_name))
+
+    routes.append(Route('/', partial(asgi_to_index_page, services=services), name='home'))
+    routes.append(Route('/services', partial(asgi_to_services, services=services),
+                        name='services'))
+    routes.append(Route('/psutil', asgi_to_psutil, name='psutil'))
+    routes.append(Route('/stats', partial(asgi_to_stats, cache=tile_cache, flight=tile_flight,
+                                          pool=pool),
+                        name='stats'))
+
+    map_sources = list({id(s.source): s.source for s in services}.values())
+    routes.append(Route('/ready', partial(asgi_to_ready, sources=map_sources, pool=pool),
+                        name='ready'))
+
+    @asynccontextmanager
+    async def lifespan(app):
+        yield
+        pool.shutdown()
+        # close the files the sources keep open
+        for source in map_sources:
+            source.unload()
+
+    app = Starlette(routes=routes,
+                    middleware=[Middleware(CORSMiddleware, allow_origins=['*'])],
+                    exception_handlers={
+                        SourceNotReadyError: partial(asgi_source_not_ready,
+                                                     retry_after=retry_after),
+                        InvalidStyleError: asgi_invalid_style,
+                    },
+                    lifespan=lifespan)
+    app.state.render_pool = pool
+    app.state.tile_cache = tile_cache
+    app.state.tile_flight = tile_flight
+
+    hello(services)
+
+    return app
@@ -9,9 +9,62 @@ from datashader.colors import Set3
 from datashader.colors import Sets1to3
 from datashader.colors import hex_to_rgb
 
-import bokeh.palettes as bokeh_colors
 
-colors = {
+class _Colors(dict):
+    """
+    Colors by name. The bokeh palettes are added on the first lookup of
+    a name that is not defined here, as importing bokeh is slow.
+    """
+
+    _palettes_added = False
+
+    def _add_palettes(self):
+        if self._palettes_added:
+            return
+        self._palettes_added = True
+
+        import bokeh.palettes as bokeh_colors
+
+        for color_group_name, hex_by_number in bokeh_colors.all_palettes.items():
+            for n, hex_list in hex_by_number.items():
+                self[color_group_name + str(n)] = [hex_to_rgb(hex_color) for hex_color in hex_list]
+
+    def __missing__(self, key):
+        if self._palettes_added:
+            raise KeyError(key)
+        self._add_palettes()
+        return self[key]
+
+    def __contains__(self, key):
+        if not dict.__contains__(self, key):
+            self._add_palettes()
+        return dict.__contains__(self, key)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def __iter__(self):
+        self._add_palettes()
+        return dict.__iter__(self)
+
+    def __len__(self):
+        self._add_palettes()
+        return dict.__len__(self)
+
+    def keys(self):
+        self._add_palettes()
+        return dict.keys(self)
+
+    def values(self):
+        self._add_palettes()
+        return dict.values(self)
+
+    def items(self):
+        self._add_palettes()
+        return dict.items(self)
+
+
+colors = _Colors({
     'race': dict((('w', 'aqua'),
                   ('b', 'lime'),
                   ('a', 'red'),
@@ -29,8 +82,4 @@ colors = {
     'hotspots': list(reversed(['#d53e4f', '#fc8d59',
                                '#fee08b', '#ffffbf', "#e6f598",
                                '#99d594', '#3288bd']))
-}
-
-for color_group_name, hex_by_number in bokeh_colors.all_palettes.items():
-    for n, hex_list in hex_by_number.items():
-        colors[color_group_name + str(n)] = [hex_to_rgb(hex_color) for hex_color in hex_list]
+})
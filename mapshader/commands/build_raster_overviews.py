@@ -1,9 +1,6 @@
 import click
 import yaml
 
-from ..scan import directory_to_config
-from ..sources import MapSource
-
 
 @click.command(
     no_args_is_help=True,
@@ -34,6 +31,9 @@ from ..sources import MapSource
     help='Force recreation of overviews even if they already exist.',
 )
 def build_raster_overviews(config_yaml, scan_directory, overview_levels, force):
+    from ..scan import directory_to_config
+    from ..sources import MapSource
+
     if not config_yaml and not scan_directory:
         raise RuntimeError("Must specify at least one of config_yaml and scan_directory")
 
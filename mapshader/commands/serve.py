@@ -1,8 +1,5 @@
 import click
 
-from ..flask_app import create_app
-from ..scan import directory_to_config
-
 
 @click.command(
     context_settings=dict(help_option_names=['-h', '--help']),
@@ -48,10 +45,94 @@ from ..scan import directory_to_config
     '--scan_directory',
     type=click.Path(exists=True),
 )
-def serve(config_yaml=None, host='0.0.0.0', port=5000, glob=None, debug=False, scan_directory=None):
+@click.option(
+    '--asgi',
+    'asgi',
+    is_flag=True,
+    default=False,
+    help='Serve with an ASGI server that renders in a worker pool (requires uvicorn)',
+)
+@click.option(
+    '--executor',
+    'executor',
+    default='thread',
+    type=click.Choice(['thread', 'process']),
+    show_default=True,
+    help='Worker pool type used to render maps in ASGI mode',
+)
+@click.option(
+    '--max_workers',
+    'max_workers',
+    type=int,
+    help='Number of render workers in ASGI mode',
+)
+@click.option(
+    '--load_timeout',
+    'load_timeout',
+    type=float,
+    help='Seconds a request waits for a source that is loading before a 503 response',
+)
+@click.option(
+    '--load_workers',
+    'load_workers',
+    type=int,
+    help='Maximum number of sources loading at once at startup',
+)
+@click.option(
+    '--background_load',
+    'background_load',
+    is_flag=True,
+    default=False,
+    help='Start accepting requests while sources finish loading in the background',
+)
+@click.option(
+    '--shared_data_dir',
+    'shared_data_dir',
+    type=click.Path(file_okay=False),
+    help=('Directory to share the loaded source data with other processes through, '
+          'e.g. under /dev/shm. Sources published there by another process are '
+          'attached to instead of loaded'),
+)
+@click.option(
+    '--workers',
+    'workers',
+    type=click.IntRange(min=1),
+    help=('Serve with a pre-forking gunicorn server of this many worker processes, '
+          'attached to the source data loaded once by the master (requires gunicorn)'),
+)
+@click.option(
+    '--threads',
+    'threads',
+    default=1,
+    type=click.IntRange(min=1),
+    show_default=True,
+    help='Number of threads handling requests in each gunicorn worker',
+)
+@click.option(
+    '--warm_up/--no_warm_up',
+    'warm_up',
+    default=True,
+    show_default=True,
+    help='Compile the renderers of the preloaded sources before serving requests',
+)
+@click.option(
+    '--agg_cache_size',
+    'agg_cache_size',
+    default=0,
+    type=click.IntRange(min=0),
+    show_default=True,
+    help=('Number of tile aggregates kept in memory, so requests restyling them with '
+          'the cmap, span and how query parameters only shade them. 0 disables it'),
+)
+def serve(config_yaml=None, host='0.0.0.0', port=5000, glob=None, debug=False, scan_directory=None,
+          asgi=False, executor='thread', max_workers=None, load_timeout=None, load_workers=None,
+          background_load=False, shared_data_dir=None, workers=None, threads=1, warm_up=True,
+          agg_cache_size=0):
 
     from os import path
 
+    from ..scan import directory_to_config
+
     if config_yaml:
         config_yaml = path.abspath(path.expanduser(config_yaml))
 
@@ -59,5 +140,48 @@ def serve(config_yaml=None, host='0.0.0.0', port=5000, glob=None, debug=False, s
     if scan_directory:
         sources = directory_to_config(scan_directory)
 
-    create_app(config_yaml, contains=glob, sources=sources).run(
-        host=host, port=port, debug=debug)
+    if workers:
+        if asgi:
+            raise click.BadParameter('--workers is not supported with --asgi, '
+                                     'use --executor process instead')
+
+        try:
+            import gunicorn  # noqa: F401
+        except ImportError:
+            raise ImportError('You must install gunicorn `pip install gunicorn` to use --workers')
+
+        from ..gunicorn_app import MapshaderApplication
+
+        options = dict(bind=f'{host}:{port}', workers=workers, threads=threads,
+                       loglevel='debug' if debug else 'info')
+        MapshaderApplication(config_yaml, contains=glob, sources=sources,
+                             shared_data_dir=shared_data_dir, options=options,
+                             load_timeout=load_timeout, load_workers=load_workers,
+                             background_load=background_load, warm_up=warm_up,
+                             agg_cache_size=agg_cache_size).run()
+        return
+
+    if asgi:
+        try:
+            import uvicorn
+        except ImportError:
+            raise ImportError('You must install uvicorn `pip install uvicorn` to use --asgi')
+
+        from ..asgi_app import create_asgi_app
+
+        app = create_asgi_app(config_yaml, contains=glob, sources=sources,
+                              executor=executor, max_workers=max_workers,
+                              load_timeout=load_timeout, load_workers=load_workers,
+                              background_load=background_load,
+                              shared_data_dir=shared_data_dir, warm_up=warm_up,
+                              agg_cache_size=agg_cache_size)
+        uvicorn.run(app, host=host, port=port, log_level='debug' if debug else 'info')
+        return
+
+    from ..flask_app import create_app
+
+    app = create_app(config_yaml, contains=glob, sources=sources, load_timeout=load_timeout,
+                     load_workers=load_workers, background_load=background_load,
+                     shared_data_dir=shared_data_dir, warm_up=warm_up,
+                     agg_cache_size=agg_cache_size)
+    app.run(host=host, port=port, debug=debug)
@@ -0,0 +1,134 @@
+from os import path
+import sys
+
+import click
+
+
+def _read(filepath):
+    import geopandas as gpd
+    import pandas as pd
+
+    if path.splitext(filepath)[1] == '.parquet':
+        try:
+            return gpd.read_parquet(filepath)
+        except ValueError:
+            # plain parquet without GeoParquet metadata
+            return pd.read_parquet(filepath)
+    elif path.splitext(filepath)[1] == '.csv':
+        return pd.read_csv(filepath)
+    return gpd.read_file(filepath)
+
+
+@click.command(
+    no_args_is_help=True,
+    context_settings=dict(help_option_names=['-h', '--help']),
+    short_help='Write a spatially sorted parquet file with a partition index.',
+    help=(
+        'Sort the features of the dataset at `FILEPATH` along a space filling '
+        'curve in Web Mercator and write them to parquet, with a sidecar index '
+        'of the bounds of every row group that mapshader uses to skip the row '
+        'groups outside of the rendered extent.'
+    ),
+)
+@click.argument(
+    'filepath',
+    type=click.Path(exists=True),
+    required=True,
+)
+@click.option(
+    '-o',
+    '--output',
+    type=str,
+    default=None,
+    help='Output parquet file, defaults to `<FILEPATH>_sorted.parquet`.',
+)
+@click.option(
+    '--curve',
+    # mapshader.spatial_sort.CURVES, not imported to keep the CLI startup fast
+    type=click.Choice(('hilbert', 'morton')),
+    default='hilbert',
+    show_default=True,
+    help='The space filling curve to sort by.',
+)
+@click.option(
+    '--xfield',
+    type=str,
+    default=None,
+    help='The x field name of point data in Web Mercator. '
+         'The geometry is used if not given.',
+)
+@click.option(
+    '--yfield',
+    type=str,
+    default=None,
+    help='The y field name of point data in Web Mercator. '
+         'The geometry is used if not given.',
+)
+@click.option(
+    '--geometry_field',
+    type=str,
+    default='geometry',
+    show_default=True,
+    help='The geometry field name.',
+)
+@click.option(
+    '--row_group_size',
+    type=int,
+    default=65536,
+    show_default=True,
+    help='Number of rows per row group. Smaller row groups are skipped more '
+         'precisely but add metadata.',
+)
+def spatial_sort(filepath, output, curve, xfield, yfield, geometry_field, row_group_size):
+    '''
+    Write a spatially sorted parquet file with a partition index.
+
+    Parameters
+    ----------
+    filepath : str
+        Relative path to the input dataset, a parquet, CSV or any
+        file readable by ``geopandas.read_file``.
+    output : str
+        Output parquet file.
+    curve : str
+        The space filling curve, either ``hilbert`` or ``morton``.
+    xfield, yfield : str
+        The x and y field names of point data in Web Mercator.
+    geometry_field : str
+        The geometry field name.
+    row_group_size : int
+        Number of rows per row group.
+    '''
+    import geopandas as gpd
+
+    from mapshader.spatial_sort import default_output_path
+    from mapshader.spatial_sort import sort_spatially
+    from mapshader.spatial_sort import write_sorted_parquet
+
+    if bool(xfield) != bool(yfield):
+        raise click.BadParameter('--xfield and --yfield must be given together')
+
+    input_file = path.abspath(path.expanduser(filepath))
+    output = output or default_output_path(input_file)
+
+    print(f'Reading {input_file}', file=sys.stdout)
+    df = _read(input_file)
+
+    for field in (xfield, yfield):
+        if field and field not in df.columns:
+            raise click.BadParameter(f"The field {field} doesn't exist.")
+
+    if not xfield:
+        if not isinstance(df, gpd.GeoDataFrame):
+            raise click.BadParameter('--xfield and --yfield are required for non spatial data')
+        if df.crs is not None and df.crs.to_epsg() != 3857:
+            print('Reprojecting to EPSG:3857', file=sys.stdout)
+            df = df.to_crs(epsg=3857)
+
+    print(f'Sorting {len(df)} features by {curve} code', file=sys.stdout)
+    df = sort_spatially(df, curve, xfield, yfield, geometry_field)
+
+    index = write_sorted_parquet(df, output, row_group_size, xfield, yfield,
+                                 geometry_field, curve)
+
+    print(f'Wrote {len(index["row_groups"])} row groups to {output}', file=sys.stdout)
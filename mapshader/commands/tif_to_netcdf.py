@@ -2,13 +2,6 @@ from os import path
 import sys
 
 import click
-import xarray as xr
-
-from mapshader.transforms import cast
-from mapshader.transforms import flip_coords
-from mapshader.transforms import orient_array
-from mapshader.transforms import reproject_raster
-from mapshader.transforms import squeeze
 
 
 @click.command(
@@ -110,6 +103,14 @@ def tif_to_netcdf(
     crs : int
         Reproject the data to the given CRS.
     '''
+    import xarray as xr
+
+    from mapshader.transforms import cast
+    from mapshader.transforms import flip_coords
+    from mapshader.transforms import orient_array
+    from mapshader.transforms import reproject_raster
+    from mapshader.transforms import squeeze
+
     input_file = path.abspath(path.expanduser(filepath))
     output_file = input_file.replace('.tif', '.nc')
 
@@ -3,9 +3,6 @@ from os import path
 import click
 import yaml
 
-from ..sources import MapSource
-from ..tile_utils import save_tiles_to_outpath
-
 
 @click.command(
     no_args_is_help=True,
@@ -26,6 +23,8 @@ from ..tile_utils import save_tiles_to_outpath
     help='Output location to write tile images.',
 )
 def tile(config_yaml, outpath):
+    from ..sources import MapSource
+    from ..tile_utils import list_tiles, save_tiles_to_outpath
 
     config_yaml = path.abspath(path.expanduser(config_yaml))
     with open(config_yaml, 'r') as f:
@@ -40,4 +39,6 @@ def tile(config_yaml, outpath):
         if source.tiling is None:
             continue
 
-        save_tiles_to_outpath(source, outpath)
+        tiles_ddf = list_tiles(source)
+        empty_tiles = source.tiling.get('empty_tiles', 'skip')
+        save_tiles_to_outpath(source, tiles_ddf, outpath, empty_tiles=empty_tiles)
@@ -1,6 +1,10 @@
+import copy
 import json
 import sys
 import os
+import time
+
+from functools import lru_cache as memoized
 
 from io import BytesIO
 
@@ -8,19 +12,29 @@ import datashader as ds
 import numpy as np
 import geopandas as gpd
 import dask.array as da
+import dask.dataframe as dd
 
 import datashader.transfer_functions as tf
 import datashader.reductions as rd
 from datashader.colors import rgb
+from datashader.utils import calc_bbox
+from datashader.utils import calc_res
 
 import xarray as xr
 
+from numba import jit
+from numba.core import event
+
 from xrspatial import hillshade
 from xrspatial.classify import quantile
 from xrspatial.utils import height_implied_by_aspect_ratio
 
+from mapshader.cache import LRUCache
+from mapshader.geotiff import WindowedGeoTIFF
+from mapshader.io import select_partitions
 from mapshader.mercator import MercatorTileDefinition
 from mapshader.sources import MapSource
+from mapshader.transforms import xy_origin
 from .multifile import MultiFileRaster
 
 import spatialpandas as spd
@@ -28,6 +42,10 @@ import spatialpandas as spd
 tile_def = MercatorTileDefinition(x_range=(-20037508.34, 20037508.34),
                                   y_range=(-20037508.34, 20037508.34))
 
+ngjit = jit(nopython=True, nogil=True, cache=True)
+
+EMPTY_TILE_MODES = ('skip', 'blob', 'write')
+
 
 def create_agg(source: MapSource,
                xmin: float = None, ymin: float = None,
@@ -84,16 +102,32 @@ def create_agg(source: MapSource,
         if dataset is None:
             dataset = source.data.load_bounds(xmin, ymin, xmax, ymax, source.band,
                                               source.transforms)
+    elif isinstance(source.data, WindowedGeoTIFF):
+        dataset = source.data.read_bounds(xmin, ymin, xmax, ymax, width, height)
     elif z and z in source.overviews:
         print(f'Using overview: {z}', file=sys.stdout)
         dataset = source.overviews[z]
     else:
         dataset = source.data
 
+        # only compute the partitions of lazy point data within the extent
+        partition_index = getattr(source, 'partition_index', None)
+        if partition_index is not None:
+            partitions = select_partitions(partition_index, xmin, ymin, xmax, ymax)
+            dataset = dataset.partitions[list(partitions) or [0]]
+
     cvs = ds.Canvas(plot_width=width, plot_height=height,
                     x_range=(xmin, xmax), y_range=(ymin, ymax))
 
     if geometry_type == 'point':
+        # compacted points are stored relative to an origin
+        x0, y0 = xy_origin(dataset)
+        if x0 or y0:
+            cvs = ds.Canvas(plot_width=width, plot_height=height,
+                            x_range=(xmin - x0, xmax - x0), y_range=(ymin - y0, ymax - y0))
+            agg = point_aggregation(cvs, dataset, xfield, yfield, zfield, geometry_field,
+                                    agg_func)
+            return agg.assign_coords({xfield: agg[xfield] + x0, yfield: agg[yfield] + y0})
         return point_aggregation(cvs, dataset, xfield, yfield, zfield, geometry_field, agg_func)
 
     elif geometry_type == 'line':
@@ -259,6 +293,10 @@ def raster_aggregation(cvs, data, interpolate='linear', padding=0, agg_method=rd
                       x_range=(new_xmin, new_xmax),
                       y_range=(new_ymin, new_ymax))
 
+    agg = aligned_raster_aggregation(stcvs, data, interpolate, agg_method)
+    if agg is not None:
+        return agg
+
     try:
         agg = stcvs.raster(data, interpolate=interpolate, agg=agg_method)
         # revert agg.data to match the coord system
@@ -272,11 +310,174 @@ def raster_aggregation(cvs, data, interpolate='linear', padding=0, agg_method=rd
     return agg
 
 
+# Largest misalignment, in source pixels, of a raster read as blocks.
+ALIGN_TOLERANCE = 1e-3
+
+_BLOCK_REDUCTIONS = {'max': 0, rd.max: 0, 'min': 1, rd.min: 1, 'mean': 2, rd.mean: 2}
+
+
+@ngjit
+def _block_reduce(data, fy, fx, how, out):
+    # nan-skipping max (0), min (1) or mean (2) of fy x fx blocks, read
+    # row by row
+    height, width = out.shape
+    acc = np.empty(width)
+    count = np.empty(width, np.int64)
+    for i in range(height):
+        acc[:] = -np.inf if how == 0 else np.inf if how == 1 else 0.
+        count[:] = 0
+        for di in range(i * fy, (i + 1) * fy):
+            for j in range(width):
+                a = acc[j]
+                c = 0
+                for dj in range(j * fx, (j + 1) * fx):
+                    v = data[di, dj]
+                    if v == v:
+                        c += 1
+                        if how == 0:
+                            if v > a:
+                                a = v
+                        elif how == 1:
+                            if v < a:
+                                a = v
+                        else:
+                            a += v
+                acc[j] = a
+                count[j] += c
+        for j in range(width):
+            if count[j] == 0:
+                out[i, j] = np.nan
+            elif how == 2:
+                out[i, j] = acc[j] / count[j]
+            else:
+                out[i, j] = acc[j]
+
+
+def _block_reduction(agg_method):
+    if isinstance(agg_method, rd.Reduction):
+        if agg_method.column is not None:
+            return None
+        agg_method = type(agg_method)
+    return _BLOCK_REDUCTIONS.get(agg_method)
+
+
+def _is_regular(values, res):
+    return np.abs(np.diff(values) - res).max() <= ALIGN_TOLERANCE * abs(res)
+
+
+def aligned_raster_aggregation(cvs, data, interpolate='linear', agg_method=rd.max()):
+    """
+    Aggregate a raster whose pixels are aligned to the canvas pixels,
+    such as the tile-aligned overviews of a ``MultiFileRaster``, by
+    slicing it or reducing blocks of an integer number of pixels.
+
+    Only the window of the canvas is read from lazy rasters. The blocks
+    are aligned to the canvas rather than to the edge of the data, and
+    pixels outside of the data are missing.
+
+    Parameters
+    ----------
+    cvs : datashader.Canvas
+        The input canvas.
+    data : xarray.DataArray
+        The input raster.
+    interpolate : str, default=linear
+        Resampling mode when upsampling raster, only checked for
+        consistency with ``raster_aggregation`` as aligned rasters are
+        never upsampled.
+    agg_method : Reduction, default=datashader.reductions.max()
+        Reduction of the blocks, one of max, min or mean.
+
+    Returns
+    -------
+    agg : xarray.DataArray or None
+        The aggregate, oriented like the ones of ``raster_aggregation``,
+        or None if the raster is not aligned to the canvas.
+    """
+    if (not isinstance(data, xr.DataArray) or data.ndim != 2
+            or min(data.shape) < 2 or not np.issubdtype(data.dtype, np.floating)
+            or interpolate not in (None, 'nearest', 'linear')):
+        return None
+
+    how = _block_reduction(agg_method)
+    if how is None:
+        return None
+
+    ydim, xdim = data.dims
+    xvals, yvals = data[xdim].values, data[ydim].values
+    # yres is positive if y is decreasing
+    xres, yres = calc_res(data)
+    if not xres > 0 or not yres or not _is_regular(xvals, xres) or \
+            not _is_regular(yvals, -yres):
+        return None
+
+    (xmin, xmax), (ymin, ymax) = cvs.x_range, cvs.y_range
+    width, height = cvs.plot_width, cvs.plot_height
+
+    # block sizes and first source pixel of the canvas along the data rows
+    fx = (xmax - xmin) / width / xres
+    fy = (ymax - ymin) / height / abs(yres)
+    col = (xmin - xvals[0]) / xres + 0.5
+    if yres > 0:
+        row = (yvals[0] - ymax) / yres + 0.5
+    else:
+        row = (ymin - yvals[0]) / -yres + 0.5
+
+    offsets = np.array([fx, fy, col, row])
+    rounded = np.round(offsets)
+    if min(fx, fy) < 0.5 or np.abs(offsets - rounded).max() > ALIGN_TOLERANCE:
+        return None
+    fx, fy, col, row = rounded.astype(int)
+
+    nrows, ncols = height * fy, width * fx
+    r0, r1 = max(row, 0), min(row + nrows, data.shape[0])
+    c0, c1 = max(col, 0), min(col + ncols, data.shape[1])
+    if r0 >= r1 or c0 >= c1:
+        return None
+
+    window = np.asarray(data.data[r0:r1, c0:c1])
+    if window.shape != (nrows, ncols):
+        padded = np.full((nrows, ncols), np.nan, dtype=window.dtype)
+        padded[r0 - row:r1 - row, c0 - col:c1 - col] = window
+        window = padded
+
+    out = np.empty((height, width), dtype=window.dtype)
+    _block_reduce(window, fy, fx, how, out)
+
+    # coords and attrs as computed by datashader
+    left, bottom, right, top = calc_bbox(xvals, yvals, (xres, yres))
+    if np.allclose([left, right], cvs.x_range) and xvals.size == width:
+        xs = xvals
+    else:
+        xs = cvs.x_axis.compute_index(cvs.x_axis.compute_scale_and_translate(cvs.x_range, width),
+                                      width)
+    if np.allclose([bottom, top], cvs.y_range) and yvals.size == height:
+        ys = yvals
+    else:
+        ys = cvs.y_axis.compute_index(cvs.y_axis.compute_scale_and_translate(cvs.y_range, height),
+                                      height)
+        if yres > 0:
+            ys = ys[::-1]
+
+    attrs = dict(res=xres, x_range=cvs.x_range, y_range=cvs.y_range)
+    for name in ['_FillValue', 'missing_value', 'fill_value', 'nodata', 'NODATA']:
+        if name in data.attrs:
+            attrs['nodata'] = data.attrs[name]
+            break
+    else:
+        nodatavals = data.attrs.get('nodatavals')
+        if nodatavals:
+            attrs['nodata'] = nodatavals[0]
+
+    # the rows are reversed like the ones of raster_aggregation
+    return xr.DataArray(out[::-1], coords={xdim: xs, ydim: ys}, dims=[ydim, xdim], attrs=attrs)
+
+
 additional_transforms = {'hillshade': hillshade,
                          'quantile': quantile}
 
 
-def apply_additional_transforms(source: MapSource, agg: xr.DataArray):
+def apply_additional_transforms(source: MapSource, agg: xr.DataArray, skip=()):
     """
     Apply additional transforms over the data, which options could be
     ``hillshade`` or ``quantile``.
@@ -287,6 +488,8 @@ def apply_additional_transforms(source: MapSource, agg: xr.DataArray):
         The map source object.
     agg : xarray.DataArray
         The transformed datasource.
+    skip : tuple of str, optional
+        Transforms already applied to the aggregate.
 
     Returns
     -------
@@ -298,6 +501,8 @@ def apply_additional_transforms(source: MapSource, agg: xr.DataArray):
     agg = agg.astype('float64')
     agg.data[agg.data == 0] = np.nan
     for e in source.extras:
+        if e in skip:
+            continue
         if e in additional_transforms:
             trans = additional_transforms.get(e)
             if trans is not None:
@@ -308,6 +513,221 @@ def apply_additional_transforms(source: MapSource, agg: xr.DataArray):
     return source, agg
 
 
+# Categories with integer values below this are looked up by index.
+DIRECT_LUT_SIZE = 1 << 16
+
+
+class CategoricalLUT:
+    """
+    Lookup table of the packed RGBA colors of the categories of a color
+    key, which shades an aggregate in a single pass over its pixels.
+
+    Small non-negative integer categories are looked up by index, other
+    numeric categories by a binary search of the sorted categories.
+    Non-numeric categories never match an aggregate and are dropped.
+
+    Parameters
+    ----------
+    color_key : dict
+        Categories colors, a key may be a tuple of categories sharing
+        a color.
+    alpha : int, default=255
+        Alpha value of the colormapped pixels.
+    nodata : int, default=0
+        Pixels whose red channel is not above this value are transparent.
+    """
+
+    def __init__(self, color_key, alpha=255, nodata=0):
+        colors = {}
+        for cats, color in color_key.items():
+            r, g, b = rgb(color)
+            a = 0 if r <= nodata else alpha
+            rgba = np.array([r, g, b, a], dtype=np.uint8).view(np.uint32)[0]
+            for c in (cats if isinstance(cats, (list, tuple)) else (cats,)):
+                if isinstance(c, (int, float, np.number)) and np.isfinite(c):
+                    colors[c] = rgba
+
+        keys = np.array(sorted(colors), dtype=np.float64)
+        values = np.array([colors[k] for k in sorted(colors)], dtype=np.uint32)
+
+        self.direct = bool(len(keys) and keys[0] >= 0 and keys[-1] < DIRECT_LUT_SIZE
+                           and (keys == np.floor(keys)).all())
+        if self.direct:
+            self.keys = None
+            self.values = np.zeros(int(keys[-1]) + 1, dtype=np.uint32)
+            self.values[keys.astype(np.int64)] = values
+        else:
+            self.keys = keys
+            self.values = values
+
+    def shade(self, data):
+        """
+        Shade a 2D array, values are truncated to integers before looking
+        them up and values without category are transparent.
+
+        Parameters
+        ----------
+        data : numpy.ndarray
+            The 2D aggregate values.
+
+        Returns
+        -------
+        img : numpy.ndarray
+            The packed RGBA pixels as uint32.
+        """
+        out = np.empty(data.shape, dtype=np.uint32)
+        if self.direct:
+            _shade_direct(data, self.values, out)
+        else:
+            _shade_sorted(data, self.keys, self.values, out)
+        return out
+
+
+@ngjit
+def _shade_direct(data, values, out):
+    h, w = data.shape
+    n = values.shape[0]
+    for i in range(h):
+        for j in range(w):
+            v = data[i, j]
+            # comparisons with nan are false
+            if v >= 0 and v < n:
+                out[i, j] = values[int(v)]
+            else:
+                out[i, j] = 0
+
+
+@ngjit
+def _shade_sorted(data, keys, values, out):
+    h, w = data.shape
+    n = keys.shape[0]
+    for i in range(h):
+        for j in range(w):
+            v = data[i, j]
+            out[i, j] = 0
+            if v >= 0:
+                k = np.floor(v)
+                idx = np.searchsorted(keys, k)
+                if idx < n and keys[idx] == k:
+                    out[i, j] = values[idx]
+
+
+@memoized()
+def _cached_categorical_lut(items, alpha, nodata):
+    return CategoricalLUT(dict(items), alpha, nodata)
+
+
+def categorical_lut(color_key, alpha=255, nodata=0):
+    """
+    Get the ``CategoricalLUT`` of a color key, built once per color key.
+    """
+    try:
+        return _cached_categorical_lut(tuple(color_key.items()), alpha, nodata)
+    except TypeError:
+        # unhashable colors
+        return CategoricalLUT(color_key, alpha, nodata)
+
+
+# Largest number of pixels of a level of the hillshade pyramid.
+HILLSHADE_LEVEL_PIXELS = 1 << 24
+
+
+def _hillshade(source: MapSource, agg: xr.DataArray):
+    # hillshade of an aggregate prepared as render_map prepares it
+    if isinstance(source.span, (list, tuple)):
+        agg = agg.where((agg >= source.span[0]) & (agg <= source.span[1]))
+    agg = agg.astype('float64')
+    agg.data[agg.data == 0] = np.nan
+    return hillshade(agg)
+
+
+def _tile_hillshade(source: MapSource, xmin, ymin, xmax, ymax, z, height, width):
+    # hillshade of a space computed with a pixel of halo around it
+    dx = (xmax - xmin) / width
+    dy = (ymax - ymin) / height
+    agg = create_agg(source, xmin - dx, ymin - dy, xmax + dx, ymax + dy,
+                     z=z, height=height + 2, width=width + 2)
+    return _hillshade(source, agg)[1:-1, 1:-1]
+
+
+def load_hillshade_overviews(source: MapSource):
+    """
+    Compute the levels of the hillshade pyramid of a raster source with
+    the ``hillshade`` extra, at each of its overview levels.
+
+    The tiles of a level are computed as ``hillshade_agg`` computes the
+    tiles of other levels, with a pixel of halo around them, so the
+    tiles match whichever way they are rendered. Levels with more than
+    ``HILLSHADE_LEVEL_PIXELS`` pixels are skipped.
+
+    Called by ``MapSource.load`` while holding the load lock, so the
+    first requests do not compute the pyramid concurrently.
+
+    Parameters
+    ----------
+    source : mapshader.sources.MapSource
+        The loaded raster map source object.
+    """
+    if 'hillshade' not in source.extras or source.geometry_type != 'raster':
+        return
+
+    size = tile_def.tile_size
+    for z in sorted(source.overviews):
+        if z in source.hillshade_overviews:
+            continue
+
+        txmin, tymin, txmax, tymax = _tile_range(source, z)
+        if (tymax - tymin + 1) * (txmax - txmin + 1) * size * size > HILLSHADE_LEVEL_PIXELS:
+            continue
+
+        print(f'Generating Hillshade Overview level {z}', file=sys.stdout)
+        level = {}
+        for tx in range(txmin, txmax + 1):
+            for ty in range(tymin, tymax + 1):
+                bounds = tile_def.get_tile_meters(tx, ty, z)
+                level[(tx, ty)] = _tile_hillshade(source, *bounds, z, size, size).compute()
+        source.hillshade_overviews[z] = level
+
+
+def hillshade_agg(source: MapSource,
+                  xmin: float = None, ymin: float = None,
+                  xmax: float = None, ymax: float = None,
+                  x: float = None, y: float = None,
+                  z: float = None,
+                  height: int = 256, width: int = 256):
+    """
+    Compute the hillshade of a raster source within a space.
+
+    Tiles of the overview levels are taken from the hillshade pyramid,
+    see ``load_hillshade_overviews``, others are computed with a pixel of
+    halo around them, so neighbouring tiles match across their borders.
+
+    Parameters
+    ----------
+    source : mapshader.sources.MapSource
+        The raster map source object.
+    xmin, ymin, xmax, ymax : float
+        The space bounds.
+    x, y, z : float
+        The coordinates of the tile, if the space is a tile.
+    height : int
+        Height of the output aggregate in pixels.
+    width : int
+        Width of the output aggregate in pixels.
+
+    Returns
+    -------
+    agg : xarray.DataArray
+        The hillshade.
+    """
+    if x is not None and y is not None and z is not None and height == width == tile_def.tile_size:
+        level = source.hillshade_overviews.get(z)
+        if level is not None and (x, y) in level:
+            return level[(x, y)]
+
+    return _tile_hillshade(source, xmin, ymin, xmax, ymax, z, height, width)
+
+
 def shade_discrete(agg, color_key, name='shaded', alpha=255, nodata=0):
     """
     Convert a DataArray to an image by choosing an RGBA pixel color
@@ -317,8 +737,8 @@ def shade_discrete(agg, color_key, name='shaded', alpha=255, nodata=0):
     ----------
     agg : xarray.DataArray
         The input datasource.
-    color_key : dict
-        Categories colors.
+    color_key : dict or CategoricalLUT
+        Categories colors, or their lookup table.
     name : str, default=shaded
         Name of the datasource array.
     alpha : int, default=255
@@ -341,42 +761,499 @@ def shade_discrete(agg, color_key, name='shaded', alpha=255, nodata=0):
     # check for dask array
     if isinstance(data, da.Array):
         data = data.compute()
+
+    if isinstance(color_key, CategoricalLUT):
+        lut = color_key
     else:
-        data = data.copy()
-
-    # support grouped color_key
-    first_cat = tuple(color_key.keys())[0]
-    if isinstance(first_cat, (list, tuple)):
-        cats = []
-        colors = []
-        for categories, val in color_key.items():
-            cor = rgb(val)
-            for c in categories:
-                cats.append(c)
-                colors.append(cor)
-    else:
-        cats = color_key.keys()
-        colors = [rgb(color_key[c]) for c in cats]
+        lut = categorical_lut(color_key, alpha, nodata)
 
-    rs, gs, bs = map(np.array, zip(*colors))
-    h, w = agg.shape
+    img = lut.shade(np.asarray(data))
+    return tf.Image(img, coords=agg.coords, dims=agg.dims, name=name)
 
-    r = np.zeros((h, w), dtype=np.uint8)
-    g = np.zeros((h, w), dtype=np.uint8)
-    b = np.zeros((h, w), dtype=np.uint8)
 
-    for i, c in enumerate(cats):
-        value_mask = data == c
-        r[value_mask] = rs[i]
-        g[value_mask] = gs[i]
-        b[value_mask] = bs[i]
+# Interpolations of the colormaps the fused shading kernel supports.
+COLORMAP_HOWS = ('linear', 'log', 'cbrt')
+
+_interpolations = (lambda d: d, np.log1p, lambda d: d ** (1 / 3.))
+
+# Number of equal-count bins of the global breaks of eq_hist shading.
+EQ_HIST_BINS = 256
+
+# Number of classes of the quantile extra, as xrspatial.classify.quantile.
+QUANTILE_CLASSES = 4
+
+# Maximum number of tiles the breaks of a zoom level are sampled from.
+BREAKS_SAMPLE_TILES = 16
+
+# Number of zoom levels, from 0, whose breaks are sampled while loading.
+BREAKS_LOAD_LEVELS = 8
+
+# How the kernel maps the values before interpolating them.
+_OFFSET, _EQ_HIST, _CLASSIFY = range(3)
+
+
+class ColormapLUT:
+    """
+    Colormap compiled once into the color stops of a continuous source,
+    which shades an aggregate in a single pass over its pixels without
+    intermediate float64 arrays.
+
+    The pixels match the ones ``datashader.transfer_functions.shade``
+    gives for the aggregate prepared by ``render_map``, i.e. zeros, nans
+    and, unless ``clip`` is set, values out of the span are transparent.
+
+    With ``breaks``, the values are rather equalized or classified with
+    the global breaks of the source, see ``value_breaks``, so the colors
+    are consistent across tiles.
+
+    Parameters
+    ----------
+    cmap : tuple of colors
+        The colormap.
+    how : str, default=linear
+        Interpolation of the values, one of ``COLORMAP_HOWS`` or
+        ``eq_hist`` with ``breaks``.
+    span : tuple of float, optional
+        Minimum and maximum values of the colormap, defaults to the range
+        of each aggregate. Only masks or clips the values with ``breaks``.
+    clip : bool, default=False
+        Clip the values out of the span to it rather than masking them.
+    alpha : int, default=255
+        Alpha value of the pixels with data.
+    breaks : tuple of float, optional
+        Equal-count breaks of the values, the quantiles the CDF of
+        ``eq_hist`` interpolates or the upper bounds of the quantile
+        classes with ``classify``.
+    classify : bool, default=False
+        Shade the classes of the values, as the ``quantile`` extra.
+    """
+
+    def __init__(self, cmap, how='linear', span=None, clip=False, alpha=255,
+                 breaks=None, classify=False):
+        self.rgb = np.array([rgb(c) for c in cmap], dtype=np.float64).T.copy()
+        self.span = None if span is None else tuple(float(v) for v in span)
+        self.clip = clip
+        self.alpha = alpha
+        self.breaks = np.array(breaks if breaks is not None else [], dtype=np.float64)
+
+        if how == 'eq_hist':
+            if breaks is None:
+                raise ValueError('eq_hist shading requires breaks')
+            self.mode = _EQ_HIST
+            self.how = 0
+            self.stops = np.linspace(0, 1, self.rgb.shape[1])
+            return
+
+        self.how = COLORMAP_HOWS.index(how)
+        if classify:
+            if breaks is None:
+                raise ValueError('quantile classes require breaks')
+            self.mode = _CLASSIFY
+            self.stops = self._stops(len(self.breaks) - 1)
+        else:
+            self.mode = _OFFSET
+            self.stops = None if span is None else self._stops(self.span[1] - self.span[0])
+
+    def _stops(self, extent):
+        # the colors are evenly spaced over the interpolated span
+        interpolated = _interpolations[self.how](np.array([0, extent], dtype=np.float64))
+        return np.linspace(interpolated[0], interpolated[1], self.rgb.shape[1])
+
+    def shade(self, agg, name=None):
+        """
+        Convert a 2D DataArray to an image.
+
+        Parameters
+        ----------
+        agg : xarray.DataArray
+            The aggregate.
+        name : str, optional
+            Name of the image.
+
+        Returns
+        -------
+        img : xarray.DataArray
+            A DataArray representing an image.
+        """
+        if not agg.ndim == 2:
+            raise ValueError("agg must be 2D")
+
+        data = agg.data
+        if isinstance(data, da.Array):
+            data = data.compute()
+
+        out = np.zeros(data.shape + (4,), dtype=np.uint8)
+        stops = self.stops
+        if self.span is not None:
+            lo, hi = self.span
+        elif self.mode == _OFFSET:
+            lo, hi = _valid_range(data)
+            stops = self._stops(hi - lo) if lo <= hi else None
+        else:
+            lo, hi = 0., 0.
+
+        if stops is not None:
+            _shade_continuous(data, self.how, self.mode, lo, hi, self.span is not None,
+                              self.clip, self.breaks, stops, self.rgb, self.alpha, out)
+
+        img = out.view(np.uint32).reshape(data.shape)
+        return tf.Image(img, coords=agg.coords, dims=agg.dims, name=name)
+
+
+@ngjit
+def _valid_range(data):
+    # range of the values that are neither zero nor nan
+    vmin = np.inf
+    vmax = -np.inf
+    for v in data.ravel():
+        if v != 0 and v == v:
+            vmin = min(vmin, np.float64(v))
+            vmax = max(vmax, np.float64(v))
+    return vmin, vmax
+
+
+@ngjit
+def _stop_index(x, stops):
+    # index of the last stop not above x, as numpy.interp searches it,
+    # guessed from the even spacing of the stops
+    n = stops.shape[0]
+    if stops[n - 1] == stops[0]:
+        return n - 1
+    j = int((x - stops[0]) / (stops[n - 1] - stops[0]) * (n - 1))
+    j = min(max(j, 0), n - 1)
+    while j < n - 1 and stops[j + 1] <= x:
+        j += 1
+    while j > 0 and stops[j] > x:
+        j -= 1
+    return j
+
+
+@ngjit
+def _interp(x, j, stops, fp):
+    # numpy.interp of a single value between the stops j and j + 1
+    if j >= stops.shape[0] - 1 or stops[j] == x:
+        return fp[j]
+    slope = (fp[j + 1] - fp[j]) / (stops[j + 1] - stops[j])
+    return slope * (x - stops[j]) + fp[j]
+
+
+@ngjit
+def _equalize(x, breaks):
+    # position of x in the CDF interpolated between equal-count breaks
+    n = breaks.shape[0]
+    if x <= breaks[0]:
+        return 0.
+    if x >= breaks[n - 1]:
+        return 1.
+    i = np.searchsorted(breaks, x, side='right') - 1
+    return (i + (x - breaks[i]) / (breaks[i + 1] - breaks[i])) / (n - 1)
+
+
+@ngjit
+def _classify(x, breaks):
+    # first class whose upper bound is not below x, the values above the
+    # sampled breaks are in the last class
+    i = np.searchsorted(breaks, x, side='left')
+    return np.float64(min(i, breaks.shape[0] - 1))
+
+
+@ngjit
+def _shade_continuous(data, how, mode, lo, hi, has_span, clip, breaks, stops, rgbs,
+                      alpha, out):
+    h, w = data.shape
+    n = stops.shape[0]
+    for i in range(h):
+        for j in range(w):
+            v = np.float64(data[i, j])
+            # zeros, nans and values out of the span are left transparent
+            if v == 0 or v != v:
+                continue
+            if has_span:
+                if clip:
+                    v = min(max(v, lo), hi)
+                elif v < lo or v > hi:
+                    continue
+
+            if mode == _EQ_HIST:
+                v = _equalize(v, breaks)
+            elif mode == _CLASSIFY:
+                v = _classify(v, breaks)
+            else:
+                v -= lo
+
+            if how == 1:
+                v = np.log1p(v)
+            elif how == 2:
+                v = v ** (1 / 3.)
+            if v != v:
+                continue
+
+            if v < stops[0]:
+                # left of the colormap
+                out[i, j, 0] = out[i, j, 1] = out[i, j, 2] = 255
+            else:
+                k = n - 1 if v > stops[n - 1] else _stop_index(v, stops)
+                out[i, j, 0] = np.uint8(_interp(v, k, stops, rgbs[0]))
+                out[i, j, 1] = np.uint8(_interp(v, k, stops, rgbs[1]))
+                out[i, j, 2] = np.uint8(_interp(v, k, stops, rgbs[2]))
+            out[i, j, 3] = alpha
+
+
+def _tile_range(source: MapSource, z):
+    # first and last tiles of a zoom level covering the extent of the source
+    extent = source.full_extent
+    if extent is None:
+        extent = (tile_def.x_range[0], tile_def.y_range[0],
+                  tile_def.x_range[1], tile_def.y_range[1])
+    xmin, ymin, xmax, ymax = extent
+    n = 2 ** z - 1
+    txmin, tymax = tile_def.meters_to_tile(xmin, ymin, z)
+    txmax, tymin = tile_def.meters_to_tile(xmax, ymax, z)
+    return (min(max(txmin, 0), n), min(max(tymin, 0), n),
+            min(max(txmax, 0), n), min(max(tymax, 0), n))
+
+
+def _sample_tiles(source: MapSource, z, max_tiles=BREAKS_SAMPLE_TILES):
+    # tiles of a zoom level spread evenly over the extent of the source
+    txmin, tymin, txmax, tymax = _tile_range(source, z)
+    side = int(np.sqrt(max_tiles))
+    txs = np.unique(np.linspace(txmin, txmax, side).astype(int))
+    tys = np.unique(np.linspace(tymin, tymax, side).astype(int))
+    return [(tx, ty) for ty in tys for tx in txs]
+
+
+def _sample_values(source: MapSource, z):
+    # aggregate values of sample tiles that are neither zero nor nan, whatever the span
+    values = []
+    for tx, ty in _sample_tiles(source, z):
+        agg = create_agg(source, x=tx, y=ty, z=z)
+        data = agg.data
+        if isinstance(data, da.Array):
+            data = data.compute()
+        data = np.asarray(data, dtype=np.float64).ravel()
+        values.append(data[np.isfinite(data) & (data != 0)])
+    return np.concatenate(values) if values else np.array([], dtype=np.float64)
+
+
+def _breaks_key(source: MapSource, z, classes):
+    # the breaks do not depend on the span, which the colormap lookup
+    # tables apply themselves, so styles with any span share them
+    return ('breaks', z, classes)
+
+
+def _value_breaks(source: MapSource, z, classes):
+    # quantiles of the values of the sample tiles, stored with the statistics
+    key = _breaks_key(source, z, classes)
+    if key not in source.statistics:
+        values = _sample_values(source, z)
+        breaks = None
+        if len(values):
+            breaks = tuple(np.quantile(values, np.linspace(0, 1, classes + 1)).tolist())
+        source.statistics[key] = breaks
+    return source.statistics[key]
+
+
+def value_breaks(source: MapSource, z, classes):
+    """
+    Get the global equal-count breaks of the aggregate values of a source
+    at a zoom level, sampled once from up to ``BREAKS_SAMPLE_TILES``
+    tiles covering its extent and stored with the source statistics.
+
+    The breaks of the first ``BREAKS_LOAD_LEVELS`` zoom levels are
+    sampled while loading the source, see ``load_breaks``, the others
+    on first use while holding the load lock of the source. Raster
+    sources sample the tiles of the levels with overviews from them.
+
+    Parameters
+    ----------
+    source : mapshader.sources.MapSource
+        The map source object.
+    z : int
+        The zoom level.
+    classes : int
+        Number of equal-count classes of the values.
+
+    Returns
+    -------
+    breaks : tuple of float or None
+        The ``classes + 1`` quantiles of the values, from their minimum
+        to their maximum, None if the sampled tiles hold no values.
+    """
+    key = _breaks_key(source, z, classes)
+    if key not in source.statistics:
+        with source._load_lock:
+            return _value_breaks(source, z, classes)
+    return source.statistics[key]
+
+
+def _breaks_classes(source: MapSource):
+    # number of classes of the breaks the LUT of a source needs, None if it
+    # has no LUT and 0 if its LUT has no breaks
+    cmap = source.cmap
+    how = source.shade_how
+    classify = list(source.extras) == ['quantile']
+    if ((source.extras and not classify)
+            or how not in COLORMAP_HOWS + ('eq_hist',) or (how == 'eq_hist' and classify)
+            or not isinstance(cmap, (list, tuple)) or not cmap
+            or not all(isinstance(c, (str, tuple)) for c in cmap)):
+        return None
+    elif classify:
+        return QUANTILE_CLASSES
+    elif how == 'eq_hist':
+        return EQ_HIST_BINS
+    return 0
+
+
+def load_breaks(source: MapSource, levels=BREAKS_LOAD_LEVELS):
+    """
+    Sample the global breaks of the first zoom levels of a source shaded
+    with ``eq_hist`` or the ``quantile`` extra, see ``value_breaks``.
+
+    Called by ``MapSource.load`` while holding the load lock, so the
+    first requests do not sample the breaks concurrently. The breaks
+    already in the statistics, e.g. read from the transform cache or
+    shared data, are not sampled again.
+
+    Parameters
+    ----------
+    source : mapshader.sources.MapSource
+        The loaded map source object.
+    levels : int
+        Number of zoom levels, from 0.
+
+    Returns
+    -------
+    sampled : int
+        Number of zoom levels sampled.
+    """
+    classes = _breaks_classes(source)
+    if not classes:
+        return 0
+
+    # breaks imported from a cache or shared data are not sampled again
+    missing = [z for z in range(levels)
+               if _breaks_key(source, z, classes) not in source.statistics]
+    start = time.perf_counter()
+    for z in missing:
+        _value_breaks(source, z, classes)
+    if missing:
+        print(f'Sampled the breaks of {len(missing)} levels of {source.name} in '
+              f'{time.perf_counter() - start:.2f}s', file=sys.stdout)
+    return len(missing)
+
+
+def _breaks_options(source: MapSource):
+    # options of the aggregates the breaks are sampled from, as stored in json
+    options = dict(geometry_type=source.geometry_type, agg_func=source.agg_func,
+                   xfield=source.xfield, yfield=source.yfield, zfield=source.zfield,
+                   geometry_field=source.geometry_field, band=source.band,
+                   raster_padding=source.raster_padding, sample_tiles=BREAKS_SAMPLE_TILES)
+    return json.loads(json.dumps(options, default=str))
+
+
+def export_breaks(source: MapSource):
+    """
+    Get the sampled breaks of a source, to store them along with its
+    cached or shared data, see ``import_breaks``.
+
+    Returns
+    -------
+    stored : dict
+        The breaks and the options they were sampled with, serializable
+        to json.
+    """
+    breaks = [[key[1], key[2], value] for key, value in source.statistics.items()
+              if isinstance(key, tuple) and key[0] == 'breaks']
+    return dict(options=_breaks_options(source), breaks=breaks)
+
+
+def import_breaks(source: MapSource, stored):
+    """
+    Add the breaks exported by ``export_breaks`` to the statistics of a
+    source, unless they were sampled with other options.
+
+    Parameters
+    ----------
+    source : mapshader.sources.MapSource
+        The map source object.
+    stored : dict or None
+        The exported breaks.
+
+    Returns
+    -------
+    imported : int
+        Number of imported breaks.
+    """
+    if not stored or stored.get('options') != _breaks_options(source):
+        return 0
+
+    for z, classes, breaks in stored['breaks']:
+        key = _breaks_key(source, z, classes)
+        source.statistics[key] = None if breaks is None else tuple(breaks)
+    return len(stored['breaks'])
+
+
+@memoized()
+def _cached_colormap_lut(cmap, how, span, clip, breaks=None, classify=False):
+    return ColormapLUT(cmap, how, span, clip, breaks=breaks, classify=classify)
+
+
+def _shade_span(source: MapSource):
+    # span of the colormap of a continuous source
+    span = source.span
+    if span == 'min/max':
+        vmin, vmax = source.value_range
+        if source.geometry_type == 'raster':
+            return int(vmin), int(vmax) + 1
+        return vmin, vmax
+    elif isinstance(span, (tuple, list)):
+        return tuple(span)
+    return None
 
-    a = np.where(np.logical_or(np.isnan(r), r <= nodata), 0, alpha)
-    img = np.dstack((r, g, b, a)).astype('uint8').view(dtype=np.uint32).reshape(a.shape)
-    return tf.Image(img, coords=agg.coords, dims=agg.dims, name=name)
 
+def colormap_lut(source: MapSource, z=None):
+    """
+    Get the ``ColormapLUT`` of a continuous source, built once per source
+    configuration and zoom level.
+
+    Parameters
+    ----------
+    source : mapshader.sources.MapSource
+        The map source object.
+    z : int, optional
+        The zoom level, required to equalize or classify the values with
+        ``shade_how='eq_hist'`` or the ``quantile`` extra.
+
+    Returns
+    -------
+    lut : ColormapLUT or None
+        The lookup table, None if the source is shaded by datashader, i.e.
+        for the ``hillshade`` extra, categorical, callable or single color
+        colormaps, and eq_hist or quantile shading without zoom level or
+        data.
+    """
+    classes = _breaks_classes(source)
+    if classes is None:
+        return None
+
+    breaks = None
+    classify = list(source.extras) == ['quantile']
+    if classes:
+        if z is None:
+            return None
+        breaks = value_breaks(source, z, classes)
+        if breaks is None:
+            return None
+        if classify:
+            # upper bounds of the classes, as xrspatial.classify.quantile
+            breaks = tuple(np.unique(breaks[1:]).tolist())
 
-def shade_agg(source: MapSource, agg: xr.DataArray, xmin, ymin, xmax, ymax):
+    return _cached_colormap_lut(tuple(source.cmap), source.shade_how, _shade_span(source),
+                                source.span == 'min/max', breaks, classify)
+
+
+def shade_agg(source: MapSource, agg: xr.DataArray, xmin, ymin, xmax, ymax, z=None,
+              lut=None):
     """
     Convert a DataArray to an image by choosing an RGBA pixel color
     for each value.
@@ -395,46 +1272,41 @@ def shade_agg(source: MapSource, agg: xr.DataArray, xmin, ymin, xmax, ymax):
         X-axis maximum range.
     ymax : float
         Y-axis maximum range.
+    z : int, optional
+        Zoom level of the global breaks of eq_hist and quantile shading,
+        defaults to the level of the extent.
+    lut : ColormapLUT, optional
+        The lookup table of the source at the zoom level, see
+        ``colormap_lut``, looked up when not given.
 
     Returns
     -------
     img : xarray.DataArray
         A DataArray representing an image.
     """
-    df = source.data
-    zfield = source.zfield
-    geometry_type = source.geometry_type
-    how = source.shade_how
     cmap = source.cmap
-    span = source.span
 
     if isinstance(cmap, dict):
-        agg.data = agg.data.astype(np.uint64)
-        return shade_discrete(agg, color_key=cmap)
+        return shade_discrete(agg, color_key=categorical_lut(cmap))
+
+    if z is None:
+        z = tile_def.get_level_by_extent((xmin, ymin, xmax, ymax), *agg.shape)
+
+    span = _shade_span(source)
+    if lut is None:
+        lut = colormap_lut(source, z)
+    if lut is not None:
+        img = lut.shade(agg)
+    elif span is not None:
+        img = tf.shade(agg, cmap=cmap, how=source.shade_how, span=span)
     else:
-        if span and span == 'min/max' and geometry_type == 'raster':
-
-            # TODO: make this work for dask
-
-            # TODO: don't need to calculate min each time...move into MapSource
-            print('Shade Raster with Span ({}, {})'.format(float(df.min().item()),
-                                                           float(df.max().item()) + 1))
-            img = tf.shade(agg, cmap=cmap,
-                           how=how, span=(int(df.min(skipna=True).item()),
-                                          int(df.max(skipna=True).item())+1))
-
-            # TODO: don't do this unless we need to...check source.padding
-            return img.loc[{'x': slice(xmin, xmax), 'y': slice(ymax, ymin)}]
-
-        elif span and span == 'min/max':
-            print('Shade with Span')
-            return tf.shade(agg, cmap=cmap, how=how, span=(np.nanmin(df[zfield]),
-                                                           np.nanmax(df[zfield])))
-        elif isinstance(span, (tuple, list)):
-            return tf.shade(agg, cmap=cmap, how=how, span=span)
-        else:
-            print('Shade without Span')
-            return tf.shade(agg, cmap=cmap, how=how)
+        img = tf.shade(agg, cmap=cmap, how=source.shade_how)
+
+    if source.span == 'min/max' and source.geometry_type == 'raster':
+        # TODO: don't do this unless we need to...check source.padding
+        return img.loc[{'x': slice(xmin, xmax), 'y': slice(ymax, ymin)}]
+
+    return img
 
 
 def to_raster(source: MapSource,
@@ -498,12 +1370,203 @@ def to_raster(source: MapSource,
     return create_agg(source, xmin, ymin, xmax, ymax, None, None, None, height, width)
 
 
+# Interpolations a request may shade with.
+SHADE_HOWS = COLORMAP_HOWS + ('eq_hist',)
+
+# Styled views of the sources, reused by requests with the same style.
+_styled_sources = LRUCache(128)
+
+
+class StyledSource:
+    """
+    View of a map source with other shading options, which forwards
+    every other attribute, e.g. its data, overviews and statistics, to
+    the source, so it follows the source when it is loaded again.
+
+    Parameters
+    ----------
+    source : mapshader.sources.MapSource
+        The map source object.
+    **style
+        The attributes overriding the ones of the source.
+    """
+    def __init__(self, source: MapSource, **style):
+        self.source = source
+        self.__dict__.update(style)
+
+    def __getattr__(self, name):
+        return getattr(self.source, name)
+
+
+class InvalidStyleError(ValueError):
+    """
+    Raised when the style parameters of a request are invalid.
+    """
+
+
+def parse_style(params):
+    """
+    Parse the style parameters of a request, which override the shading
+    options of a source.
+
+    Parameters
+    ----------
+    params : dict
+        The request query parameters, of which ``cmap`` is a palette name
+        of ``mapshader.colors.colors`` or comma separated colors,
+        ``span`` is ``min/max`` or comma separated minimum and maximum
+        values, and ``how`` is one of ``SHADE_HOWS``.
+
+    Returns
+    -------
+    style : dict
+        The ``cmap``, ``span`` and ``how`` given, as ``styled_source``
+        arguments.
+
+    Raises
+    ------
+    InvalidStyleError
+        If a parameter is invalid.
+    """
+    from mapshader.colors import colors
+
+    style = {}
+    cmap = params.get('cmap')
+    if cmap:
+        if cmap in colors:
+            style['cmap'] = tuple(colors[cmap])
+        else:
+            style['cmap'] = tuple(c.strip() for c in cmap.split(','))
+            for c in style['cmap']:
+                try:
+                    rgb(c)
+                except ValueError:
+                    raise InvalidStyleError(f'Invalid color {c}')
+
+    span = params.get('span')
+    if span:
+        if span == 'min/max':
+            style['span'] = span
+        else:
+            try:
+                vmin, vmax = (float(v) for v in span.split(','))
+            except ValueError:
+                raise InvalidStyleError(f'Invalid span {span}, must be min/max or two numbers')
+            style['span'] = (vmin, vmax)
+
+    how = params.get('how')
+    if how:
+        if how not in SHADE_HOWS:
+            raise InvalidStyleError(f'Invalid how {how}, must be one of {SHADE_HOWS}')
+        style['how'] = how
+
+    return style
+
+
+def styled_source(source: MapSource, cmap=None, span=None, how=None):
+    """
+    Get a view of a source with other shading options, see
+    ``StyledSource``.
+
+    Parameters
+    ----------
+    source : mapshader.sources.MapSource
+        The map source object.
+    cmap : tuple of colors, optional
+        The colormap, defaults to the one of the source.
+    span : tuple of float or str, optional
+        The span, defaults to the one of the source.
+    how : str, optional
+        The interpolation, defaults to the one of the source.
+
+    Returns
+    -------
+    source : StyledSource or mapshader.sources.MapSource
+        The styled source, the source itself without options.
+    """
+    if cmap is None and span is None and how is None:
+        return source
+
+    key = (id(source), cmap, span, how)
+    cached = _styled_sources.get(key)
+    # the view references the source, so its id is not reused while cached
+    if cached is not None and cached.source is source:
+        return cached
+
+    style = {}
+    if cmap is not None:
+        style['cmap'] = list(cmap)
+    if span is not None:
+        style['span'] = span
+        # the hillshade is masked by the span
+        style['hillshade_overviews'] = {}
+    if how is not None:
+        style['shade_how'] = how
+
+    styled = StyledSource(source, **style)
+    _styled_sources.put(key, styled)
+    return styled
+
+
+def cached_agg(source: MapSource, agg_cache: LRUCache,
+               xmin: float = None, ymin: float = None,
+               xmax: float = None, ymax: float = None,
+               x: float = None, y: float = None,
+               z: float = None,
+               height: int = 256, width: int = 256):
+    """
+    Compute the aggregate of a source with ``create_agg``, or get it from
+    a cache of the aggregates rendered before.
+
+    The aggregates are cached before shading, as computed, so requests
+    for the same tile with other styles only shade them again. Only
+    tiles of ``tile_def.tile_size`` pixels are cached, which bounds the
+    memory of an entry, other spaces are aggregated on every request.
+
+    Parameters
+    ----------
+    source : mapshader.sources.MapSource
+        The map source object.
+    agg_cache : mapshader.cache.LRUCache
+        The cache of aggregates.
+    xmin, ymin, xmax, ymax : float
+        The space bounds.
+    x, y, z : float
+        The coordinates of the tile, if the space is a tile.
+    height : int
+        Height of the output aggregate in pixels.
+    width : int
+        Width of the output aggregate in pixels.
+
+    Returns
+    -------
+    agg : xarray.DataArray
+        The aggregate.
+    """
+    size = tile_def.tile_size
+    generation = source.load_generation
+    if (x is None or y is None or z is None or not height == width == size
+            or generation is None):
+        return create_agg(source, xmin, ymin, xmax, ymax, x, y, z, height, width)
+
+    # the load generation identifies the loaded data without keeping it
+    # alive, entries of unloaded data are evicted as they go unused
+    key = (generation, source.agg_func, source.zfield, xmin, ymin, xmax, ymax, z,
+           height, width)
+    agg = agg_cache.get(key)
+    if agg is None:
+        agg = create_agg(source, xmin, ymin, xmax, ymax, x, y, z, height, width).compute()
+        agg_cache.put(key, agg)
+    return agg
+
+
 def render_map(source: MapSource,  # noqa: C901
                xmin: float = None, ymin: float = None,
                xmax: float = None, ymax: float = None,
                x: float = None, y: float = None,
                z: float = None,
-               height: int = None, width: int = None):
+               height: int = None, width: int = None,
+               style: dict = None, agg_cache: LRUCache = None):
     """
     Export a MapSource object to a map object.
 
@@ -525,7 +1588,16 @@ def render_map(source: MapSource,  # noqa: C901
         Height of the output aggregate in pixels.
     width : int
         Width of the output aggregate in pixels.
+    style : dict, optional
+        Shading options overriding the ones of the source, see
+        ``parse_style``.
+    agg_cache : mapshader.cache.LRUCache, optional
+        Cache of the aggregates, reused by renders of the same space
+        with other styles, see ``cached_agg``.
     """
+    if style:
+        source = styled_source(source, **style)
+
     if x is not None and y is not None and z is not None:
         xmin, ymin, xmax, ymax = tile_def.get_tile_meters(x, y, z)
 
@@ -556,21 +1628,41 @@ def render_map(source: MapSource,  # noqa: C901
         x_range, y_range = ((xmin, xmax), (ymin, ymax))
         width = height_implied_by_aspect_ratio(height, y_range, x_range)
 
+    if z is None:
+        level = tile_def.get_level_by_extent((xmin, ymin, xmax, ymax), height, width)
+    else:
+        level = z
+
+    # looked up once, the extras do not change the source
+    lut = colormap_lut(source, level)
+
     # handle out of bounds
     if xmax < sxmin or ymax < symin or xmin > symax or ymin > symax:
         agg = tf.Image(np.zeros(shape=(height, width), dtype=np.uint32),
                        coords={'x': np.linspace(xmin, xmax, width),
                                'y': np.linspace(ymin, ymax, height)},
                        dims=['x', 'y'])
-        img = shade_agg(source, agg, xmin, ymin, xmax, ymax)
+        img = shade_agg(source, agg, xmin, ymin, xmax, ymax, level, lut)
     else:
-        agg = create_agg(source, xmin, ymin, xmax, ymax, x, y, z, height, width)
+        if 'hillshade' in source.extras and source.geometry_type == 'raster':
+            # the hillshade is sliced from its pyramid or computed with a halo
+            agg = hillshade_agg(source, xmin, ymin, xmax, ymax, x, y, z, height, width)
+            source, agg = apply_additional_transforms(source, agg, skip=('hillshade',))
+        else:
+            if agg_cache is not None:
+                agg = cached_agg(source, agg_cache, xmin, ymin, xmax, ymax, x, y, z,
+                                 height, width)
+            else:
+                agg = create_agg(source, xmin, ymin, xmax, ymax, x, y, z, height, width)
+
+            # the colormap lookup tables mask the values themselves
+            if lut is None:
+                if source.span and isinstance(source.span, (list, tuple)):
+                    agg = agg.where((agg >= source.span[0]) & (agg <= source.span[1]))
 
-        if source.span and isinstance(source.span, (list, tuple)):
-            agg = agg.where((agg >= source.span[0]) & (agg <= source.span[1]))
+                source, agg = apply_additional_transforms(source, agg)
 
-        source, agg = apply_additional_transforms(source, agg)
-        img = shade_agg(source, agg, xmin, ymin, xmax, ymax)
+        img = shade_agg(source, agg, xmin, ymin, xmax, ymax, level, lut)
 
         # apply dynamic spreading ----------
         if source.dynspread and source.dynspread > 0:
@@ -579,6 +1671,94 @@ def render_map(source: MapSource,  # noqa: C901
     return img
 
 
+def _sample_data(data, size=64):
+    # a few rows or pixels of the data, of the same type and dtypes
+    if isinstance(data, xr.DataArray):
+        return data.isel({dim: slice(0, size) for dim in data.dims})
+    elif isinstance(data, dd.DataFrame):
+        return dd.from_pandas(data.head(size, npartitions=-1), npartitions=1)
+    return data.iloc[:size]
+
+
+def _warm_up_key(source):
+    # sources rendered by the same compiled functions
+    data = source.data
+    if isinstance(data, xr.DataArray):
+        dtypes = str(data.dtype)
+    else:
+        fields = [source.xfield, source.yfield, source.zfield, source.geometry_field]
+        dtypes = tuple(str(data[f].dtype) for f in fields if f in data.columns)
+    return (source.geometry_type, source.agg_func, source.shade_how,
+            type(data).__name__, dtypes)
+
+
+def warm_up(sources):
+    """
+    Render a tiny map of a sample of every distinct combination of
+    geometry type, aggregation, shading and data types of the loaded
+    sources, so the numba functions they use are compiled before the
+    first request rather than within it.
+
+    The compiled functions of mapshader itself are also cached on disk
+    by numba, so later processes load rather than compile them.
+
+    Parameters
+    ----------
+    sources : list of mapshader.sources.MapSource
+        The map sources. Sources not loaded yet and multi-file rasters
+        are skipped.
+
+    Returns
+    -------
+    stats : dict
+        The number of ``renderers`` warmed up, the total ``seconds`` it
+        took and the ``compile_seconds`` spent compiling.
+    """
+    compile_times = []
+    start = time.perf_counter()
+    warmed = set()
+    with event.install_timer('numba:compile', compile_times.append):
+        for source in sources:
+            lazy = isinstance(source.data, (MultiFileRaster, WindowedGeoTIFF))
+            if not source.is_loaded or lazy:
+                continue
+
+            key = _warm_up_key(source)
+            if key in warmed:
+                continue
+            warmed.add(key)
+
+            sample = copy.copy(source)
+            sample.data = _sample_data(source.data)
+            sample.overviews = {}
+            sample.statistics = {}
+            if hasattr(sample, 'partition_index'):
+                sample.partition_index = None
+            try:
+                render_map(sample, x=0, y=0, z=0, height=8, width=8).to_bytesio()
+            except Exception as e:
+                print(f'Failed warming up {source.name}: {e}', file=sys.stdout)
+
+    stats = dict(renderers=len(warmed), seconds=time.perf_counter() - start,
+                 compile_seconds=sum(compile_times))
+    print(f'Warmed up {stats["renderers"]} renderers in {stats["seconds"]:.2f}s, '
+          f'{stats["compile_seconds"]:.2f}s compiling', file=sys.stdout)
+    return stats
+
+
+def tile_key(z=0, x=0, y=0, tile_format='png'):
+    """
+    Get the relative path of a tile below an output location.
+    """
+    return os.path.join(str(z), str(x), '{}.{}'.format(y, tile_format.lower()))
+
+
+def _encode_image(img, tile_format):
+    buf = BytesIO()
+    img.save(buf, tile_format)
+    return buf.getvalue()
+
+
 def tile_to_disk(img, output_location, z=0, x=0, y=0, tile_format='png'):
     """
     Write a tile image to local disk
@@ -596,22 +1776,9 @@ def tile_to_disk(img, output_location, z=0, x=0, y=0, tile_format='png'):
     -------
         None
     """
-
-    tile_file_name = '{}.{}'.format(y, tile_format.lower())
-    tile_directory = os.path.join(output_location, str(z), str(x))
-    try:
-        os.makedirs(tile_directory)
-    except OSError as e:
-        import errno
-        if e.errno != errno.EEXIST:
-            raise
-    output_file = os.path.join(tile_directory, tile_file_name)
-
-    # save to local disk
-    print(f'Writing tile ({x, y, z}) to {output_file}')
-    img.save(output_file, tile_format)
-
-    return output_file
+    key = tile_key(z, x, y, tile_format)
+    print(f'Writing tile ({x, y, z}) to {os.path.join(output_location, key)}')
+    return _write_to_disk(_encode_image(img, tile_format), output_location, key)
 
 
 def tile_to_s3(img, output_location, z=0, x=0, y=0, tile_format='png'):
@@ -630,36 +1797,187 @@ def tile_to_s3(img, output_location, z=0, x=0, y=0, tile_format='png'):
     -------
 
     """
+    return _write_to_s3(_encode_image(img, tile_format), output_location,
+                        tile_key(z, x, y, tile_format))
+
+
+@ngjit
+def _has_opaque_pixel(data):
+    flat = data.ravel()
+    for i in range(flat.shape[0]):
+        # alpha is the most significant byte of a little-endian RGBA uint32
+        if flat[i] >> 24:
+            return True
+    return False
+
+
+def is_empty_tile(img):
+    """
+    Check whether every pixel of an RGBA image is fully transparent.
+
+    The check runs directly over the packed ``uint32`` buffer and stops
+    at the first pixel with a non-zero alpha, so it costs far less than
+    encoding the image.
+
+    Parameters
+    ----------
+    img : datashader.transfer_functions.Image or numpy.ndarray
+        The shaded image or its ``uint32`` buffer.
+
+    Returns
+    -------
+    empty : bool
+    """
+    data = getattr(img, 'data', img)
+    data = np.ascontiguousarray(data, dtype=np.uint32)
+    return data.size == 0 or not _has_opaque_pixel(data)
+
+
+def write_to_location(buf, output_location, key):
+    """
+    Write raw bytes under a local directory or an S3 prefix.
+
+    Parameters
+    ----------
+    buf : bytes
+        Content to write.
+    output_location : str
+        Local directory or ``s3://bucket/prefix`` location.
+    key : str
+        Relative path of the object below ``output_location``.
 
+    Returns
+    -------
+    location : str
+        Path or url of the written object.
+    """
+    if output_location.startswith('s3:'):
+        return _write_to_s3(buf, output_location, key)
+    return _write_to_disk(buf, output_location, key)
+
+
+def _write_to_s3(buf, output_location, key):
     try:
         import boto3
     except ImportError:
         raise ImportError('conda install boto3 to enable rendering to S3')
 
-    try:
-        from urlparse import urlparse
-    except ImportError:
-        from urllib.parse import urlparse
+    from urllib.parse import urlparse
 
     s3_info = urlparse(output_location)
     bucket = s3_info.netloc
-    s3_client = boto3.client('s3')
+    s3_key = os.path.join(s3_info.path, key).lstrip('/')
+    boto3.client('s3').put_object(Body=buf, Bucket=bucket, Key=s3_key, ACL='public-read')
+    return 'https://{}.s3.amazonaws.com/{}'.format(bucket, s3_key)
+
+
+def _write_to_disk(buf, output_location, key):
+    output_file = os.path.join(output_location, key)
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    with open(output_file, 'wb') as f:
+        f.write(buf)
+    return output_file
+
+
+def empty_tile_key(tile_format='png'):
+    """
+    Get the key of the shared blob used in place of empty tiles.
+    """
+    return 'empty.{}'.format(tile_format.lower())
+
+
+def write_empty_tile(output_location, tile_format='png', height=256, width=256):
+    """
+    Write the single fully transparent tile shared by every empty tile.
+
+    Parameters
+    ----------
+    output_location : str
+        Local directory or ``s3://bucket/prefix`` location.
+    tile_format : str, default=png
+        Image format of the tile.
+    height, width : int, default=256
+        Tile size in pixels.
+
+    Returns
+    -------
+    location : str
+        Path or url of the shared blob.
+    """
+    from PIL.Image import fromarray
+
+    img = fromarray(np.zeros((height, width, 4), dtype=np.uint8), 'RGBA')
+    buf = BytesIO()
+    img.save(buf, tile_format)
+    return write_to_location(buf.getvalue(), output_location, empty_tile_key(tile_format))
+
+
+def write_coverage_index(tiles, output_location, tile_format='png', empty_tiles='skip'):
+    """
+    Record which tiles of a seeding run have been written.
 
-    tile_file_name = '{}.{}'.format(y, tile_format.lower())
-    key = os.path.join(s3_info.path, str(z), str(x), tile_file_name).lstrip('/')
-    output_buf = BytesIO()
-    img.save(output_buf, tile_format)
-    output_buf.seek(0)
-    s3_client.put_object(Body=output_buf, Bucket=bucket, Key=key, ACL='public-read')
-    return 'https://{}.s3.amazonaws.com/{}'.format(bucket, key)
+    Parameters
+    ----------
+    tiles : pandas.DataFrame
+        Tiles with ``x``, ``y``, ``z`` and boolean ``written`` columns.
+    output_location : str
+        Local directory or ``s3://bucket/prefix`` location.
+    tile_format : str, default=png
+        Image format of the tiles.
+    empty_tiles : str, default=skip
+        How empty tiles were handled, see ``render_tile``.
 
+    Returns
+    -------
+    location : str
+        Path or url of the ``coverage.json`` index.
+    """
+    written = tiles[tiles['written']].sort_values(by=['z', 'x', 'y'])
+    coverage = dict(
+        format=tile_format.lower(),
+        empty_tile=empty_tile_key(tile_format) if empty_tiles == 'blob' else None,
+        total=int(len(tiles)),
+        tiles=written[['z', 'x', 'y']].astype(int).values.tolist(),
+    )
+    return write_to_location(json.dumps(coverage).encode('utf-8'),
+                             output_location, 'coverage.json')
+
+
+def render_tile(source, output_location, z=0, x=0, y=0, tile_format='png', empty_tiles='skip'):
+    """
+    Render a single tile and write it to disk or S3.
+
+    Parameters
+    ----------
+    source : mapshader.sources.MapSource
+        The input datasource.
+    output_location : str
+        Local directory or ``s3://bucket/prefix`` location.
+    x, y, z : int
+        The tile coordinates.
+    tile_format : str, default=png
+        Image format of the tile.
+    empty_tiles : str, default=skip
+        What to do with fully transparent tiles: ``skip`` them,
+        leave them to a single shared ``blob`` written once per run,
+        or ``write`` them like any other tile.
+
+    Returns
+    -------
+    location : str or None
+        Path or url of the written tile, or None if nothing was written.
+    """
+    if empty_tiles not in EMPTY_TILE_MODES:
+        raise ValueError(f'Invalid empty_tiles mode {empty_tiles}')
 
-def render_tile(source, output_location, z=0, x=0, y=0, tile_format='png'):
     agg = render_map(source, x=int(x), y=int(y), z=int(z), height=256, width=256)
 
     if 0 in agg.shape:
         return None
 
+    if empty_tiles != 'write' and is_empty_tile(agg):
+        return None
+
     try:
         from PIL.Image import fromarray
     except ImportError:
@@ -669,10 +1987,10 @@ def render_tile(source, output_location, z=0, x=0, y=0, tile_format='png'):
     img = fromarray(np.flip(agg.data, 0), 'RGBA')
 
     if output_location.startswith('s3:'):
-        tile_to_s3(img, output_location, z, x, y, tile_format)
+        return tile_to_s3(img, output_location, z, x, y, tile_format)
     else:
         # write to local disk
-        tile_to_disk(img, output_location, z, x, y, tile_format)
+        return tile_to_disk(img, output_location, z, x, y, tile_format)
 
 
 def get_source_data(source: MapSource, simplify=None):
@@ -1,27 +1,22 @@
 from functools import partial
+from io import BytesIO
 from os import path
-import sys
-
-from bokeh.models.sources import GeoJSONDataSource
-from bokeh.plotting import figure
-from bokeh.models.tiles import WMTSTileSource
-from bokeh.embed import components
-from bokeh.tile_providers import STAMEN_TONER_BACKGROUND
-from bokeh.tile_providers import get_provider
 
 from jinja2 import Environment, FileSystemLoader
 
-from bokeh.resources import INLINE
-
 try:
     from flask import Flask
     from flask import send_file
     from flask import request
+    from flask import jsonify
 except ImportError:
     raise ImportError('You must install flask `pip install flask` to use this module')
 from flask_cors import CORS
 
 from mapshader import hello
+from mapshader.cache import LRUCache
+from mapshader.core import InvalidStyleError
+from mapshader.core import parse_style
 from mapshader.core import render_map
 from mapshader.core import render_geojson
 from mapshader.core import render_legend
@@ -29,7 +24,9 @@ from mapshader.core import render_services
 
 from mapshader.services import get_services, MapService
 
-from mapshader.sources import MapSource
+from mapshader.sources import MapSource, SourceNotReadyError
+
+from mapshader.singleflight import SingleFlight
 
 from mapshader.utils import psutil_fetching
 
@@ -38,34 +35,76 @@ TEMPLATE_DIR = path.join(HERE, 'templates')
 jinja2_env = Environment(loader=FileSystemLoader(TEMPLATE_DIR))
 
 
-def flask_to_tile(source: MapSource, z=0, x=0, y=0):
-
+def ensure_loaded(source: MapSource, timeout=None):
+    """
+    Load a source on first use, waiting at most ``timeout`` seconds for
+    a load already in progress in another request.
+    """
     if not source.is_loaded:
-        print(f'Dynamically Loading Data {source.name}', file=sys.stdout)
-        source.load()
+        source.load(timeout=timeout)
 
-    img = render_map(source, x=int(x), y=int(y), z=int(z), height=256, width=256)
-    return send_file(img.to_bytesio(), mimetype='image/png')
+
+def source_readiness(sources):
+    """
+    Get the load state of each source.
+
+    Sources that have not been requested yet count as ready since they
+    load on demand, only queued, loading or failed sources make the
+    server not ready. Preloaded sources are queued until their load
+    starts, see ``mapshader.sources.load_sources``.
+
+    Returns
+    -------
+    ready : bool
+    states : dict
+        Load state and last load error by source key.
+    """
+    states = {}
+    for source in sources:
+        states[source.key] = dict(state=source.load_state, error=source.load_error)
+    ready = all(s['state'] in ('unloaded', 'loaded') for s in states.values())
+    return ready, states
+
+
+def render_tile_png(source: MapSource, z=0, x=0, y=0, style=None, agg_cache=None):
+    img = render_map(source, x=x, y=y, z=z, height=256, width=256,
+                     style=style, agg_cache=agg_cache)
+    return img.to_bytesio().getvalue()
+
+
+def flask_to_tile(source: MapSource, z=0, x=0, y=0, flight: SingleFlight = None,
+                  load_timeout=None, agg_cache: LRUCache = None):
+
+    ensure_loaded(source, load_timeout)
+
+    z, x, y = int(z), int(x), int(y)
+    style = parse_style(request.args)
+    if flight is None:
+        png = render_tile_png(source, z, x, y, style, agg_cache)
+    else:
+        # concurrent requests for the same tile share a single render
+        key = (source.key, z, x, y, tuple(sorted(style.items())))
+        png = flight.do(key, render_tile_png, source, z, x, y, style, agg_cache)
+    return send_file(BytesIO(png), mimetype='image/png')
 
 
 def flask_to_image(source: MapSource,
                    xmin=-20e6, ymin=-20e6,
                    xmax=20e6, ymax=20e6,
-                   height=500, width=500):
+                   height=500, width=500, load_timeout=None, agg_cache: LRUCache = None):
 
-    if not source.is_loaded:
-        source.load()
+    ensure_loaded(source, load_timeout)
 
     img = render_map(source, xmin=float(xmin), ymin=float(ymin),
                      xmax=float(xmax), ymax=float(ymax),
-                     height=int(height), width=int(width))
+                     height=int(height), width=int(width),
+                     style=parse_style(request.args), agg_cache=agg_cache)
     return send_file(img.to_bytesio(), mimetype='image/png')
 
 
-def flask_to_wms(source: MapSource):
+def flask_to_wms(source: MapSource, load_timeout=None, agg_cache: LRUCache = None):
 
-    if not source.is_loaded:
-        source.load()
+    ensure_loaded(source, load_timeout)
 
     height = request.args.get('height')
     width = request.args.get('width')
@@ -73,14 +112,14 @@ def flask_to_wms(source: MapSource):
     xmin, ymin, xmax, ymax = bbox.split(',')
     img = render_map(source, xmin=float(xmin), ymin=float(ymin),
                      xmax=float(xmax), ymax=float(ymax),
-                     height=int(height), width=int(width))
+                     height=int(height), width=int(width),
+                     style=parse_style(request.args), agg_cache=agg_cache)
     return send_file(img.to_bytesio(), mimetype='image/png')
 
 
-def flask_to_geojson(source: MapSource):
+def flask_to_geojson(source: MapSource, load_timeout=None):
 
-    if not source.is_loaded:
-        source.load()
+    ensure_loaded(source, load_timeout)
 
     resp = render_geojson(source)
     return resp
@@ -96,6 +135,26 @@ def flask_to_services(services: list):
     return resp
 
 
+def flask_to_stats(flight: SingleFlight, agg_cache: LRUCache = None):
+    stats = dict(coalescing=flight.stats())
+    if agg_cache is not None:
+        stats['agg_cache'] = agg_cache.stats()
+    return stats
+
+
+def flask_to_ready(sources: list):
+    ready, states = source_readiness(sources)
+    return jsonify(ready=ready, sources=states), 200 if ready else 503
+
+
+def flask_source_not_ready(error, retry_after=5):
+    return str(error), 503, {'Retry-After': str(retry_after)}
+
+
+def flask_invalid_style(error):
+    return str(error), 400
+
+
 def build_previewer(service: MapService):
     '''Helper function for creating a simple Bokeh figure with
     a WMTS Tile Source.
@@ -104,6 +163,13 @@ def build_previewer(service: MapService):
     - if you don't supply height / width, stretch_both sizing_mode is used.
     - supply an output_dir to write figure to disk.
     '''
+    # bokeh is only needed by the service pages, import it on their first
+    # request rather than when the server starts
+    from bokeh.models.sources import GeoJSONDataSource
+    from bokeh.plotting import figure
+    from bokeh.models.tiles import WMTSTileSource
+    from bokeh.tile_providers import STAMEN_TONER_BACKGROUND
+    from bokeh.tile_providers import get_provider
 
     xmin, ymin, xmax, ymax = service.default_extent
 
@@ -144,6 +210,9 @@ def build_previewer(service: MapService):
 
 
 def service_page(service: MapService):
+    from bokeh.embed import components
+    from bokeh.resources import INLINE
+
     plot = build_previewer(service)
     script, div = components(dict(preview=plot))
     template = jinja2_env.get_template("service_page.html")
@@ -164,21 +233,29 @@ def index_page(services):
     return template.render(services=services)
 
 
-def configure_app(app: Flask, user_source_filepath=None, contains=None, sources=None):
+def configure_app(app: Flask, user_source_filepath=None, contains=None, sources=None,
+                  load_timeout=None, retry_after=5, load_workers=None, background_load=False,
+                  shared_data_dir=None, warm_up=False, agg_cache_size=0):
 
     CORS(app)
 
+    tile_flight = SingleFlight()
+    agg_cache = LRUCache(agg_cache_size)
+
     view_func_creators = {
-        'tile': flask_to_tile,
-        'image': flask_to_image,
-        'wms': flask_to_wms,
-        'geojson': flask_to_geojson,
+        'tile': partial(flask_to_tile, flight=tile_flight, load_timeout=load_timeout,
+                        agg_cache=agg_cache),
+        'image': partial(flask_to_image, load_timeout=load_timeout, agg_cache=agg_cache),
+        'wms': partial(flask_to_wms, load_timeout=load_timeout, agg_cache=agg_cache),
+        'geojson': partial(flask_to_geojson, load_timeout=load_timeout),
         'legend': flask_to_legend,
     }
 
     services = []
     for service in get_services(
-            config_path=user_source_filepath, contains=contains, sources=sources):
+            config_path=user_source_filepath, contains=contains, sources=sources,
+            load_workers=load_workers, background_load=background_load,
+            shared_data_dir=shared_data_dir, warm_up=warm_up):
         services.append(service)
 
         view_func = view_func_creators[service.service_type]
@@ -200,15 +277,27 @@ def configure_app(app: Flask, user_source_filepath=None, contains=None, sources=
     app.add_url_rule('/', 'home', partial(index_page, services=services))
     app.add_url_rule('/services', 'services', partial(flask_to_services, services=services))
     app.add_url_rule('/psutil', 'psutil', psutil_fetching)
+    app.add_url_rule('/stats', 'stats',
+                     partial(flask_to_stats, flight=tile_flight, agg_cache=agg_cache))
+
+    map_sources = list({id(s.source): s.source for s in services}.values())
+    app.add_url_rule('/ready', 'ready', partial(flask_to_ready, sources=map_sources))
+    app.register_error_handler(SourceNotReadyError,
+                               partial(flask_source_not_ready, retry_after=retry_after))
+    app.register_error_handler(InvalidStyleError, flask_invalid_style)
 
     hello(services)
 
     return app
 
 
-def create_app(user_source_filepath=None, contains=None, sources=None):
+def create_app(user_source_filepath=None, contains=None, sources=None,
+               load_timeout=None, retry_after=5, load_workers=None, background_load=False,
+               shared_data_dir=None, warm_up=False, agg_cache_size=0):
     app = Flask(__name__)
-    return configure_app(app, user_source_filepath, contains, sources)
+    return configure_app(app, user_source_filepath, contains, sources,
+                         load_timeout, retry_after, load_workers, background_load,
+                         shared_data_dir, warm_up, agg_cache_size)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,286 @@
+from contextlib import contextmanager
+import math
+from threading import Lock
+
+from affine import Affine
+import numpy as np
+import rasterio
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window
+from rasterio.windows import from_bounds
+import xarray as xr
+
+from .mercator import MercatorTileDefinition
+
+
+tile_def = MercatorTileDefinition(x_range=(-20037508.34, 20037508.34),
+                                  y_range=(-20037508.34, 20037508.34))
+
+# Largest number of pixels read to compute the value range of a file.
+VALUE_RANGE_PIXELS = 1 << 20
+
+# Number of idle datasets, or warped views, of a file kept open between reads.
+DATASET_HANDLES = 16
+
+MERCATOR = CRS.from_epsg(3857)
+
+# Latitude limit of the web mercator tiles.
+MAX_LATITUDE = 85.0511287798
+
+
+def _close_dataset(dataset):
+    # a warped view is closed along with the dataset it warps
+    src = getattr(dataset, 'src_dataset', None)
+    dataset.close()
+    if src is not None:
+        src.close()
+
+
+class DatasetPool:
+    """
+    Bounded pool of open rasterio datasets shared between threads.
+
+    A rasterio dataset is not safe to read from several threads, so a
+    dataset is checked out of the pool by a single thread at a time and
+    returned once read. The least recently used idle datasets beyond
+    ``maxsize`` are closed, along with the dataset of a warped view.
+
+    Parameters
+    ----------
+    maxsize : int, default=DATASET_HANDLES
+        Maximum number of idle datasets kept open.
+    """
+    def __init__(self, maxsize=DATASET_HANDLES):
+        self.maxsize = maxsize
+        self._lock = Lock()
+        self._idle = []  # (key, dataset) pairs, most recently used last
+        self._closed = False
+
+    def __len__(self):
+        return len(self._idle)
+
+    @contextmanager
+    def dataset(self, key, opener):
+        """
+        Check out an idle dataset of ``key``, or one opened by calling
+        ``opener``, for the duration of the context.
+        """
+        dataset = None
+        with self._lock:
+            for i in range(len(self._idle) - 1, -1, -1):
+                if self._idle[i][0] == key:
+                    dataset = self._idle.pop(i)[1]
+                    break
+        if dataset is None:
+            dataset = opener()
+
+        try:
+            yield dataset
+        finally:
+            evicted = []
+            with self._lock:
+                if self._closed:
+                    evicted.append(dataset)
+                else:
+                    self._idle.append((key, dataset))
+                    while len(self._idle) > self.maxsize:
+                        evicted.append(self._idle.pop(0)[1])
+            for evicted_dataset in evicted:
+                _close_dataset(evicted_dataset)
+
+    def close(self):
+        """
+        Close the idle datasets, and the checked out ones once returned.
+        """
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for _, dataset in idle:
+            _close_dataset(dataset)
+
+
+class WindowedGeoTIFF:
+    """
+    Proxy for a single GeoTIFF file that reads the window of each canvas
+    rather than the whole file, like ``MultiFileRaster`` does for
+    multiple files.
+
+    A window is read from the coarsest internal overview level that is
+    still at least as fine as the canvas, so low zoom tiles of a large
+    cloud optimized GeoTIFF only read a few blocks of its overviews.
+    Windows that are still much finer than the canvas, as for files
+    without overviews, are decimated while read.
+
+    Files in another CRS than EPSG:3857 are warped while read instead,
+    through a ``rasterio.vrt.WarpedVRT`` of the overview level on the
+    web mercator grid at the resolution of the canvas. The warped views
+    are kept, so the tiles of a zoom level reuse their coordinate
+    transformer.
+
+    The open datasets and warped views are shared between threads
+    through a bounded ``DatasetPool``, closed by ``close``.
+
+    Parameters
+    ----------
+    file_path : str
+        Path to the GeoTIFF file, north up.
+    band : int, default=1
+        The band to read.
+    interpolate : str, default=linear
+        Resampling mode when warping, either nearest or linear.
+    """
+    def __init__(self, file_path, band=1, interpolate='linear'):
+        self._file_path = file_path
+        self._band = band
+        self._datasets = DatasetPool()
+        self._resampling = Resampling.bilinear if interpolate == 'linear' else Resampling.nearest
+
+        with rasterio.open(file_path) as src:
+            if src.crs is None:
+                raise ValueError(f'Windowed reads need a raster with a CRS: {file_path}')
+            if src.transform.b or src.transform.d or src.transform.e > 0:
+                raise ValueError(f'Windowed reads need a north up raster: {file_path}')
+
+            self._crs = src.crs
+            self._warp = src.crs != MERCATOR
+            self._res = src.transform.a
+            self._factors = src.overviews(band)
+            self._nodata = src.nodata
+            self._dtype = np.dtype(src.dtypes[band - 1])
+
+            if self._warp:
+                left, bottom, right, top = src.bounds
+                if src.crs.is_geographic:
+                    bottom, top = max(bottom, -MAX_LATITUDE), min(top, MAX_LATITUDE)
+                self._bounds = transform_bounds(src.crs, MERCATOR, left, bottom, right, top)
+            else:
+                self._bounds = tuple(src.bounds)
+
+    def _open(self, level):
+        # level -1 is the full resolution, others index the overview factors
+        kwargs = dict(overview_level=level) if level >= 0 else {}
+        return rasterio.open(self._file_path, **kwargs)
+
+    def _dataset(self, level):
+        # dataset of the level checked out of the pool
+        return self._datasets.dataset(level, lambda: self._open(level))
+
+    def _open_warped(self, level, res):
+        # view of the level on the web mercator grid at the resolution
+        x0, y0 = tile_def.x_origin_offset, tile_def.y_origin_offset
+        xmin, ymin, xmax, ymax = self._bounds
+        col0, col1 = math.floor((xmin + x0) / res), math.ceil((xmax + x0) / res)
+        row0, row1 = math.floor((y0 - ymax) / res), math.ceil((y0 - ymin) / res)
+
+        dtype = 'float64' if np.issubdtype(self._dtype, np.integer) else self._dtype.name
+        return WarpedVRT(self._open(level), crs=MERCATOR,
+                         transform=Affine(res, 0, col0 * res - x0, 0, -res, y0 - row0 * res),
+                         width=max(col1 - col0, 1), height=max(row1 - row0, 1),
+                         resampling=self._resampling, nodata=np.nan, dtype=dtype)
+
+    def _warped(self, level, res):
+        # warped view of the level checked out of the pool
+        return self._datasets.dataset((level, res), lambda: self._open_warped(level, res))
+
+    def _source_res(self, xmin, ymin, xmax, ymax, width, height):
+        # resolution of the canvas in the units of the file
+        left, bottom, right, top = transform_bounds(MERCATOR, self._crs, xmin, ymin, xmax, ymax)
+        return min((right - left) / width, (top - bottom) / height)
+
+    def _level(self, res):
+        # coarsest level that is not coarser than res
+        level = -1
+        for i, factor in enumerate(self._factors):
+            if factor * self._res <= res * (1 + 1e-9):
+                level = i
+        return level
+
+    def _read(self, src, window, step):
+        out_shape = (max(math.ceil(window.height / step), 1),
+                     max(math.ceil(window.width / step), 1))
+        values = src.read(self._band, window=window, out_shape=out_shape,
+                          resampling=Resampling.nearest)
+
+        if np.issubdtype(values.dtype, np.integer):
+            values = values.astype('f8')
+        if self._nodata is not None:
+            values[values == self._nodata] = np.nan
+
+        scale = Affine.scale(window.width / out_shape[1], window.height / out_shape[0])
+        transform = src.window_transform(window) * scale
+        return values, transform
+
+    def full_extent(self):
+        return self._bounds
+
+    def read_bounds(self, xmin, ymin, xmax, ymax, width, height):
+        """
+        Read the data covering the bounds at about the resolution of a
+        canvas of ``width`` by ``height`` pixels.
+
+        Parameters
+        ----------
+        xmin, ymin, xmax, ymax : float
+            The bounds of the canvas.
+        width, height : int
+            The size of the canvas in pixels.
+
+        Returns
+        -------
+        arr : xarray.DataArray
+            The data of the window plus a pixel on each side, with nodata
+            values as nans. Empty if the bounds are outside of the data.
+        """
+        res = min((xmax - xmin) / width, (ymax - ymin) / height)
+        if self._warp:
+            level = self._level(self._source_res(xmin, ymin, xmax, ymax, width, height))
+            # the canvases of a zoom level share a warped view despite
+            # rounding errors of their bounds
+            with self._warped(level, round(res, 6)) as src:
+                return self._read_bounds(src, xmin, ymin, xmax, ymax, res)
+
+        with self._dataset(self._level(res)) as src:
+            return self._read_bounds(src, xmin, ymin, xmax, ymax, res)
+
+    def _read_bounds(self, src, xmin, ymin, xmax, ymax, res):
+        window = from_bounds(xmin, ymin, xmax, ymax, src.transform)
+        # whole pixels and a pixel more on each side to interpolate
+        col0 = max(math.floor(window.col_off) - 1, 0)
+        row0 = max(math.floor(window.row_off) - 1, 0)
+        col1 = min(math.ceil(window.col_off + window.width) + 1, src.width)
+        row1 = min(math.ceil(window.row_off + window.height) + 1, src.height)
+        if col0 >= col1 or row0 >= row1:
+            return xr.DataArray()
+
+        # datashader needs two pixels to compute the resolution
+        col0, row0 = max(min(col0, col1 - 2), 0), max(min(row0, row1 - 2), 0)
+        window = Window(col0, row0, col1 - col0, row1 - row0)
+        step = int(res / src.transform.a)
+        step = max(min(step, window.width // 2, window.height // 2), 1)
+
+        values, transform = self._read(src, window, step)
+        ny, nx = values.shape
+        x = transform.c + transform.a * (np.arange(nx) + 0.5)
+        y = transform.f + transform.e * (np.arange(ny) + 0.5)
+        return xr.DataArray(values, coords=dict(y=y, x=x), dims=('y', 'x'),
+                            name=self._file_path)
+
+    def value_range(self):
+        """
+        Minimum and maximum of the data values, ignoring nans, read from
+        the coarsest overview level so possibly narrower than the range
+        of the full resolution data.
+        """
+        with self._dataset(len(self._factors) - 1) as src:
+            step = max(math.ceil(math.sqrt(src.width * src.height / VALUE_RANGE_PIXELS)), 1)
+            values, _ = self._read(src, Window(0, 0, src.width, src.height), step)
+        return float(np.nanmin(values)), float(np.nanmax(values))
+
+    def close(self):
+        """
+        Close the datasets of the file kept open.
+        """
+        self._datasets.close()
@@ -0,0 +1,82 @@
+import shutil
+import sys
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:
+    raise ImportError('You must install gunicorn `pip install gunicorn` to use this module')
+
+from mapshader.flask_app import create_app
+from mapshader.shared_data import default_shared_data_dir
+from mapshader.shared_data import preload_shared_data
+
+
+class MapshaderApplication(BaseApplication):
+    """
+    Pre-forking gunicorn server of the mapshader Flask app.
+
+    The sources are loaded once and published to a shared data directory
+    before the workers are forked, see
+    ``mapshader.shared_data.preload_shared_data``. Every worker then
+    attaches to the published data, so the memory of the host scales with
+    the data rather than with the data times the workers, and warms up
+    its renderers before accepting requests unless ``warm_up=False`` is
+    given. Gunicorn restarts the workers that die, which attach to the
+    same data.
+
+    Parameters
+    ----------
+    user_source_filepath : str
+        Relative path to the config file.
+    contains : str
+        Skip the service type creation that contains this route.
+    sources : list of dict
+        The map source objects.
+    shared_data_dir : str, optional
+        Directory to publish the source data to, defaults to a temporary
+        directory under ``/dev/shm`` which is removed on exit.
+    options : dict, optional
+        Gunicorn settings, e.g. ``bind``, ``workers`` and ``threads``.
+    **app_kwargs
+        Other arguments of ``mapshader.flask_app.create_app``.
+    """
+
+    def __init__(self, user_source_filepath=None, contains=None, sources=None,
+                 shared_data_dir=None, options=None, **app_kwargs):
+        self.user_source_filepath = user_source_filepath
+        self.contains = contains
+        self.sources = sources
+        self.remove_shared_data_dir = shared_data_dir is None
+        self.shared_data_dir = shared_data_dir or default_shared_data_dir()
+        self.app_kwargs = dict(app_kwargs)
+        self.app_kwargs.setdefault('warm_up', True)
+        self.options = dict(options or {})
+        if self.options.get('threads', 1) > 1:
+            self.options.setdefault('worker_class', 'gthread')
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            if key in self.cfg.settings and value is not None:
+                self.cfg.set(key, value)
+
+        # the workers attach to the data published by the master rather
+        # than inheriting it, as forking after numba started its threading
+        # layer hangs the workers on exit
+        self.cfg.set('preload_app', False)
+        self.cfg.set('on_starting', self._on_starting)
+        self.cfg.set('on_exit', self._on_exit)
+
+    def _on_starting(self, server):
+        print(f'Preloading sources to {self.shared_data_dir}', file=sys.stdout)
+        preload_shared_data(self.shared_data_dir, self.user_source_filepath, self.contains,
+                            self.sources, self.app_kwargs.get('load_workers'))
+
+    def _on_exit(self, server):
+        if self.remove_shared_data_dir:
+            shutil.rmtree(self.shared_data_dir, ignore_errors=True)
+
+    def load(self):
+        return create_app(self.user_source_filepath, contains=self.contains,
+                          sources=self.sources, shared_data_dir=self.shared_data_dir,
+                          **self.app_kwargs)
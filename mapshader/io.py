@@ -1,18 +1,29 @@
-from os.path import expanduser, splitext
+from os.path import basename, expanduser, splitext
 
 import numpy as np
 import xarray as xr
 import geopandas as gpd
 import dask_geopandas
 import dask
+from dask.utils import natural_sort_key
+import fsspec
+from fsspec.implementations.local import LocalFileSystem
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 
+from mapshader.geotiff import WindowedGeoTIFF
 from mapshader.multifile import SharedMultiFile
+from mapshader.spatial_sort import read_sidecar_index
+
+# Extensions of Arrow IPC (Feather v2) files.
+ARROW_EXTENSIONS = ('.arrow', '.feather', '.ipc')
 
 
 def load_raster(file_path, transforms, force_recreate_overviews,
                 storage_options, geometry, region_of_interest,
                 xmin=None, ymin=None, xmax=None, ymax=None, chunks=None,
-                layername='data'):
+                layername='data', windowed=False, band=None, interpolate='linear'):
     """
     Load raster data.
 
@@ -30,10 +41,18 @@ def load_raster(file_path, transforms, force_recreate_overviews,
         Y-axis maximum range.
     layername : str, default=data
         Data layer name.
+    windowed : bool, default=False
+        Read a GeoTIFF file window by window rather than loading it,
+        see ``mapshader.geotiff.WindowedGeoTIFF``.
+    band : int, optional
+        The band of a windowed GeoTIFF file, the first one by default.
+    interpolate : str, default=linear
+        Resampling mode when warping a windowed GeoTIFF file in another
+        CRS than EPSG:3857, either nearest or linear.
 
     Returns
     -------
-    arr : xarray.DataArray
+    arr : xarray.DataArray or mapshader.geotiff.WindowedGeoTIFF
         The loaded data.
     """
 
@@ -48,7 +67,10 @@ def load_raster(file_path, transforms, force_recreate_overviews,
             arr = SharedMultiFile.get(file_path, transforms, force_recreate_overviews)
 
     else:
-        if file_extension == '.tif':
+        if file_extension == '.tif' and windowed:
+            arr = WindowedGeoTIFF(expanduser(file_path), band or 1, interpolate)
+
+        elif file_extension == '.tif':
             arr = xr.open_rasterio(expanduser(file_path), chunks={'y': 512, 'x': 512})
 
             if hasattr(arr, 'nodatavals'):
@@ -78,14 +100,34 @@ def load_vector(
     storage_options,
     geometry,
     region_of_interest,
+    columns=None,
+    xfield='x',
+    yfield='y',
 ):
     """
     Load vector data.
 
+    The column selection and region of interest are pushed down to the
+    reader, so parquet files only read the selected columns and the row
+    groups whose statistics overlap the region, and other formats only
+    read the selected fields of the features intersecting the region.
+    Arrow IPC files (``.arrow``, ``.feather`` or ``.ipc``) are
+    memory-mapped, see ``read_arrow``.
+
     Parameters
     ----------
     filepath : str
         Relative path to the file.
+    columns : list of str, optional
+        Columns to read, in this order. Columns missing from the file are
+        ignored and the geometry is always read. Reads every column by
+        default.
+    xfield : str, default=x
+        The x field name used to limit the data to the region of interest.
+    yfield : str, default=y
+        The y field name used to limit the data to the region of interest.
+        If the file does not have both fields, the data is limited by the
+        bounding box of its geometry instead.
 
     Returns
     -------
@@ -99,17 +141,219 @@ def load_vector(
         kwargs = {'storage_options': storage_options} if storage_options is not None else {}
         if geometry is not None:
             # read data into a dask_geopandas dataframe
-            df = dask_geopandas.read_parquet(filepath, **kwargs)
+            read_parquet = dask_geopandas.read_parquet
         else:
             # read data into a dask dataframe
-            df = dask.dataframe.read_parquet(filepath, **kwargs)
+            read_parquet = dask.dataframe.read_parquet
+
+        # only the metadata is read until the data is computed
+        df = read_parquet(filepath, **kwargs)
+        file_columns = list(df.columns)
+        point_fields = xfield in file_columns and yfield in file_columns
+
+        # indexed data is read as one partition per row group, so the
+        # partitions can be selected by their bounds
+        index = None
+        if point_fields or geometry in file_columns:
+            index = parquet_partition_index(filepath, xfield, yfield, storage_options)
+        if index is not None:
+            filepath = list(index['file'].unique())
+            kwargs['split_row_groups'] = True
+
+        filter_points = region_of_interest is not None and point_fields
+
+        if columns is not None:
+            keep = set(columns) | {geometry}
+            if filter_points:
+                keep |= {xfield, yfield}
+            kwargs['columns'] = [c for c in file_columns if c in keep]
+
+        if filter_points and index is None:
+            # skip the row groups outside of the region of interest
+            minx, miny, maxx, maxy = region_of_interest
+            kwargs['filters'] = [(xfield, '>=', minx), (xfield, '<=', maxx),
+                                 (yfield, '>=', miny), (yfield, '<=', maxy)]
+
+        if kwargs.keys() - {'storage_options'}:
+            df = read_parquet(filepath, **kwargs)
+
+        if region_of_interest is not None and index is not None:
+            # keep at least one partition for the exact filter to empty
+            partitions = select_partitions(index, *region_of_interest)
+            df = df.partitions[list(partitions) or [0]]
+    elif file_extension in ARROW_EXTENSIONS:
+        df = read_arrow(filepath, columns, geometry, storage_options)
+        point_fields = xfield in df.columns and yfield in df.columns
     else:
         # assume a geopandas DataFrame
-        df = gpd.read_file(filepath)
+        kwargs = {}
+        if columns is not None:
+            kwargs['include_fields'] = list(columns)
+        if region_of_interest is not None:
+            kwargs['bbox'] = tuple(region_of_interest)
+
+        df = gpd.read_file(filepath, **kwargs)
+        point_fields = xfield in df.columns and yfield in df.columns
 
     if region_of_interest is not None:
         # limit data to be within the region of interest
         minx, miny, maxx, maxy = region_of_interest
-        df = df[(df.x >= minx) & (df.x <= maxx) & (df.y >= miny) & (df.y <= maxy)]
+        if point_fields:
+            df = df[(df[xfield] >= minx) & (df[xfield] <= maxx) &
+                    (df[yfield] >= miny) & (df[yfield] <= maxy)]
+        elif geometry in df.columns:
+            df = df.cx[minx:maxx, miny:maxy]
 
     return df
+
+
+def read_arrow(filepath, columns=None, geometry=None, storage_options=None):
+    """
+    Read an Arrow IPC (Feather v2) file.
+
+    Local files are memory-mapped, and the numeric columns without nulls
+    of files written uncompressed as a single record batch, e.g. with
+    ``pyarrow.feather.write_feather(df, path, compression='uncompressed',
+    chunksize=len(df))``, are exposed to pandas without copying. Several
+    processes reading the same file then share the pages of the operating
+    system's file cache rather than holding a copy each. Other columns,
+    compressed files and remote files are copied into memory.
+
+    Parameters
+    ----------
+    filepath : str
+        Path to the file.
+    columns : list of str, optional
+        Columns to read. Columns missing from the file are ignored and
+        the geometry is always read. Reads every column by default.
+    geometry : str, optional
+        The geometry field name. Files written by ``GeoDataFrame.to_feather``
+        are read into a geopandas GeoDataFrame, decoding the geometry.
+    storage_options : dict, optional
+        Options of the ``fsspec`` filesystem of ``filepath``.
+
+    Returns
+    -------
+    df : pandas.DataFrame or geopandas.GeoDataFrame
+        The loaded data, with read-only numeric columns when memory-mapped.
+    """
+    fs, path = fsspec.core.url_to_fs(expanduser(filepath), **(storage_options or {}))
+    if isinstance(fs, LocalFileSystem):
+        source = pa.memory_map(path, 'r')
+    else:
+        with fs.open(path, 'rb') as f:
+            source = pa.py_buffer(f.read())
+
+    reader = pa.ipc.open_file(source)
+    file_columns = reader.schema.names
+    if columns is not None:
+        # in the order asked for, so the frame needs no copying reindex
+        keep = list(dict.fromkeys(list(columns) + [geometry]))
+        file_columns = [c for c in keep if c in file_columns]
+
+    if geometry is not None and b'geo' in (reader.schema.metadata or {}):
+        with fs.open(path, 'rb') as f:
+            return gpd.read_feather(f, columns=file_columns)
+
+    # a block per column lets pandas wrap the Arrow buffers
+    table = reader.read_all().select(file_columns)
+    return table.to_pandas(split_blocks=True)
+
+
+def _row_group_bounds(row_group, xfield, yfield):
+    bounds = {}
+    for i in range(row_group.num_columns):
+        column = row_group.column(i)
+        if column.path_in_schema in (xfield, yfield):
+            stats = column.statistics
+            if stats is None or not stats.has_min_max:
+                return None
+            bounds[column.path_in_schema] = (stats.min, stats.max)
+
+    if len(bounds) < 2:
+        return None
+
+    (xmin, xmax), (ymin, ymax) = bounds[xfield], bounds[yfield]
+    return xmin, ymin, xmax, ymax
+
+
+def parquet_partition_index(filepath, xfield, yfield, storage_options=None):
+    """
+    Collect the x/y bounds of every row group of a parquet dataset from
+    the sidecar index of each file or the statistics in the file footers,
+    without reading the data.
+
+    Parameters
+    ----------
+    filepath : str
+        Path to a parquet file or a directory of parquet files.
+    xfield : str
+        The x field name.
+    yfield : str
+        The y field name.
+    storage_options : dict, optional
+        Options of the ``fsspec`` filesystem of ``filepath``.
+
+    Returns
+    -------
+    index : pandas.DataFrame or None
+        One row per row group with ``file``, ``row_group``, ``xmin``,
+        ``ymin``, ``xmax`` and ``ymax`` columns, ordered like the
+        partitions of ``dask.dataframe.read_parquet`` called with the
+        list of files and ``split_row_groups=True``. None if a row group
+        has neither a sidecar index nor x/y statistics.
+    """
+    fs, path = fsspec.core.url_to_fs(filepath, **(storage_options or {}))
+    if fs.isdir(path):
+        files = [f for f in fs.find(path)
+                 if f.endswith('.parquet') and not basename(f).startswith(('_', '.'))]
+        files = sorted(files, key=natural_sort_key)
+    else:
+        files = [path]
+
+    rows = []
+    for f in files:
+        with fs.open(f) as fh:
+            metadata = pq.ParquetFile(fh).metadata
+
+        # prefer the sidecar index written by ``mapshader spatial_sort``,
+        # which also covers the bounds of non-point geometries
+        sidecar = read_sidecar_index(fs, f)
+        if sidecar is not None and len(sidecar) != metadata.num_row_groups:
+            sidecar = None
+
+        name = fs.unstrip_protocol(f) if '://' in filepath else f
+        for i in range(metadata.num_row_groups):
+            if sidecar is not None:
+                bounds = tuple(sidecar[i])
+            else:
+                bounds = _row_group_bounds(metadata.row_group(i), xfield, yfield)
+            if bounds is None:
+                return None
+            rows.append((name, i) + bounds)
+
+    if not rows:
+        return None
+
+    return pd.DataFrame(rows, columns=['file', 'row_group', 'xmin', 'ymin', 'xmax', 'ymax'])
+
+
+def select_partitions(index, xmin, ymin, xmax, ymax):
+    """
+    Get the positions of the partitions whose bounds intersect an extent.
+
+    Parameters
+    ----------
+    index : pandas.DataFrame
+        The partition index, see ``parquet_partition_index``.
+    xmin, ymin, xmax, ymax : float
+        The extent.
+
+    Returns
+    -------
+    partitions : numpy.ndarray
+        The positions of the intersecting partitions.
+    """
+    intersects = ((index['xmax'] >= xmin) & (index['xmin'] <= xmax) &
+                  (index['ymax'] >= ymin) & (index['ymin'] <= ymax))
+    return np.flatnonzero(intersects.to_numpy())
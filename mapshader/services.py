@@ -2,6 +2,7 @@ import sys
 import yaml
 from mapshader.sources import (
     MapSource,
+    load_sources,
     elevation_source,
     elevation_source_netcdf,
     nybb_source,
@@ -229,11 +230,16 @@ class GeoJSONService(MapService):
         return 'geojson'
 
 
-def parse_sources(source_objs, config_path=None, contains=None):
+def parse_sources(source_objs, config_path=None, contains=None,
+                  load_workers=None, background_load=False, shared_data_dir=None,
+                  warm_up=False):
     """
     Parse ``mapshader.sources.MapSource`` and instantiate a
     ``mapshader.sources.MapService``.
 
+    Sources that need to be loaded at startup are loaded concurrently
+    once every source has been created.
+
     Parameters
     ----------
     source_objs : list of ``mapshader.sources.MapSource``
@@ -242,6 +248,19 @@ def parse_sources(source_objs, config_path=None, contains=None):
         Relative path to the config file.
     contains : str
         Skip the service type creation that contains this route.
+    load_workers : int, optional
+        Maximum number of sources loading at once.
+    background_load : bool, default=False
+        Yield the services without waiting for the sources to load.
+    shared_data_dir : str, optional
+        Directory to share the data of the preloaded sources with other
+        processes through, see ``mapshader.shared_data``. Sources whose
+        data was published there are attached to it instead of loading,
+        and the data of the other sources is published once loaded.
+    warm_up : bool, default=False
+        Compile the renderers of the preloaded sources once they are
+        loaded, see ``mapshader.core.warm_up``. Skipped when loading in
+        the background.
     """
     service_classes = {
         'tile': TileService,
@@ -250,9 +269,13 @@ def parse_sources(source_objs, config_path=None, contains=None):
         'geojson': GeoJSONService,
     }
 
+    services = []
+    preload_sources = []
     for source in source_objs:
         # create sources
-        source_obj = MapSource.from_obj(source)
+        source_obj = MapSource.from_obj(source, autoload=False)
+        if source_obj.needs_preload:
+            preload_sources.append(source_obj)
 
         for service_type in source['service_types']:
             source['config_path'] = config_path
@@ -264,10 +287,30 @@ def parse_sources(source_objs, config_path=None, contains=None):
             ServiceKlass = service_classes[service_type]
 
             # TODO: add renderers here...
-            yield ServiceKlass(source=source_obj)
+            services.append(ServiceKlass(source=source_obj))
+
+    if shared_data_dir:
+        # imported here as importing the services should not import the
+        # rendering or shared data stacks
+        from mapshader.shared_data import attach_sources, publish_sources
+        attach_sources(preload_sources, shared_data_dir)
+
+    load_sources(preload_sources, max_workers=load_workers, background=background_load)
+
+    if shared_data_dir and not background_load:
+        publish_sources(preload_sources, shared_data_dir)
+
+    if warm_up and not background_load:
+        from mapshader.core import warm_up as warm_up_renderers
+        warm_up_renderers(preload_sources)
+
+    for service in services:
+        yield service
 
 
-def get_services(config_path=None, include_default=True, contains=None, sources=None):
+def get_services(config_path=None, include_default=True, contains=None, sources=None,
+                 load_workers=None, background_load=False, shared_data_dir=None,
+                 warm_up=False):
     """
     Get the map services.
 
@@ -281,6 +324,15 @@ def get_services(config_path=None, include_default=True, contains=None, sources=
         Skip the service type creation that contains this route.
     sources : list of ``mapshader.sources.MapSource``
         The map source objects.
+    load_workers : int, optional
+        Maximum number of sources loading at once at startup.
+    background_load : bool, default=False
+        Start serving without waiting for the startup loads to finish.
+    shared_data_dir : str, optional
+        Directory to share the data of the preloaded sources with other
+        processes through.
+    warm_up : bool, default=False
+        Compile the renderers of the preloaded sources once loaded.
     """
 
     source_objs = None
@@ -309,5 +361,7 @@ def get_services(config_path=None, include_default=True, contains=None, sources=
                             nybb_source(),
                             elevation_source()]
 
-    for service in parse_sources(source_objs, config_path=config_path, contains=contains):
+    for service in parse_sources(source_objs, config_path=config_path, contains=contains,
+                                 load_workers=load_workers, background_load=background_load,
+                                 shared_data_dir=shared_data_dir, warm_up=warm_up):
         yield service
@@ -0,0 +1,353 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import uuid
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pyarrow as pa
+import pyarrow.feather as feather
+import spatialpandas
+import xarray as xr
+
+from mapshader.core import export_breaks
+from mapshader.core import import_breaks
+from mapshader.io import read_arrow
+from mapshader.transform_cache import entry_name
+from mapshader.transform_cache import prune_entries
+
+
+# Bump when the layout of published entries changes.
+SHARED_DATA_VERSION = 2
+
+MANIFEST_FILENAME = 'manifest.json'
+
+
+def default_shared_data_dir():
+    """
+    Create a directory to publish source data to, in the shared memory
+    filesystem ``/dev/shm`` where available.
+    """
+    shm_dir = '/dev/shm'
+    return tempfile.mkdtemp(prefix='mapshader-',
+                            dir=shm_dir if os.path.isdir(shm_dir) else None)
+
+
+def source_fingerprint(source):
+    """
+    Hash the options a source loads and transforms its data with, so a
+    process only attaches data published for an identical source.
+
+    Parameters
+    ----------
+    source : mapshader.sources.MapSource
+        The map source.
+
+    Returns
+    -------
+    fingerprint : str
+        Hex digest of the source options.
+    """
+    inputs = dict(
+        version=SHARED_DATA_VERSION,
+        key=source.key,
+        filepath=source.filepath,
+        config_path=source.config_path,
+        transforms=source.transforms,
+        fields=source.fields,
+        geometry_field=source.geometry_field,
+        region_of_interest=source.region_of_interest,
+        load_kwargs=source._load_kwargs(),
+    )
+    if source.filepath:
+        data_path = source._data_path()
+        if os.path.isfile(data_path):
+            stat = os.stat(data_path)
+            inputs.update(mtime=stat.st_mtime_ns, size=stat.st_size)
+
+    canonical = json.dumps(inputs, sort_keys=True, default=str)
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
+def _data_kind(data):
+    if isinstance(data, (gpd.GeoDataFrame, spatialpandas.GeoDataFrame)):
+        # geometry arrays are not backed by flat buffers
+        return None
+    elif isinstance(data, pd.DataFrame):
+        return 'pandas'
+    elif isinstance(data, xr.DataArray) and isinstance(data.data, np.ndarray):
+        return 'xarray'
+    return None
+
+
+def _write_data(data, kind, entry_dir, name):
+    # returns the manifest item of the written data
+    if kind == 'pandas':
+        filename = f'{name}.arrow'
+        table = pa.Table.from_pandas(data, preserve_index=False)
+        # a single uncompressed record batch is mapped without copies
+        feather.write_feather(table, os.path.join(entry_dir, filename),
+                              compression='uncompressed', chunksize=max(len(data), 1))
+        return dict(file=filename, attrs=dict(data.attrs))
+
+    filename = f'{name}.npy'
+    np.save(os.path.join(entry_dir, filename), data.values)
+
+    coords_filename = f'{name}_coords.nc'
+    coords = data.coords.to_dataset()
+    coords.attrs = dict(data.attrs)
+    coords.to_netcdf(os.path.join(entry_dir, coords_filename))
+    return dict(file=filename, coords=coords_filename, dims=list(data.dims), name=data.name)
+
+
+def _attach_data(kind, entry_dir, item):
+    if kind == 'pandas':
+        data = read_arrow(os.path.join(entry_dir, item['file']))
+        data.attrs.update(item['attrs'])
+        return data
+
+    values = np.load(os.path.join(entry_dir, item['file']), mmap_mode='r')
+    with xr.open_dataset(os.path.join(entry_dir, item['coords'])) as coords:
+        coords = coords.load()
+    return xr.DataArray(values, coords=coords.coords, dims=item['dims'],
+                        name=item['name'], attrs=coords.attrs)
+
+
+def _hillshade_options(source):
+    # style options the hillshade pyramid is computed with, as stored in json
+    return json.loads(json.dumps(dict(span=source.span), default=str))
+
+
+def _write_hillshade_level(level, entry_dir, z):
+    # the tiles of a level stacked in a single file, returns its manifest item
+    tiles = sorted(level)
+    arrays = [level[tile] for tile in tiles]
+    first = arrays[0]
+
+    filename = f'hillshade_{z}.npy'
+    np.save(os.path.join(entry_dir, filename), np.stack([a.values for a in arrays]))
+
+    coords_filename = f'hillshade_{z}_coords.npz'
+    np.savez(os.path.join(entry_dir, coords_filename),
+             **{name: np.stack([a[name].values for a in arrays]) for name in first.coords})
+    return dict(file=filename, coords=coords_filename, dims=list(first.dims), name=first.name,
+                coord_dims={name: list(first[name].dims) for name in first.coords},
+                tiles=[[tx, ty, a.attrs] for (tx, ty), a in zip(tiles, arrays)])
+
+
+def _attach_hillshade_level(entry_dir, item):
+    values = np.load(os.path.join(entry_dir, item['file']), mmap_mode='r')
+    with np.load(os.path.join(entry_dir, item['coords'])) as f:
+        coords = {name: f[name] for name in f.files}
+
+    level = {}
+    for i, (tx, ty, attrs) in enumerate(item['tiles']):
+        # json stores the tuple attributes, e.g. x_range, as lists
+        attrs = {k: tuple(v) if isinstance(v, list) else v for k, v in attrs.items()}
+        level[(tx, ty)] = xr.DataArray(
+            values[i], dims=item['dims'], name=item['name'], attrs=attrs,
+            coords={name: (dims, coords[name][i]) for name, dims in item['coord_dims'].items()})
+    return level
+
+
+def publish_source(source, directory):
+    """
+    Publish the loaded data and overviews of a source to memory-mapped
+    files that other processes attach to with ``attach_source``.
+
+    Vector data is written as Arrow IPC files and raster data as numpy
+    files. Data held in geometry arrays, lazy dask collections or
+    multi-file rasters is not published, which is logged, so every
+    process loads it, while lazy raster overviews are computed. The
+    levels of the hillshade pyramid are published along raster data.
+
+    Parameters
+    ----------
+    source : mapshader.sources.MapSource
+        A loaded map source.
+    directory : str
+        Directory shared by the processes, preferably on a shared memory
+        filesystem such as ``/dev/shm``.
+
+    Returns
+    -------
+    published : bool
+        Whether the data was published.
+    """
+    if not source.is_loaded:
+        return False
+
+    kind = _data_kind(source.data)
+    # lazy raster overviews of in-memory data are computed to publish them
+    overview_types = (xr.DataArray,) if kind == 'xarray' else (pd.DataFrame,)
+    if kind is None or any(_data_kind(o) is None and not isinstance(o, overview_types)
+                           for o in source.overviews.values()):
+        print(f'Not publishing {source.name}: its {type(source.data).__name__} data '
+              'is loaded by every process', file=sys.stdout)
+        return False
+
+    entry_dir = os.path.join(directory, entry_name(source.key, source_fingerprint(source)))
+    if os.path.isdir(entry_dir):
+        return True
+
+    os.makedirs(directory, exist_ok=True)
+    tmp_dir = os.path.join(directory, f'.tmp-{uuid.uuid4().hex}')
+    os.makedirs(tmp_dir)
+
+    try:
+        manifest = dict(version=SHARED_DATA_VERSION, kind=kind,
+                        data=_write_data(source.data, kind, tmp_dir, 'data'), overviews=[],
+                        breaks=export_breaks(source))
+        for level, overview in source.overviews.items():
+            item = _write_data(overview, kind, tmp_dir, f'overview_{level}')
+            manifest['overviews'].append([level, item])
+
+        if source.hillshade_overviews:
+            manifest['hillshade'] = dict(options=_hillshade_options(source), levels=[
+                [z, _write_hillshade_level(level, tmp_dir, z)]
+                for z, level in source.hillshade_overviews.items() if level])
+
+        with open(os.path.join(tmp_dir, MANIFEST_FILENAME), 'w') as f:
+            json.dump(manifest, f, default=str)
+
+        os.rename(tmp_dir, entry_dir)
+    except OSError:
+        # another process published the same source first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if not os.path.isdir(entry_dir):
+            raise
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    prune_entries(directory, source.key, os.path.basename(entry_dir))
+    print(f'Published {source.name} to {entry_dir}', file=sys.stdout)
+    return True
+
+
+def attach_source(source, directory):
+    """
+    Attach a source to the data published for it with ``publish_source``,
+    without loading or transforming it.
+
+    The attached arrays are read-only views of the memory-mapped files,
+    so processes attached to the same data share its memory. The breaks
+    and hillshade pyramid computed by the publishing process are reused
+    rather than computed in every process.
+
+    Parameters
+    ----------
+    source : mapshader.sources.MapSource
+        The map source, not loaded yet.
+    directory : str
+        Directory the data was published to.
+
+    Returns
+    -------
+    attached : bool
+        Whether data was published for the source and attached.
+    """
+    if source.is_loaded or not source.filepath:
+        return False
+
+    entry_dir = os.path.join(directory, entry_name(source.key, source_fingerprint(source)))
+    manifest_path = os.path.join(entry_dir, MANIFEST_FILENAME)
+    if not os.path.isfile(manifest_path):
+        return False
+
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+
+    kind = manifest['kind']
+    with source._load_lock:
+        source.data = _attach_data(kind, entry_dir, manifest['data'])
+        source.overviews = {level: _attach_data(kind, entry_dir, item)
+                            for level, item in manifest['overviews']}
+        source.is_loaded = True
+        source._new_load_generation()
+        # the breaks sampled by the publishing process
+        import_breaks(source, manifest.get('breaks'))
+        hillshade = manifest.get('hillshade')
+        if (hillshade and 'hillshade' in source.extras
+                and hillshade['options'] == _hillshade_options(source)):
+            source.hillshade_overviews = {z: _attach_hillshade_level(entry_dir, item)
+                                          for z, item in hillshade['levels']}
+        source._cache_entry = None
+        source._prepare_rendering()
+        source.load_state = 'loaded'
+
+    print(f'Attached {source.name} to {entry_dir}', file=sys.stdout)
+    return True
+
+
+def publish_sources(sources, directory):
+    """
+    Publish the data of the loaded sources, see ``publish_source``. A
+    failure to publish a source is logged and leaves it unpublished.
+    """
+    for source in sources:
+        try:
+            publish_source(source, directory)
+        except Exception as e:
+            print(f'Failed publishing {source.name}: {e}', file=sys.stdout)
+
+
+def attach_sources(sources, directory):
+    """
+    Attach the sources to their published data, see ``attach_source``.
+
+    Returns
+    -------
+    attached : list of mapshader.sources.MapSource
+        The attached sources.
+    """
+    return [source for source in sources if attach_source(source, directory)]
+
+
+def _publish_services(shared_data_dir, user_source_filepath, contains, sources, load_workers):
+    from mapshader.services import get_services
+
+    for _ in get_services(config_path=user_source_filepath, contains=contains,
+                          sources=sources, load_workers=load_workers,
+                          shared_data_dir=shared_data_dir):
+        pass
+
+
+def preload_shared_data(shared_data_dir, user_source_filepath=None, contains=None,
+                        sources=None, load_workers=None):
+    """
+    Load and publish the preloaded sources in a new process.
+
+    The sources are loaded in a spawned process rather than in the
+    calling one, which keeps the calling process free of loaded data and
+    of started numba threading layers. That makes it safe to fork server
+    workers from it, which then attach to the published data.
+
+    Parameters
+    ----------
+    shared_data_dir : str
+        Directory to publish the source data to.
+    user_source_filepath : str
+        Relative path to the config file.
+    contains : str
+        Skip the service type creation that contains this route.
+    sources : list of dict
+        The map source objects.
+    load_workers : int, optional
+        Maximum number of sources loading at once.
+    """
+    context = multiprocessing.get_context('spawn')
+    process = context.Process(
+        target=_publish_services,
+        args=(shared_data_dir, user_source_filepath, contains, sources, load_workers),
+    )
+    process.start()
+    process.join()
+
+    if process.exitcode != 0:
+        raise RuntimeError(f'Preloading the sources failed with exit code {process.exitcode}')
@@ -0,0 +1,103 @@
+import asyncio
+from threading import Event, Lock
+
+
+class _Call:
+    def __init__(self):
+        self.event = Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesce identical concurrent calls made from different threads.
+
+    The first caller for a key runs the function, callers arriving
+    while it is in flight wait for and share its result (or error)
+    instead of starting a duplicate call.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._calls = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def do(self, key, func, *args, **kwargs):
+        """
+        Call ``func(*args, **kwargs)`` unless a call for ``key`` is
+        already in flight, in which case wait for its result.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+        return call.result
+
+    def stats(self):
+        """
+        Get the coalescing counters as a dict.
+        """
+        with self._lock:
+            return dict(leaders=self.leaders, coalesced=self.coalesced,
+                        in_flight=len(self._calls))
+
+
+class AsyncSingleFlight:
+    """
+    Coalesce identical concurrent coroutine calls on one event loop.
+
+    The shared work runs in its own task, so a caller going away does
+    not cancel it for the others waiting on the same key.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def do(self, key, func, *args, **kwargs):
+        """
+        Await ``func(*args, **kwargs)`` unless a call for ``key`` is
+        already in flight, in which case await its result.
+        """
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args, **kwargs))
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._calls.pop(key, None))
+            self.leaders += 1
+        else:
+            self.coalesced += 1
+
+        return await asyncio.shield(task)
+
+    def stats(self):
+        """
+        Get the coalescing counters as a dict.
+        """
+        return dict(leaders=self.leaders, coalesced=self.coalesced,
+                    in_flight=len(self._calls))
@@ -1,21 +1,56 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
 from functools import lru_cache as memoized
+from functools import partial
+import itertools
 
-import os
 from os import path
+from os.path import splitext
 import sys
+from threading import Lock
+import time
 
+import dask.dataframe as dd
+import numba
 import pandas as pd
 import geopandas as gpd
+import xarray as xr
 
 from mapshader.colors import colors
 from mapshader.io import load_raster
 from mapshader.io import load_vector
+from mapshader.io import parquet_partition_index
+from mapshader.io import select_partitions
 from mapshader.transforms import get_transform_by_name
+from mapshader.transforms import in_memory_nbytes
+from mapshader.transforms import plan_transforms
+from mapshader.transforms import RESAMPLING_RASTER_TRANSFORMS
+from mapshader.transforms import xy_origin
+from mapshader import transform_cache
+from .geotiff import WindowedGeoTIFF
 from .multifile import MultiFileRaster
 
 import spatialpandas
 
 
+# Numbers of the loads of the sources, identifying their loaded data.
+_load_generations = itertools.count()
+
+# Transforms that filter rows within each partition, without moving points
+# between partitions or changing their coordinates.
+PARTITION_PRESERVING_TRANSFORMS = ('select_by_attributes',)
+
+# Transforms that windowed reads of a GeoTIFF honour themselves: a single
+# band is read, north up, from the internal overviews, in web mercator.
+WINDOWED_TRANSFORMS = ('squeeze', 'orient_array', 'build_raster_overviews', 'reproject_raster')
+
+
+class SourceNotReadyError(RuntimeError):
+    """
+    Raised when a source is still being loaded by another thread.
+    """
+
+
 class MapSource:
     """
     This class represents a map source object.
@@ -99,7 +134,22 @@ class MapSource:
     force_recreate_overviews : bool, default=False
         For overviews to be recreated even if they already exist.
     tiling: dict, default=None
-        Settings for saving tile images to an output location
+        Settings for saving tile images to an output location, such as
+        the zoom range and how to handle ``empty_tiles``.
+    autoload : bool, default=True
+        Load the data on creation if the source is preloaded or has
+        overviews. Pass False to load it later, e.g. with ``load_sources``.
+    cache_dir : str, optional
+        Directory to cache the transformed data and overviews in, relative
+        to the config file like ``filepath``. Later loads read the cached
+        result instead of applying the transforms again, until the data
+        file or the transforms change.
+    windowed_reads : bool, default=False
+        Read a single GeoTIFF raster window by window for each tile, from
+        its nearest internal overview, rather than loading it whole. A
+        file in another CRS than EPSG:3857 is warped for each tile rather
+        than reprojected whole. Only the transforms these reads honour
+        are allowed, see ``WINDOWED_TRANSFORMS``.
     """
 
     def __init__(self,  # noqa: C901
@@ -140,7 +190,10 @@ class MapSource:
                  attrs=None,
                  preload=False,
                  force_recreate_overviews=False,
-                 tiling=None):
+                 tiling=None,
+                 autoload=True,
+                 cache_dir=None,
+                 windowed_reads=False):
 
         if fields is None and isinstance(data, (gpd.GeoDataFrame)):
             fields = [geometry_field]
@@ -212,107 +265,357 @@ class MapSource:
         self.force_recreate_overviews = force_recreate_overviews
         self.region_of_interest = region_of_interest
         self.tiling = tiling
+        self.cache_dir = cache_dir
+        self.windowed_reads = windowed_reads
+
+        # statistics of the data computed once, e.g. its value range
+        self.statistics = {}
+
+        # hillshade of the tiles of the overview levels, by level and tile
+        self.hillshade_overviews = {}
 
         self.is_loaded = False
+        self.load_state = 'unloaded'
+        self.load_error = None
+        # number of the load of the data, unique across sources
+        self.load_generation = None
+        self._load_lock = Lock()
+        self._shared = None
+        self._cache_entry = None
+        self._applied_transforms = 0
+        self.transform_peak_memory = None
         self.data = data
 
-        # autoload if overviews are present
-        contains_overviews = bool(len([t for t in transforms if 'overviews' in t['name']]))
-
-        if self.preload or contains_overviews:
+        if autoload and self.needs_preload:
             self.load()
 
+    @property
+    def needs_preload(self):
+        """
+        Whether the data should be loaded at startup rather than on the
+        first request, which is the case if preloaded or if overviews are
+        present.
+        """
+        contains_overviews = bool(len([t for t in self.transforms if 'overviews' in t['name']]))
+        return self.preload or contains_overviews
+
     @property
     def load_func(self):
         raise NotImplementedError()
 
-    def load(self):
+    def load(self, timeout=None):
         """
         Load the service data.
+
+        Only one thread loads a source, concurrent callers wait for it
+        to finish and then share the loaded data.
+
+        Parameters
+        ----------
+        timeout : float, optional
+            Maximum number of seconds to wait for a load in progress in
+            another thread. Waits indefinitely by default.
+
+        Raises
+        ------
+        SourceNotReadyError
+            If the source is still loading after ``timeout`` seconds.
         """
         if self.is_loaded:
             return self
 
-        if self.data is None:
-
-            if self.config_path:
-                ogcwd = os.getcwd()
-                config_dir = path.abspath(path.dirname(self.config_path))
-                os.chdir(config_dir)
-                try:
-                    data_path = path.abspath(path.expanduser(self.filepath))
-                finally:
-                    os.chdir(ogcwd)
+        if not self._load_lock.acquire(timeout=-1 if timeout is None else timeout):
+            raise SourceNotReadyError(f'Source {self.name} is still loading')
+
+        try:
+            if self.is_loaded:
+                return self
+
+            # only the thread actually loading the source logs it
+            print(f'Loading Data {self.name}', file=sys.stdout)
+            self.load_state = 'loading'
+            self._load()
+            self._new_load_generation()
+            self._prepare_rendering()
+            self.load_state = 'loaded'
+            self.load_error = None
+        except Exception as e:
+            self.load_state = 'failed'
+            self.load_error = str(e)
+            raise
+        finally:
+            self._load_lock.release()
 
-            elif self.filepath.startswith('zip'):
-                print('Zipfile Path', file=sys.stdout)
-                data_path = self.filepath
+        return self
 
-            elif self.filepath.startswith('s3://'):
-                print('S3 Path', file=sys.stdout)
-                data_path = self.filepath
+    def unload(self):
+        """
+        Unload the data of a source read from a file, closing the files
+        it keeps open, so the next request loads it again. Sources given
+        their data are left loaded.
+        """
+        with self._load_lock:
+            if not self.is_loaded or not self.filepath:
+                return self
+
+            close = getattr(self.data, 'close', None)
+            if callable(close):
+                close()
+            self.data = None
+            self.overviews = {}
+            self.statistics = {}
+            self.hillshade_overviews = {}
+            self._applied_transforms = 0
+            self.load_generation = None
+            self._cache_entry = None
+            self.is_loaded = False
+            self.load_state = 'unloaded'
+        return self
 
-            elif not path.isabs(self.filepath):
-                print('Not Absolute', file=sys.stdout)
-                data_path = path.abspath(path.expanduser(self.filepath))
+    def _new_load_generation(self):
+        # caches key the loaded data by its generation rather than keeping it
+        self.load_generation = next(_load_generations)
+
+    def _prepare_rendering(self):
+        # data the renders need, e.g. the global breaks, computed while
+        # holding the load lock rather than by concurrent first requests
+        from mapshader.core import export_breaks
+        from mapshader.core import import_breaks
+        from mapshader.core import load_breaks
+        from mapshader.core import load_hillshade_overviews
+        entry_dir = self._cache_entry
+        try:
+            # breaks sampled by an earlier load of the cached data
+            if entry_dir is not None:
+                stored = transform_cache.read_statistics(entry_dir) or {}
+                import_breaks(self, stored.get('breaks'))
+            if load_breaks(self) and entry_dir is not None:
+                transform_cache.write_statistics(entry_dir, dict(breaks=export_breaks(self)))
+        except Exception as e:
+            print(f'Failed sampling the breaks of {self.name}: {e}', file=sys.stdout)
+        try:
+            load_hillshade_overviews(self)
+        except Exception as e:
+            print(f'Failed generating the hillshade overviews of {self.name}: {e}',
+                  file=sys.stdout)
+
+    def _data_path(self):
+        if self.config_path:
+            # resolve relative to the config file without os.chdir, which
+            # would race with sources loading in other threads
+            config_dir = path.abspath(path.dirname(self.config_path))
+            return path.abspath(path.join(config_dir, path.expanduser(self.filepath)))
+
+        elif self.filepath.startswith('zip'):
+            print('Zipfile Path', file=sys.stdout)
+            return self.filepath
+
+        elif self.filepath.startswith('s3://'):
+            print('S3 Path', file=sys.stdout)
+            return self.filepath
+
+        elif not path.isabs(self.filepath):
+            print('Not Absolute', file=sys.stdout)
+            return path.abspath(path.expanduser(self.filepath))
 
-            else:
-                print('Using Given Filepath unmodified: config{self.config_file}', file=sys.stdout)
-                data_path = self.filepath
-
-            data = self.load_func(
-                data_path,
-                self.transforms,
-                self.force_recreate_overviews,
-                self.storage_options,
-                self.geometry_field,
-                self.region_of_interest,
-            )
         else:
-            data = self.data
-
-        if self.fields:
+            print('Using Given Filepath unmodified: config{self.config_file}', file=sys.stdout)
+            return self.filepath
+
+    def _load_file(self, data_path):
+        data = self.load_func(
+            data_path,
+            self.transforms,
+            self.force_recreate_overviews,
+            self.storage_options,
+            self.geometry_field,
+            self.region_of_interest,
+            **self._load_kwargs(),
+        )
+
+        # selecting the columns copies memory-mapped ones, so data read
+        # with the fields already is not subset again
+        if self.fields and list(data.columns) != list(self.fields):
             data = data[self.fields]
 
-        self.data = data
+        return data
+
+    def _load_kwargs(self):
+        # extra arguments of the load function, e.g. to push the selection
+        # of columns down to the reader
+        return {}
+
+    def _index_partitions(self, data_path):
+        pass
+
+    def _load(self):
+        entry_dir = None
+        data_path = None
+        shared, self._shared = self._shared, None
+        self._cache_entry = None
+
+        try:
+            if self.data is None:
+                data_path = self._data_path()
+
+                entry_dir = self._transform_cache_entry(data_path)
+                if entry_dir is not None and self._read_transform_cache(entry_dir):
+                    # cached data is indexed like freshly loaded data
+                    self._index_partitions(data_path)
+                    self._cache_entry = entry_dir
+                    return
+
+                if shared is not None:
+                    self.data = shared.get(partial(self._load_file, data_path))
+                    self._applied_transforms = len(shared.transforms)
+                    shared = None
+                else:
+                    self.data = self._load_file(data_path)
+
+            elif self.fields:
+                self.data = self.data[self.fields]
+        finally:
+            if shared is not None:
+                shared.release()
+
         self._finish_load()
-        return self
+
+        if data_path is not None:
+            self._index_partitions(data_path)
+
+        if entry_dir is not None and not isinstance(self.data, (MultiFileRaster, WindowedGeoTIFF)):
+            self._write_transform_cache(entry_dir)
+            if path.isdir(entry_dir):
+                self._cache_entry = entry_dir
+
+    def _transform_cache_entry(self, data_path):
+        if not self.cache_dir:
+            return None
+
+        key = transform_cache.transform_cache_key(
+            data_path,
+            self.transforms,
+            fields=self.fields,
+            geometry_field=self.geometry_field,
+            region_of_interest=self.region_of_interest,
+            load_kwargs=self._load_kwargs(),
+        )
+        if key is None:
+            return None
+
+        cache_dir = path.expanduser(self.cache_dir)
+        if self.config_path:
+            cache_dir = path.join(path.dirname(path.abspath(self.config_path)), cache_dir)
+        return path.join(path.abspath(cache_dir), transform_cache.entry_name(self.key, key))
+
+    def _read_transform_cache(self, entry_dir):
+        # rebuilding overviews on request also rebuilds the cache entry
+        if self.force_recreate_overviews:
+            return False
+
+        try:
+            cached = transform_cache.read_transformed(entry_dir)
+        except Exception as e:
+            print(f'Ignoring unreadable transform cache {entry_dir}: {e}', file=sys.stdout)
+            return False
+
+        if cached is None:
+            return False
+
+        print(f'Read cached transforms {entry_dir}', file=sys.stdout)
+        self.data, self.overviews = cached
+        self.is_loaded = True
+        return True
+
+    def _write_transform_cache(self, entry_dir):
+        # a failing cache write must not fail the load
+        try:
+            if transform_cache.write_transformed(entry_dir, self.data, self.overviews):
+                print(f'Wrote transform cache {entry_dir}', file=sys.stdout)
+                transform_cache.prune_entries(path.dirname(entry_dir), self.key,
+                                              path.basename(entry_dir))
+        except Exception as e:
+            print(f'Failed writing transform cache {entry_dir}: {e}', file=sys.stdout)
 
     def _finish_load(self):
 
         if self.is_loaded:
             return self
 
-        if not isinstance(self.data, MultiFileRaster):
+        if isinstance(self.data, WindowedGeoTIFF):
+            self._check_windowed_transforms()
+        elif not isinstance(self.data, MultiFileRaster):
             self._apply_transforms()
 
         self.is_loaded = True
 
+    def _check_windowed_transforms(self):
+        # windowed reads do not apply the transforms, so the ones they do
+        # not honour fail the load rather than being skipped
+        skipped = [t['name'] for t in self.transforms
+                   if t['name'] not in WINDOWED_TRANSFORMS
+                   or t.get('args', {}).get('epsg', 3857) != 3857]
+        if skipped:
+            self.data.close()
+            raise ValueError(f'Windowed reads of {self.name} cannot apply the transforms '
+                             f'{", ".join(skipped)}')
+
     def _apply_transforms(self):
 
         print('# ----------------------', file=sys.stdout)
         print(f'# APPLYING TRANSFORMS {self.name}', file=sys.stdout)
         print('# ----------------------', file=sys.stdout)
-        for trans in self.transforms:
-            transform_name = trans['name']
-            print(f'\tApplying {transform_name}', file=sys.stdout)
-            func = get_transform_by_name(transform_name)
-            args = trans.get('args', {})
 
-            if 'overviews' in transform_name:
-                self.overviews = func(self.data, **args)
+        is_raster = isinstance(self.data, xr.DataArray)
+        dtype = self.data.dtype if is_raster else None
 
-            else:
-                self.data = func(self.data, **args)
+        # leading transforms may have been applied already to shared data
+        stages = plan_transforms(self.transforms[self._applied_transforms:], dtype)
+
+        peak_memory, peak_stage = 0, None
+        for stage in stages:
+            stage_name = ' + '.join(trans['name'] for trans in stage)
+            print(f'\tApplying {stage_name}', file=sys.stdout)
+            for trans in stage:
+                memory = self._apply_transform(trans)
+                if memory > peak_memory:
+                    peak_memory, peak_stage = memory, stage_name
 
-                # apply transforms to overviews if they exist
-                for level, overview_data in self.overviews.items():
-                    self.overviews[level] = func(overview_data, **args)
+        if is_raster:
+            print(f'\tEstimated peak memory {peak_memory / 2**20:.1f} MB ({peak_stage})',
+                  file=sys.stdout)
+        self.transform_peak_memory = peak_memory
 
         return self
 
+    def _apply_transform(self, trans):
+        # returns the estimated memory in use while applying the transform,
+        # counting arrays that are materialized rather than lazy
+        transform_name = trans['name']
+        func = get_transform_by_name(transform_name)
+        args = trans.get('args', {})
+
+        materializes = ('overviews' in transform_name
+                        or transform_name in RESAMPLING_RASTER_TRANSFORMS)
+        if materializes and isinstance(self.data, xr.DataArray):
+            memory = self.data.nbytes
+        else:
+            memory = in_memory_nbytes(self.data)
+
+        if 'overviews' in transform_name:
+            self.overviews = func(self.data, **args)
+            return memory + sum(in_memory_nbytes(o) for o in self.overviews.values())
+
+        self.data = func(self.data, **args)
+
+        # apply transforms to overviews if they exist
+        for level, overview_data in self.overviews.items():
+            self.overviews[level] = func(overview_data, **args)
+
+        return memory + in_memory_nbytes(self.data)
+
     @staticmethod
-    def from_obj(obj: dict):
+    def from_obj(obj: dict, autoload=True):
         transforms = obj.get('transforms')
         if transforms and isinstance(transforms, (list, tuple)):
             n = 'raster_to_categorical_points'
@@ -321,9 +624,9 @@ class MapSource:
             has_to_vector = False
 
         if obj['geometry_type'] == 'raster' or has_to_vector:
-            return RasterSource(**obj)
+            return RasterSource(autoload=autoload, **obj)
         else:
-            return VectorSource(**obj)
+            return VectorSource(autoload=autoload, **obj)
 
 
 class RasterSource(MapSource):
@@ -342,6 +645,11 @@ class RasterSource(MapSource):
     def load_func(self):
         return load_raster
 
+    def _load_kwargs(self):
+        if self.windowed_reads:
+            return dict(windowed=True, band=self.band, interpolate=self.raster_agg_func)
+        return {}
+
     @property
     @memoized()
     def full_extent(self):
@@ -353,6 +661,18 @@ class RasterSource(MapSource):
                     self.data.coords['x'].max().compute().item(),
                     self.data.coords['y'].max().compute().item())
 
+    @property
+    def value_range(self):
+        """
+        Minimum and maximum of the data values, ignoring nans.
+        """
+        if 'value_range' not in self.statistics and hasattr(self.data, 'value_range'):
+            self.statistics['value_range'] = self.data.value_range()
+        elif 'value_range' not in self.statistics:
+            self.statistics['value_range'] = (self.data.min(skipna=True).compute().item(),
+                                              self.data.max(skipna=True).compute().item())
+        return self.statistics['value_range']
+
 
 class VectorSource(MapSource):
     """
@@ -365,11 +685,64 @@ class VectorSource(MapSource):
     """
 
     source_type = 'vector'
+    partition_index = None
 
     @property
     def load_func(self):
         return load_vector
 
+    @property
+    def read_columns(self):
+        """
+        Columns read from the data file, or None to read all of them.
+
+        These are the ``fields`` if given. Otherwise, sources without a
+        geojson service, which returns every column, only read the
+        geometry, x, y and z fields and the fields used by transforms.
+        """
+        if self.fields:
+            return list(self.fields)
+
+        if 'geojson' in self.service_types:
+            return None
+
+        columns = [self.geometry_field, self.xfield, self.yfield, self.zfield]
+        for trans in self.transforms:
+            args = trans.get('args', {})
+            columns.extend(args[k] for k in ('field', 'geometry_field') if k in args)
+        return list(dict.fromkeys(c for c in columns if c))
+
+    def _load_kwargs(self):
+        kwargs = dict(columns=self.read_columns)
+        # point sources limit the region of interest by their x and y
+        # fields rather than by their geometry
+        if self.xfield != self.geometry_field and self.yfield != self.geometry_field:
+            kwargs.update(xfield=self.xfield, yfield=self.yfield)
+        return kwargs
+
+    def _index_partitions(self, data_path):
+        # lazily loaded parquet data keeps the bounds of its partitions,
+        # as long as the transforms keep the partitions and coordinates
+        self.partition_index = None
+        if (not isinstance(self.data, dd.DataFrame)
+                or splitext(data_path)[1] != '.parquet'
+                or any(t['name'] not in PARTITION_PRESERVING_TRANSFORMS
+                       for t in self.transforms)):
+            return
+
+        # the same fields load_vector indexed the partitions with
+        kwargs = self._load_kwargs()
+        index = parquet_partition_index(data_path, kwargs.get('xfield', 'x'),
+                                        kwargs.get('yfield', 'y'), self.storage_options)
+        if index is not None and self.region_of_interest is not None:
+            # the same partitions load_vector kept
+            partitions = select_partitions(index, *self.region_of_interest)
+            index = index.iloc[list(partitions) or [0]].reset_index(drop=True)
+
+        if index is not None and len(index) == self.data.npartitions:
+            print(f'Indexed {len(index)} partitions of {self.name}', file=sys.stdout)
+            self.partition_index = index
+
     @property
     @memoized()
     def full_extent(self):
@@ -378,14 +751,277 @@ class VectorSource(MapSource):
         elif isinstance(self.data, gpd.GeoDataFrame):
             return self.data[self.geometry_field].total_bounds
         elif isinstance(self.data, pd.DataFrame):
+            x0, y0 = xy_origin(self.data)
             minx, miny, maxx, maxy = (
-                self.data[self.xfield].min(),
-                self.data[self.xfield].max(),
-                self.data[self.yfield].min(),
-                self.data[self.yfield].max()
+                self.data[self.xfield].min() + x0,
+                self.data[self.yfield].min() + y0,
+                self.data[self.xfield].max() + x0,
+                self.data[self.yfield].max() + y0
             )
             return minx, miny, maxx, maxy
 
+    @property
+    def value_range(self):
+        """
+        Minimum and maximum of the ``zfield`` values, ignoring nans.
+        """
+        if 'value_range' not in self.statistics:
+            values = self.data[self.zfield]
+            self.statistics['value_range'] = dd.compute(values.min(), values.max())
+        return self.statistics['value_range']
+
+
+class SharedTransforms:
+    """
+    Simple thread-safe sharing of data between sources that read the same
+    file with the same leading transforms.
+
+    Sources are grouped with ``share``, after which the first of them to
+    load reads the file and applies the shared transforms once, and every
+    source gets a shallow copy of the result to apply its own remaining
+    transforms to. Shared transforms are not applied to the shared data
+    in place, so a shallow copy is enough to keep it intact.
+
+    Groups of sources with different transforms further down form a tree,
+    e.g. sources that only share the file read share a ``SharedTransforms``
+    holding the raw data, which is the parent of the one holding the data
+    with a common first transform for some of them. The shared data is
+    released as soon as all of its users got it.
+
+    Parameters
+    ----------
+    transforms : list of dict
+        The shared leading transforms.
+    users : int
+        Number of sources and child ``SharedTransforms`` getting the data.
+    parent : SharedTransforms, optional
+        Shared data the transforms start from instead of the file.
+    """
+
+    def __init__(self, transforms, users, parent=None):
+        self.transforms = transforms
+        self.users = users
+        self.parent = parent
+        self._lock = Lock()
+        self._data = None
+        self._loaded = False
+
+    def get(self, load):
+        """
+        Get a shallow copy of the shared data, loading it with ``load`` if
+        no other user did it yet.
+        """
+        with self._lock:
+            if not self._loaded:
+                self._data = self._load(load)
+                self._loaded = True
+
+            data = self._data
+            self._release()
+
+        return _shallow_copy(data)
+
+    def release(self):
+        """
+        Give up on getting the shared data, e.g. for a source that read
+        the data from the transform cache instead.
+        """
+        with self._lock:
+            self._release()
+
+    def _release(self):
+        self.users -= 1
+        if self.users > 0:
+            return
+
+        if not self._loaded and self.parent is not None:
+            self.parent.release()
+        self._data = None
+
+    def _load(self, load):
+        if self.parent is None:
+            data = load()
+            start = 0
+        else:
+            data = self.parent.get(load)
+            start = len(self.parent.transforms)
+
+        if isinstance(data, (MultiFileRaster, WindowedGeoTIFF)):
+            return data
+
+        for trans in self.transforms[start:]:
+            print(f'\tApplying shared {trans["name"]}', file=sys.stdout)
+            func = get_transform_by_name(trans['name'])
+            data = func(data, **trans.get('args', {}))
+        return data
+
+    @classmethod
+    def share(cls, sources):
+        """
+        Find the sources reading the same file with the same options and
+        let each group share the file read and its common leading transforms.
+
+        Parameters
+        ----------
+        sources : list of mapshader.sources.MapSource
+            The map sources about to be loaded.
+
+        Returns
+        -------
+        shared : list of SharedTransforms
+            The top level shared data of every group.
+        """
+        groups = {}
+        for source in sources:
+            key = _shared_load_key(source)
+            if key is not None:
+                groups.setdefault(key, []).append(source)
+
+        shared = []
+        for members in groups.values():
+            if len(members) > 1:
+                prefixes = [(source, _shareable_transforms(source)) for source in members]
+                shared.append(cls._share_prefix(prefixes, 0, None))
+        return shared
+
+    @classmethod
+    def _share_prefix(cls, prefixes, depth, parent):
+        # all members agree on the first ``depth`` transforms, extend that
+        # to their longest common prefix
+        length = min(len(transforms) for _, transforms in prefixes)
+        first = prefixes[0][1]
+        while depth < length and all(t[depth] == first[depth] for _, t in prefixes):
+            depth += 1
+
+        shared = cls([t for _, t in first[:depth]], 0, parent)
+
+        # members with nothing left to share use this data directly, the
+        # others split by their next transform
+        branches = {}
+        for source, transforms in prefixes:
+            if len(transforms) == depth:
+                source._shared = shared
+                shared.users += 1
+            else:
+                branches.setdefault(transforms[depth][0], []).append((source, transforms))
+
+        for branch in branches.values():
+            if len(branch) > 1:
+                cls._share_prefix(branch, depth + 1, shared)
+            else:
+                branch[0][0]._shared = shared
+            shared.users += 1
+
+        return shared
+
+
+def _shallow_copy(data):
+    if isinstance(data, (MultiFileRaster, WindowedGeoTIFF)):
+        return data
+    return data.copy(deep=False)
+
+
+def _shareable_transforms(source: MapSource):
+    # overviews transforms also change the overviews of a source, so only
+    # the transforms before the first of them are shared
+    shareable = []
+    for trans in source.transforms:
+        if 'overviews' in trans['name']:
+            break
+        shareable.append((json.dumps(trans, sort_keys=True, default=str), trans))
+    return shareable
+
+
+def _shared_load_key(source: MapSource):
+    # sources that already share their data are left as they are
+    if (source.is_loaded or source.data is not None or not source.filepath
+            or source._shared is not None):
+        return None
+
+    return json.dumps([
+        source.source_type,
+        source._data_path(),
+        source.storage_options,
+        source.geometry_field,
+        source.region_of_interest,
+        source.fields,
+        source._load_kwargs(),
+    ], default=str)
+
+
+def _timed_load(source: MapSource):
+    start = time.perf_counter()
+    try:
+        source.load()
+    except Exception as e:
+        print(f'Failed loading {source.name} after {time.perf_counter() - start:.2f}s: {e}',
+              file=sys.stdout)
+        raise
+    print(f'Loaded {source.name} in {time.perf_counter() - start:.2f}s', file=sys.stdout)
+    return source
+
+
+def load_sources(sources, max_workers=None, background=False):
+    """
+    Load map sources concurrently in a thread pool.
+
+    Threads rather than processes are used as the loaded data has to
+    end up in the serving process, while file reads, GDAL and most
+    numpy/pandas work release the GIL.
+
+    Parameters
+    ----------
+    sources : list of mapshader.sources.MapSource
+        The map sources to load.
+    max_workers : int, optional
+        Maximum number of sources loading at once, defaults to the
+        ``ThreadPoolExecutor`` default.
+    background : bool, default=False
+        Return immediately and let the loads finish in the background.
+        Requests for a source still loading wait for it, see
+        ``MapSource.load``.
+
+    Returns
+    -------
+    futures : list of concurrent.futures.Future
+        One future per source, resolving to the loaded source.
+    """
+    if not sources:
+        return []
+
+    # Start numba's parallel threading layer from this thread. When a
+    # short-lived pool thread is the first to use it, the TBB layer
+    # hangs on interpreter exit.
+    numba.get_num_threads()
+
+    SharedTransforms.share(sources)
+
+    # sources waiting for a load thread are not ready yet, unlike sources
+    # loading on demand, see mapshader.flask_app.source_readiness
+    for source in sources:
+        if source._load_lock.acquire(blocking=False):
+            try:
+                if source.load_state == 'unloaded':
+                    source.load_state = 'queued'
+            finally:
+                source._load_lock.release()
+
+    start = time.perf_counter()
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='mapshader-load')
+    futures = [executor.submit(_timed_load, source) for source in sources]
+    executor.shutdown(wait=not background)
+
+    if background:
+        print(f'Loading {len(sources)} sources in the background', file=sys.stdout)
+        return futures
+
+    # surface the first load error like a sequential load would
+    for future in futures:
+        future.result()
+
+    print(f'Loaded {len(sources)} sources in {time.perf_counter() - start:.2f}s', file=sys.stdout)
+    return futures
+
 
 # ----------------------------------------------------------------------------
 # DEFAULT MAP SOURCES
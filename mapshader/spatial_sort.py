@@ -0,0 +1,227 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from numba import jit
+
+ngjit = jit(nopython=True, nogil=True, cache=True)
+
+# Web Mercator extent the space filling curves are laid over.
+WEB_MERCATOR_BOUNDS = (-20037508.34, -20037508.34, 20037508.34, 20037508.34)
+
+CURVES = ('hilbert', 'morton')
+
+# Suffix of the sidecar partition index written next to a parquet file.
+INDEX_SUFFIX = '.index.json'
+
+# Key of the bounds in the parquet key-value metadata.
+METADATA_KEY = b'mapshader'
+
+
+@ngjit
+def _hilbert_codes(ix, iy, bits, out):
+    n = 1 << bits
+    for i in range(ix.shape[0]):
+        x = ix[i]
+        y = iy[i]
+        d = 0
+        s = n >> 1
+        while s > 0:
+            rx = 1 if (x & s) > 0 else 0
+            ry = 1 if (y & s) > 0 else 0
+            d += s * s * ((3 * rx) ^ ry)
+            # rotate the quadrant
+            if ry == 0:
+                if rx == 1:
+                    x = n - 1 - x
+                    y = n - 1 - y
+                x, y = y, x
+            s >>= 1
+        out[i] = d
+
+
+@ngjit
+def _morton_codes(ix, iy, bits, out):
+    for i in range(ix.shape[0]):
+        d = 0
+        for b in range(bits):
+            d |= ((ix[i] >> b) & 1) << (2 * b)
+            d |= ((iy[i] >> b) & 1) << (2 * b + 1)
+        out[i] = d
+
+
+def spatial_codes(x, y, curve='hilbert', bounds=WEB_MERCATOR_BOUNDS, bits=16):
+    """
+    Compute the position of points along a space filling curve.
+
+    Parameters
+    ----------
+    x, y : numpy.ndarray
+        The point coordinates.
+    curve : str, default=hilbert
+        The space filling curve, either ``hilbert`` or ``morton``.
+    bounds : tuple of float, default=WEB_MERCATOR_BOUNDS
+        Extent ``(xmin, ymin, xmax, ymax)`` covered by the curve. Points
+        outside of it are clamped to its edges.
+    bits : int, default=16
+        Resolution of the curve, in bits per axis.
+
+    Returns
+    -------
+    codes : numpy.ndarray of int64
+        The curve positions, close points having close codes.
+    """
+    if curve not in CURVES:
+        raise ValueError(f'Invalid curve {curve}, must be one of {CURVES}')
+
+    xmin, ymin, xmax, ymax = bounds
+    n = 1 << bits
+    ix = np.clip((np.asarray(x, dtype='f8') - xmin) / (xmax - xmin) * n, 0, n - 1)
+    iy = np.clip((np.asarray(y, dtype='f8') - ymin) / (ymax - ymin) * n, 0, n - 1)
+    ix = np.nan_to_num(ix).astype('i8')
+    iy = np.nan_to_num(iy).astype('i8')
+
+    codes = np.empty(len(ix), dtype='i8')
+    if curve == 'hilbert':
+        _hilbert_codes(ix, iy, bits, codes)
+    else:
+        _morton_codes(ix, iy, bits, codes)
+    return codes
+
+
+def _feature_bounds(df, xfield=None, yfield=None, geometry_field='geometry'):
+    # per feature (xmin, ymin, xmax, ymax) as a (n, 4) array
+    if xfield and yfield:
+        x = df[xfield].to_numpy(dtype='f8')
+        y = df[yfield].to_numpy(dtype='f8')
+        return np.column_stack([x, y, x, y])
+    return df[geometry_field].bounds.to_numpy(dtype='f8')
+
+
+def sort_spatially(df, curve='hilbert', xfield=None, yfield=None, geometry_field='geometry'):
+    """
+    Sort features along a space filling curve in Web Mercator, so that
+    features close in space end up in the same parquet row groups.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame or geopandas.GeoDataFrame
+        The data, in Web Mercator.
+    curve : str, default=hilbert
+        The space filling curve, either ``hilbert`` or ``morton``.
+    xfield, yfield : str, optional
+        Point coordinate columns. Features are sorted by the center of
+        their geometry bounds if not given.
+    geometry_field : str, default=geometry
+        The geometry field name.
+
+    Returns
+    -------
+    sorted_df : pandas.DataFrame or geopandas.GeoDataFrame
+        The sorted data.
+    """
+    bounds = _feature_bounds(df, xfield, yfield, geometry_field)
+    x = (bounds[:, 0] + bounds[:, 2]) / 2
+    y = (bounds[:, 1] + bounds[:, 3]) / 2
+    order = np.argsort(spatial_codes(x, y, curve), kind='stable')
+    return df.iloc[order].reset_index(drop=True)
+
+
+def _row_group_bounds(bounds, row_group_size):
+    row_groups = []
+    for start in range(0, len(bounds), row_group_size):
+        chunk = bounds[start:start + row_group_size]
+        row_groups.append([float(np.nanmin(chunk[:, 0])), float(np.nanmin(chunk[:, 1])),
+                           float(np.nanmax(chunk[:, 2])), float(np.nanmax(chunk[:, 3]))])
+    return row_groups
+
+
+def write_sorted_parquet(df, output, row_group_size=65536, xfield=None, yfield=None,
+                         geometry_field='geometry', curve=None):
+    """
+    Write spatially sorted data to parquet along with its partition index.
+
+    The total bounds are embedded in the parquet metadata, and the bounds
+    of every row group are written to a sidecar ``<output>.index.json``
+    file that ``load_vector`` uses to prune row groups.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame or geopandas.GeoDataFrame
+        The data, sorted with ``sort_spatially``.
+    output : str
+        Path of the parquet file to write.
+    row_group_size : int, default=65536
+        Number of rows per row group. Smaller row groups are pruned more
+        precisely, at the cost of more footer metadata.
+    xfield, yfield : str, optional
+        Point coordinate columns, the geometry bounds are used otherwise.
+    geometry_field : str, default=geometry
+        The geometry field name.
+    curve : str, optional
+        The curve the data was sorted by, recorded in the metadata.
+
+    Returns
+    -------
+    index : dict
+        The partition index written to the sidecar file.
+    """
+    bounds = _feature_bounds(df, xfield, yfield, geometry_field)
+    row_groups = _row_group_bounds(bounds, row_group_size)
+    total_bounds = [min(b[0] for b in row_groups), min(b[1] for b in row_groups),
+                    max(b[2] for b in row_groups), max(b[3] for b in row_groups)]
+    index = dict(curve=curve, crs='EPSG:3857', xfield=xfield, yfield=yfield,
+                 row_group_size=row_group_size, bounds=total_bounds, row_groups=row_groups)
+
+    if isinstance(df, gpd.GeoDataFrame):
+        # GeoParquet metadata already records the bounds of the geometry
+        df.to_parquet(output, index=False, row_group_size=row_group_size)
+    else:
+        table = pa.Table.from_pandas(pd.DataFrame(df), preserve_index=False)
+        metadata = dict(table.schema.metadata or {})
+        metadata[METADATA_KEY] = json.dumps(dict(bounds=total_bounds, curve=curve)).encode()
+        pq.write_table(table.replace_schema_metadata(metadata), output,
+                       row_group_size=row_group_size)
+
+    with open(output + INDEX_SUFFIX, 'w') as f:
+        json.dump(index, f)
+
+    return index
+
+
+def read_sidecar_index(fs, path):
+    """
+    Read the row group bounds of the sidecar index of a parquet file.
+
+    Parameters
+    ----------
+    fs : fsspec.AbstractFileSystem
+        Filesystem of the parquet file.
+    path : str
+        Path of the parquet file on ``fs``.
+
+    Returns
+    -------
+    row_groups : list of list of float or None
+        The ``(xmin, ymin, xmax, ymax)`` bounds of every row group, or
+        None if the file has no sidecar index.
+    """
+    index_path = path + INDEX_SUFFIX
+    if not fs.exists(index_path):
+        return None
+
+    with fs.open(index_path, 'r') as f:
+        return json.load(f)['row_groups']
+
+
+def default_output_path(filepath):
+    """
+    Get the default output path of ``mapshader spatial_sort``.
+    """
+    root = os.path.splitext(filepath)[0]
+    return f'{root}_sorted.parquet'
@@ -0,0 +1,85 @@
+import json
+import pytest
+
+pytest.importorskip('starlette')
+pytest.importorskip('httpx')
+
+from starlette.testclient import TestClient  # noqa: E402
+
+from mapshader.asgi_app import create_asgi_app  # noqa: E402
+from mapshader.services import get_services  # noqa: E402
+
+
+DEFAULT_SERVICES = list(get_services())
+
+
+@pytest.fixture(scope='module')
+def client():
+    app = create_asgi_app(concurrency={'wms': 1})
+    with TestClient(app) as client:
+        yield client
+
+
+@pytest.mark.parametrize("service", [s for s in DEFAULT_SERVICES if s.service_type == 'tile'])
+def test_default_tiles(client, service):
+    resp = client.get(service.default_url)
+    assert resp.status_code == 200
+    assert resp.headers['content-type'] == 'image/png'
+
+    # second request is served from the tile cache
+    hits = client.app.state.tile_cache.hits
+    assert client.get(service.default_url).content == resp.content
+    assert client.app.state.tile_cache.hits == hits + 1
+
+
+@pytest.mark.parametrize("service", [s for s in DEFAULT_SERVICES if s.service_type == 'image'])
+def test_default_images(client, service):
+    resp = client.get(service.default_url)
+    assert resp.status_code == 200
+
+
+@pytest.mark.parametrize("service", [s for s in DEFAULT_SERVICES if s.service_type == 'wms'])
+def test_default_wms(client, service):
+    resp = client.get(service.service_url + '?bbox=-20e6,-20e6,20e6,20e6&width=256&height=256')
+    assert resp.status_code == 200
+
+
+@pytest.mark.parametrize("service", [s for s in DEFAULT_SERVICES if s.service_type == 'geojson'])
+def test_default_geojson(client, service):
+    resp = client.get(service.default_url)
+    assert resp.status_code == 200
+    assert isinstance(json.loads(resp.content), dict)
+
+
+def test_legend_and_services(client):
+    resp = client.get(DEFAULT_SERVICES[0].legend_url)
+    assert isinstance(json.loads(resp.content), list)
+
+    resp = client.get('/services')
+    assert len(json.loads(resp.content)) == len(DEFAULT_SERVICES)
+
+
+def test_invalid_executor():
+    with pytest.raises(ValueError):
+        create_asgi_app(executor='fiber')
+
+
+def test_ready_process_executor():
+    # the states are the ones of the server process, not of the workers
+    app = create_asgi_app(executor='process', max_workers=1)
+    with TestClient(app) as client:
+        data = client.get('/ready').json()
+    assert data['executor'] == 'process'
+    assert set(data['sources']) == {s.source.key for s in DEFAULT_SERVICES}
+    assert all(s['state'] in ('unloaded', 'loaded') for s in data['sources'].values())
+
+
+def test_tile_style(client):
+    service = [s for s in DEFAULT_SERVICES if s.service_type == 'tile'][0]
+    default = client.get(service.default_url)
+    styled = client.get(service.default_url + '?cmap=red,blue&how=log')
+    assert styled.status_code == 200
+    assert styled.content != default.content
+
+    assert client.get(service.default_url + '?span=1').status_code == 400
+    assert 'agg_cache' in client.get('/stats').json()
@@ -1,10 +1,15 @@
+from concurrent.futures import ThreadPoolExecutor
 import json
+from os import path
 
 import pytest
 
 import numpy as np
+import pandas as pd
 import xarray as xr
 
+import datashader as ds
+import datashader.reductions as rd
 from datashader.transfer_functions import Image
 
 from mapshader.sources import MapSource
@@ -12,8 +17,25 @@ from mapshader.core import render_map
 from mapshader.core import render_geojson
 from mapshader.core import to_raster
 from mapshader.core import create_agg
+from mapshader.core import aligned_raster_aggregation
+from mapshader.core import is_empty_tile
+from mapshader.core import render_tile
+from mapshader.core import tile_def
+from mapshader.core import warm_up
+from mapshader.core import shade_discrete
+from mapshader.core import categorical_lut
+from mapshader.core import ColormapLUT
+from mapshader.core import colormap_lut
+from mapshader.core import styled_source
+from mapshader.core import value_breaks
+from mapshader.core import hillshade_agg
+from mapshader.core import InvalidStyleError
+from mapshader.core import parse_style
+from mapshader.cache import LRUCache
+from mapshader.io import select_partitions
 from mapshader.tests.data import DEFAULT_SOURCES_FUNCS
 from mapshader.sources import elevation_source
+from mapshader.sources import nybb_source
 
 
 @pytest.mark.parametrize("source_func", DEFAULT_SOURCES_FUNCS)
@@ -72,3 +94,365 @@ def test_tile_render_edge_effects():
 
     img = render_map(source, x=10, y=11, z=5)
     assert isinstance(img, Image)
+
+
+def test_is_empty_tile():
+    data = np.zeros((256, 256), dtype=np.uint32)
+    assert is_empty_tile(data)
+
+    # colour without alpha is still transparent
+    data[10, 10] = 0x00ffffff
+    assert is_empty_tile(data)
+
+    data[200, 3] = 0x01000000
+    assert not is_empty_tile(data)
+
+
+@pytest.mark.parametrize("empty_tiles", ['skip', 'blob', 'write'])
+def test_render_tile_empty(tmp_path, empty_tiles):
+    source = MapSource.from_obj(nybb_source()).load()
+    outpath = str(tmp_path)
+
+    # a tile over the Pacific Ocean has nothing to draw
+    output = render_tile(source, outpath, z=3, x=0, y=3, empty_tiles=empty_tiles)
+    if empty_tiles == 'write':
+        assert path.isfile(output)
+    else:
+        assert output is None
+        assert not path.exists(path.join(outpath, '3'))
+
+    output = render_tile(source, outpath, z=0, x=0, y=0, empty_tiles=empty_tiles)
+    assert path.isfile(output)
+
+
+def test_create_agg_prunes_partitions(tmp_path):
+    data_dir = tmp_path / 'points.parquet'
+    data_dir.mkdir()
+    rng = np.random.default_rng(0)
+    for i in range(4):
+        x = np.sort(rng.uniform(-2e7 + i * 1e7, -1e7 + i * 1e7, 1000))
+        y = rng.uniform(-1e7, 1e7, 1000)
+        df = pd.DataFrame(dict(x=x, y=y, value=rng.random(1000)))
+        df.to_parquet(data_dir / f'part.{i}.parquet', row_group_size=250)
+
+    source = MapSource.from_obj(dict(
+        name='Points', key='points', geometry_type='point', filepath=str(data_dir),
+        xfield='x', yfield='y', zfield='value', agg_func='sum', geometry_field=None,
+    )).load()
+    assert source.data.npartitions == 16
+    assert len(source.partition_index) == 16
+
+    agg = create_agg(source, x=1, y=0, z=1)
+    index = source.partition_index
+    source.partition_index = None
+    expected = create_agg(source, x=1, y=0, z=1)
+    source.partition_index = index
+
+    np.testing.assert_allclose(agg.values, expected.values)
+    xmin, ymin, xmax, ymax = tile_def.get_tile_meters(1, 0, 1)
+    assert len(select_partitions(index, xmin, ymin, xmax, ymax)) == 8
+
+
+def test_create_agg_compacted_points():
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(dict(x=rng.uniform(-2e7, 2e7, 1000), y=rng.uniform(-2e7, 2e7, 1000),
+                           value=rng.random(1000)))
+    source_obj = dict(
+        name='Points', key='points', geometry_type='point', data=df,
+        xfield='x', yfield='y', zfield='value', agg_func='sum', geometry_field=None,
+    )
+    expected = create_agg(MapSource.from_obj(source_obj).load(), x=1, y=0, z=1)
+
+    source_obj['transforms'] = [dict(name='compact_points',
+                                     args=dict(xfield='x', yfield='y', zfield='value'))]
+    source = MapSource.from_obj(source_obj).load()
+    assert source.data['x'].dtype == 'float32'
+    assert source.full_extent[0] == df['x'].min()
+
+    agg = create_agg(source, x=1, y=0, z=1)
+    np.testing.assert_allclose(agg['x'], expected['x'])
+    np.testing.assert_allclose(agg['y'], expected['y'])
+    np.testing.assert_allclose(agg.values, expected.values, rtol=1e-6)
+
+
+@pytest.mark.parametrize("agg_method", [rd.max(), rd.min(), rd.mean()])
+def test_aligned_raster_aggregation(agg_method):
+    # an overview of 2048 pixels across the tile grid, north up
+    dx = 2 * 20037508.34 / 2048
+    x = -20037508.34 + dx * (np.arange(96, 1904) + 0.5)
+    y = -20037508.34 + dx * (np.arange(1536, 256, -1) - 0.5)
+    values = np.random.default_rng(0).random((len(y), len(x)))
+    values[values < 0.05] = np.nan
+    data = xr.DataArray(values, coords=dict(y=y, x=x), dims=('y', 'x'))
+
+    for z, tx, ty in [(3, 3, 3), (2, 1, 1), (1, 0, 1), (1, 1, 0)]:
+        xmin, ymin, xmax, ymax = tile_def.get_tile_meters(tx, ty, z)
+        cvs = ds.Canvas(plot_width=256, plot_height=256,
+                        x_range=(xmin, xmax), y_range=(ymin, ymax))
+        agg = aligned_raster_aggregation(cvs, data, agg_method=agg_method)
+        expected = cvs.raster(data, agg=agg_method)
+        np.testing.assert_allclose(agg.values, expected.values[::-1])
+        np.testing.assert_array_equal(agg.x, expected.x)
+        np.testing.assert_array_equal(agg.y, expected.y)
+
+    # upsampled and shifted canvases are resampled
+    xmin, ymin, xmax, ymax = tile_def.get_tile_meters(5, 5, 5)
+    cvs = ds.Canvas(plot_width=256, plot_height=256, x_range=(xmin, xmax), y_range=(ymin, ymax))
+    assert aligned_raster_aggregation(cvs, data) is None
+    cvs = ds.Canvas(plot_width=256, plot_height=256,
+                    x_range=(dx / 2, dx / 2 + 4e6), y_range=(0, 4e6))
+    assert aligned_raster_aggregation(cvs, data) is None
+
+
+def test_warm_up():
+    sources = [MapSource.from_obj(func()).load() for func in DEFAULT_SOURCES_FUNCS]
+    data = [source.data for source in sources]
+
+    stats = warm_up(sources + [MapSource.from_obj(elevation_source(), autoload=False)])
+    assert 0 < stats['renderers'] <= len(sources)
+    assert 0 <= stats['compile_seconds'] <= stats['seconds']
+
+    # the sources keep their data
+    assert all(source.data is d for source, d in zip(sources, data))
+
+    # already compiled renderers do not compile again
+    assert warm_up(sources)['compile_seconds'] < stats['compile_seconds'] or \
+        stats['compile_seconds'] == 0
+
+
+def _shade_discrete_reference(data, color_key, alpha=255, nodata=0):
+    # per category masks, as the pixels were shaded before the lookup tables
+    from datashader.colors import rgb
+    rgba = np.zeros(data.shape + (4,), dtype=np.uint8)
+    with np.errstate(invalid='ignore'):
+        values = data.astype(np.uint64)
+    for cats, color in color_key.items():
+        for c in (cats if isinstance(cats, tuple) else (cats,)):
+            rgba[values == c, :3] = rgb(color)
+    rgba[..., 3] = np.where(rgba[..., 0] <= nodata, 0, alpha)
+    return rgba.view(np.uint32)[..., 0]
+
+
+@pytest.mark.parametrize("color_key", [
+    {1: 'red', 2: '#00ff00', 3: 'blue', 7: 'white'},
+    {(1, 2): 'red', (3, 9): '#123456'},
+    {1: 'red', 100000: 'blue', 3: 'green'},
+])
+def test_shade_discrete(color_key):
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 12, (30, 40)).astype('float64')
+    data[data == 0] = np.nan
+    data[5, 5] = 3.7
+    data[6, 6] = 100000
+    agg = xr.DataArray(data, dims=['y', 'x'],
+                       coords=dict(y=np.arange(30.), x=np.arange(40.)))
+
+    img = shade_discrete(agg, color_key)
+    assert img.dtype == np.uint32
+    np.testing.assert_array_equal(img.data, _shade_discrete_reference(data, color_key))
+
+    # small integer categories are indexed, others searched
+    assert categorical_lut(color_key).direct == (100000 not in color_key)
+    assert categorical_lut(color_key) is categorical_lut(color_key)
+
+
+@pytest.mark.parametrize("dtype", ['float64', 'float32', 'uint32'])
+@pytest.mark.parametrize("how", ['linear', 'log', 'cbrt'])
+@pytest.mark.parametrize("span,clip", [(None, False), ((58, 248), False), ((20, 200), True)])
+def test_colormap_lut(dtype, how, span, clip):
+    from datashader.transfer_functions import shade
+    from mapshader.colors import colors
+
+    rng = np.random.default_rng(0)
+    data = (rng.random((50, 60)) * 300).astype(dtype)
+    data[rng.random(data.shape) < 0.2] = 0
+    if data.dtype.kind == 'f':
+        data[rng.random(data.shape) < 0.1] = np.nan
+    agg = xr.DataArray(data, dims=['y', 'x'],
+                       coords=dict(y=np.arange(50.), x=np.arange(60.)))
+
+    # the aggregate as render_map prepares it for datashader
+    expected = agg
+    if span is not None and not clip:
+        expected = expected.where((agg >= span[0]) & (agg <= span[1]))
+    expected = expected.astype('float64')
+    expected.data[expected.data == 0] = np.nan
+    cmap = colors['viridis']
+    expected = shade(expected, cmap=cmap, how=how, span=span)
+
+    img = ColormapLUT(tuple(cmap), how, span, clip).shade(agg)
+    assert img.dtype == np.uint32
+    np.testing.assert_array_equal(img.data, expected.data)
+
+
+def test_colormap_lut_sources():
+    source = MapSource.from_obj(elevation_source()).load()
+    assert colormap_lut(source) is colormap_lut(source)
+    assert colormap_lut(source).span == (58, 248)
+
+    source.extras = ['hillshade']
+    assert colormap_lut(source) is None
+    source.extras = []
+    source.shade_how = 'eq_hist'
+    assert colormap_lut(source) is None
+
+
+def test_global_eq_hist_breaks():
+    source_obj = elevation_source()
+    source_obj['shade_how'] = 'eq_hist'
+    source_obj['span'] = None
+    source = MapSource.from_obj(source_obj).load()
+
+    # the breaks of the first zoom levels are sampled while loading
+    assert [k[1] for k in source.statistics if k[0] == 'breaks'] == list(range(8))
+    breaks = source.statistics[('breaks', 2, 256)]
+    img = render_map(source, x=1, y=1, z=2, height=256, width=256)
+    assert len(breaks) == 257
+    assert list(breaks) == sorted(breaks)
+    assert value_breaks(source, 2, 256) is breaks
+
+    # styles with other spans reuse the breaks, the span masks the values
+    n = len(source.statistics)
+    for vmax in range(100, 200, 10):
+        styled = render_map(source, x=1, y=1, z=2, height=256, width=256,
+                            style=dict(span=(60, vmax), how='eq_hist'))
+        alpha = styled.data >> 24
+        agg = create_agg(source, x=1, y=1, z=2, height=256, width=256)
+        assert not alpha[(agg.values > vmax)].any()
+    assert len(source.statistics) == n
+
+    # every tile of the zoom level is shaded with the same breaks
+    lut = colormap_lut(source, 2)
+    assert colormap_lut(source, 2) is lut
+    agg = create_agg(source, x=1, y=1, z=2, height=256, width=256)
+    np.testing.assert_array_equal(img.data, lut.shade(agg).data)
+
+    # with a single tile the global and per tile equalization agree
+    from datashader.transfer_functions import shade
+    agg = create_agg(source, x=0, y=0, z=0, height=256, width=256).astype('float64')
+    agg.data[agg.data == 0] = np.nan
+    expected = shade(agg, cmap=source.cmap, how='eq_hist')
+    img = render_map(source, x=0, y=0, z=0, height=256, width=256)
+    diff = np.abs(img.data.view(np.uint8).astype(int) - expected.data.view(np.uint8).astype(int))
+    assert diff.max() <= 1
+
+
+def test_global_quantile_breaks():
+    from datashader.transfer_functions import shade
+    from xrspatial.classify import quantile
+
+    source_obj = elevation_source()
+    source_obj['extras'] = ['quantile']
+    source_obj['span'] = None
+    source = MapSource.from_obj(source_obj).load()
+
+    # with a single tile the global and per tile classes are the same
+    img = render_map(source, x=0, y=0, z=0, height=256, width=256)
+    agg = create_agg(source, x=0, y=0, z=0, height=256, width=256).astype('float64')
+    agg.data[agg.data == 0] = np.nan
+    expected = shade(quantile(agg), cmap=source.cmap, how='linear')
+    np.testing.assert_array_equal(img.data, expected.data)
+    assert len(value_breaks(source, 0, 4)) == 5
+
+    # the breaks of deeper levels are sampled once on first use
+    key = ('breaks', 9, 4)
+    assert key not in source.statistics
+    with ThreadPoolExecutor(4) as executor:
+        results = list(executor.map(lambda _: value_breaks(source, 9, 4), range(4)))
+    assert all(r is source.statistics[key] for r in results)
+
+
+def test_hillshade_pyramid():
+    source_obj = elevation_source()
+    source_obj['extras'] = ['hillshade']
+    source_obj['span'] = None
+    source = MapSource.from_obj(source_obj).load()
+
+    # the tiles of the overview levels are computed while loading
+    assert sorted(source.hillshade_overviews) == sorted(source.overviews) == [2, 3]
+    level = source.hillshade_overviews[2]
+    left = hillshade_agg(source, *tile_def.get_tile_meters(1, 1, 2), x=1, y=1, z=2)
+    assert left is level[(1, 1)]
+    assert left.shape == (256, 256)
+
+    expected = create_agg(source, x=1, y=1, z=2)
+    np.testing.assert_allclose(left.x, expected.x)
+    np.testing.assert_allclose(left.y, expected.y)
+
+    # and match the tiles computed with a halo
+    for (tx, ty), tile in level.items():
+        xmin, ymin, xmax, ymax = tile_def.get_tile_meters(tx, ty, 2)
+        computed = hillshade_agg(source, xmin, ymin, xmax, ymax, z=2)
+        np.testing.assert_array_equal(tile.values, computed.values)
+
+    # other tiles are computed with a halo, without nan borders within the data
+    xmin, ymin, xmax, ymax = tile_def.get_tile_meters(4, 5, 4)
+    agg = hillshade_agg(source, xmin, ymin, xmax, ymax, x=4, y=5, z=4)
+    assert agg.shape == (256, 256)
+    assert not np.isnan(agg.values).any()
+    assert 4 not in source.hillshade_overviews
+
+
+def test_parse_style():
+    from mapshader.colors import colors
+
+    style = parse_style(dict(cmap='viridis', span='10,20.5', how='log'))
+    assert style == dict(cmap=tuple(colors['viridis']), span=(10, 20.5), how='log')
+    assert parse_style(dict(cmap='red, #0000ff', span='min/max')) == \
+        dict(cmap=('red', '#0000ff'), span='min/max')
+    assert parse_style({}) == {}
+
+    for params in (dict(cmap='red,nocolor'), dict(span='1'), dict(how='sqrt')):
+        with pytest.raises(InvalidStyleError):
+            parse_style(params)
+
+
+def test_render_map_restyles_cached_aggs():
+    source = MapSource.from_obj(elevation_source()).load()
+    agg_cache = LRUCache(8)
+
+    img = render_map(source, x=0, y=0, z=0, height=256, width=256, agg_cache=agg_cache)
+    assert agg_cache.stats()['misses'] == 1
+    # the cached aggregate is the one rendered without cache
+    cached = next(iter(agg_cache._data.values()))
+    expected = create_agg(source, x=0, y=0, z=0, height=256, width=256)
+    assert cached.dtype == expected.dtype
+    np.testing.assert_array_equal(
+        img.data, render_map(source, x=0, y=0, z=0, height=256, width=256).data)
+
+    # restyling only shades the cached aggregate again
+    style = dict(cmap=('red', 'blue'), span=(60, 200), how='cbrt')
+    styled = render_map(source, x=0, y=0, z=0, height=256, width=256, style=style,
+                        agg_cache=agg_cache)
+    assert agg_cache.stats()['hits'] == 1
+    assert not np.array_equal(styled.data, img.data)
+
+    source_obj = elevation_source()
+    source_obj.update(cmap=['red', 'blue'], span=(60, 200), shade_how='cbrt')
+    expected = render_map(MapSource.from_obj(source_obj).load(), x=0, y=0, z=0,
+                          height=256, width=256)
+    np.testing.assert_array_equal(styled.data, expected.data)
+
+    # spaces other than tiles are not cached
+    render_map(source, *tile_def.get_tile_meters(0, 0, 0), height=512, width=512,
+               agg_cache=agg_cache)
+    assert len(agg_cache) == 1
+
+
+def test_styled_source_follows_reloads():
+    source = MapSource.from_obj(elevation_source()).load()
+    agg_cache = LRUCache(8)
+
+    styled = styled_source(source, how='log')
+    assert styled is styled_source(source, how='log')
+    assert styled.shade_how == 'log' and styled.data is source.data
+    render_map(source, x=0, y=0, z=0, height=256, width=256, agg_cache=agg_cache)
+
+    # reloaded data is styled, and cached aggregates do not keep the old one
+    data = source.data
+    source.unload().load()
+    assert source.data is not data
+    assert styled_source(source, how='log').data is source.data
+    assert all(not isinstance(v, tuple) for v in agg_cache._data.values())
+    render_map(source, x=0, y=0, z=0, height=256, width=256, agg_cache=agg_cache)
+    assert agg_cache.stats()['misses'] == 2
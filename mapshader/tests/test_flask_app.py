@@ -1,7 +1,14 @@
 import json
+from threading import Event
+
 import pytest
 
 from mapshader.flask_app import create_app
+from mapshader.flask_app import source_readiness
+from mapshader.sources import MapSource
+from mapshader.sources import load_sources
+from mapshader.sources import nybb_source
+from mapshader.sources import world_countries_source
 
 from mapshader.services import get_services
 
@@ -52,3 +59,55 @@ def test_default_wms(service):
 def test_site_index():
     resp = CLIENT.get('/')
     assert resp.status_code == 200
+
+
+def test_stats():
+    resp = CLIENT.get('/stats')
+    assert resp.status_code == 200
+
+    data = json.loads(resp.data)
+    assert set(data['coalescing']) == {'leaders', 'coalesced', 'in_flight'}
+
+
+def test_ready():
+    resp = CLIENT.get('/ready')
+    assert resp.status_code == 200
+
+    data = json.loads(resp.data)
+    assert data['ready']
+    assert all(s['state'] in ('unloaded', 'loaded') for s in data['sources'].values())
+
+
+def test_ready_queued_sources(monkeypatch):
+    sources = [MapSource.from_obj(func(), autoload=False)
+               for func in (nybb_source, world_countries_source)]
+    release = Event()
+    finish_load = sources[0]._finish_load
+
+    def blocked_finish_load():
+        release.wait()
+        finish_load()
+
+    monkeypatch.setattr(sources[0], '_finish_load', blocked_finish_load)
+
+    # preloaded sources waiting for a load thread are not ready
+    futures = load_sources(sources, max_workers=1, background=True)
+    ready, states = source_readiness(sources)
+    assert not ready
+    assert states[sources[1].key]['state'] == 'queued'
+
+    release.set()
+    for future in futures:
+        future.result()
+    assert source_readiness(sources)[0]
+
+
+def test_tile_style():
+    service = next(s for s in get_services() if s.service_type == 'tile')
+    default = CLIENT.get(service.default_url)
+    styled = CLIENT.get(service.default_url + '?cmap=red,blue&how=log')
+    assert styled.status_code == 200
+    assert styled.data != default.data
+
+    resp = CLIENT.get(service.default_url + '?how=sqrt')
+    assert resp.status_code == 400
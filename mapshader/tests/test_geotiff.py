@@ -0,0 +1,153 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.transform import from_bounds
+from rasterio.transform import from_origin
+from rasterio.warp import reproject
+
+from mapshader.core import create_agg
+from mapshader.core import render_map
+from mapshader.core import tile_def
+from mapshader.geotiff import DATASET_HANDLES
+from mapshader.geotiff import WindowedGeoTIFF
+from mapshader.sources import MapSource
+
+
+def _geotiff(tmp_path, n=1024):
+    # a world raster with overviews down to 256 pixels
+    res = 2 * 20037508.34 / n
+    y, x = np.mgrid[0:n, 0:n]
+    values = (100 + 100 * np.sin(x / 50) * np.cos(y / 70)).astype('float32')
+    values[:10, :10] = -9999
+
+    filepath = str(tmp_path / 'raster.tif')
+    with rasterio.open(filepath, 'w', driver='GTiff', width=n, height=n, count=1,
+                       dtype='float32', crs='EPSG:3857', nodata=-9999, tiled=True,
+                       transform=from_origin(-20037508.34, 20037508.34, res, res)) as dst:
+        dst.write(values, 1)
+        dst.build_overviews([2, 4], Resampling.average)
+    return filepath
+
+
+def test_read_bounds_overview_level(tmp_path):
+    raster = WindowedGeoTIFF(_geotiff(tmp_path))
+    assert raster.full_extent() == pytest.approx(tile_def.get_tile_meters(0, 0, 0))
+
+    # the world tile is read from the overview of 256 pixels
+    arr = raster.read_bounds(*tile_def.get_tile_meters(0, 0, 0), 256, 256)
+    assert arr.shape == (256, 256)
+    assert np.isnan(arr.values[:2, :2]).all()
+    assert arr.y[0] > arr.y[-1]
+
+    # deeper tiles read their window at full resolution, with a halo
+    arr = raster.read_bounds(*tile_def.get_tile_meters(1, 1, 2), 256, 256)
+    assert 258 <= min(arr.shape) <= max(arr.shape) <= 259
+
+    arr = raster.read_bounds(*tile_def.get_tile_meters(1, 1, 2), 64, 64)
+    assert 66 <= min(arr.shape) <= max(arr.shape) <= 67
+
+    # tiles outside of the data are empty
+    assert raster.read_bounds(3e7, 3e7, 4e7, 4e7, 256, 256).ndim == 0
+
+    vmin, vmax = raster.value_range()
+    assert 0 <= vmin < vmax <= 200
+
+
+def test_windowed_reads_source(tmp_path):
+    source_obj = dict(name='Raster', key='raster', geometry_type='raster',
+                      filepath=_geotiff(tmp_path), span='min/max',
+                      transforms=[dict(name='squeeze', args=dict(dim='band'))])
+    source = MapSource.from_obj(source_obj).load()
+    windowed = MapSource.from_obj(dict(source_obj, windowed_reads=True)).load()
+    assert isinstance(windowed.data, WindowedGeoTIFF)
+
+    # tiles at the resolution of the raster match the loaded raster
+    for x, y, z in [(1, 1, 2), (0, 3, 2)]:
+        agg = create_agg(windowed, x=x, y=y, z=z)
+        expected = create_agg(source, x=x, y=y, z=z)
+        np.testing.assert_allclose(agg.values, expected.values)
+
+    img = render_map(windowed, x=0, y=0, z=0, height=256, width=256)
+    assert img.shape == (256, 256)
+    # the nodata corner in the north west is transparent
+    assert (img.data[-2:, :2] >> 24 == 0).all()
+
+    # unloading closes the datasets kept open
+    datasets = windowed.data._datasets
+    assert len(datasets) > 0
+    windowed.unload()
+    assert len(datasets) == 0 and windowed.data is None
+    assert windowed.load().is_loaded
+
+    # transforms the windowed reads do not honour fail the load
+    transforms = source_obj['transforms'] + [dict(name='cast', args=dict(dtype='int16'))]
+    with pytest.raises(ValueError, match='cast'):
+        MapSource.from_obj(dict(source_obj, windowed_reads=True, transforms=transforms)).load()
+
+
+def test_dataset_pool(tmp_path):
+    raster = WindowedGeoTIFF(_geotiff(tmp_path))
+    bounds = [tile_def.get_tile_meters(x, y, 2) for x in range(4) for y in range(4)]
+
+    # threads share the datasets of the pool
+    with ThreadPoolExecutor(8) as executor:
+        arrs = list(executor.map(lambda b: raster.read_bounds(*b, 256, 256), bounds))
+    for b, arr in zip(bounds, arrs):
+        np.testing.assert_array_equal(arr.values, raster.read_bounds(*b, 256, 256).values)
+    assert 0 < len(raster._datasets) <= DATASET_HANDLES
+
+    with raster._dataset(-1) as src:
+        raster.close()
+        assert len(raster._datasets) == 0
+        assert not src.closed
+    # datasets returned after closing the pool are closed
+    assert src.closed
+
+
+def test_windowed_reads_warp(tmp_path):
+    # a global raster in EPSG:4326
+    n = 1024
+    y, x = np.mgrid[0:n // 2, 0:n]
+    values = (100 + 100 * np.sin(x / 50) * np.cos(y / 70)).astype('float32')
+    filepath = str(tmp_path / 'raster_4326.tif')
+    with rasterio.open(filepath, 'w', driver='GTiff', width=n, height=n // 2, count=1,
+                       dtype='float32', crs='EPSG:4326', tiled=True,
+                       transform=from_origin(-180, 90, 360 / n, 360 / n)) as dst:
+        dst.write(values, 1)
+
+    raster = WindowedGeoTIFF(filepath)
+    assert raster.full_extent() == pytest.approx(tile_def.get_tile_meters(0, 0, 0))
+
+    with rasterio.open(filepath) as src:
+        for x, y in [(5, 6), (6, 6)]:
+            xmin, ymin, xmax, ymax = tile_def.get_tile_meters(x, y, 4)
+            expected = np.full((256, 256), np.nan, dtype='float32')
+            reproject(rasterio.band(src, 1), expected, dst_crs='EPSG:3857',
+                      dst_transform=from_bounds(xmin, ymin, xmax, ymax, 256, 256),
+                      resampling=Resampling.bilinear)
+
+            arr = raster.read_bounds(xmin, ymin, xmax, ymax, 256, 256)
+            arr = arr.sel(x=slice(xmin, xmax), y=slice(ymax, ymin))
+            np.testing.assert_allclose(arr.values, expected, atol=1e-3)
+
+    # the tiles of a zoom level share a warped view of the file
+    assert len(raster._datasets) == 1
+    with raster._warped(*raster._datasets._idle[0][0]) as vrt:
+        pass
+
+    # evicted views are closed along with their dataset
+    raster._datasets.maxsize = 1
+    raster.read_bounds(*tile_def.get_tile_meters(2, 3, 3), 256, 256)
+    assert len(raster._datasets) == 1
+    assert vrt.closed and vrt.src_dataset.closed
+
+    # rasters without a CRS are not read
+    filepath = str(tmp_path / 'raster_no_crs.tif')
+    with rasterio.open(filepath, 'w', driver='GTiff', width=2, height=2, count=1,
+                       dtype='float32') as dst:
+        dst.write(values[:2, :2], 1)
+    with pytest.raises(ValueError):
+        WindowedGeoTIFF(filepath)
@@ -0,0 +1,32 @@
+import os
+
+import pytest
+
+pytest.importorskip('gunicorn')
+
+from mapshader.gunicorn_app import MapshaderApplication  # noqa: E402
+from mapshader.sources import elevation_source  # noqa: E402
+
+
+def test_gunicorn_app(tmp_path):
+    shared_dir = str(tmp_path / 'shared')
+    source_obj = elevation_source()
+    source_obj['service_types'] = ['tile']
+
+    application = MapshaderApplication(sources=[source_obj], shared_data_dir=shared_dir,
+                                       options=dict(workers=2, threads=4))
+    assert application.cfg.workers == 2
+    assert application.cfg.threads == 4
+    assert application.cfg.worker_class_str == 'gthread'
+    assert not application.cfg.preload_app
+
+    application.cfg.on_starting(None)
+    assert len(os.listdir(shared_dir)) == 1
+
+    app = application.load()
+    resp = app.test_client().get('/elevation-tile/tile/0/0/0')
+    assert resp.status_code == 200
+
+    # a given shared data directory is kept on exit
+    application.cfg.on_exit(None)
+    assert os.path.isdir(shared_dir)
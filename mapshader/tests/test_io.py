@@ -1,21 +1,127 @@
-# import json
-# from os import path
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
 
-# from io import BytesIO
+from mapshader.io import load_vector
+from mapshader.io import parquet_partition_index
+from mapshader.io import select_partitions
+from mapshader.sources import MapSource
+from mapshader.sources import world_countries_source
 
-# import pytest
 
-# import xarray as xr
+def _points_parquet(tmp_path):
+    n = 1000
+    df = pd.DataFrame(dict(x=np.linspace(0, 100, n), y=np.linspace(0, 100, n),
+                           value=np.arange(n), unused=np.zeros(n)))
+    filepath = str(tmp_path / 'points.parquet')
+    df.to_parquet(filepath, row_group_size=100)
+    return filepath, df
 
-# from datashader.transfer_functions import Image
 
-# from mapshader.sources import MapSource
-# from mapshader.core import render_map
-# from mapshader.core import render_geojson
+def test_load_vector_parquet_pushdown(tmp_path):
+    filepath, df = _points_parquet(tmp_path)
 
-# from mapshader.sources import world_countries_source
-# from mapshader.sources import world_cities_source
-# from mapshader.sources import nybb_source
-# from mapshader.sources import elevation_source
+    region = (10, 10, 20, 20)
+    loaded = load_vector(filepath, [], False, None, None, region,
+                         columns=['value', 'missing'], xfield='x', yfield='y')
 
-# from mapshader.tests.data import DEFAULT_SOURCES_FUNCS
+    # the x and y fields are read to filter the region of interest
+    assert list(loaded.columns) == ['x', 'y', 'value']
+    result = loaded.compute()
+    expected = df[(df.x >= 10) & (df.x <= 20) & (df.y >= 10) & (df.y <= 20)]
+    np.testing.assert_array_equal(result['value'], expected['value'])
+
+
+def test_load_vector_parquet_columns(tmp_path):
+    filepath, df = _points_parquet(tmp_path)
+
+    loaded = load_vector(filepath, [], False, None, None, None, columns=['y', 'x'])
+    assert list(loaded.columns) == ['x', 'y']
+    assert len(loaded.compute()) == len(df)
+
+
+def test_load_vector_ogr_pushdown():
+    filepath = gpd.datasets.get_path('naturalearth_lowres')
+    all_countries = gpd.read_file(filepath)
+
+    region = (0, 40, 10, 50)
+    loaded = load_vector(filepath, [], False, None, 'geometry', region, columns=['name'])
+
+    assert list(loaded.columns) == ['name', 'geometry']
+    expected = all_countries.cx[0:10, 40:50]
+    assert sorted(loaded['name']) == sorted(expected['name'])
+
+
+def test_vector_source_read_columns():
+    source_obj = world_countries_source()
+    source = MapSource.from_obj(source_obj, autoload=False)
+    assert source.read_columns is None
+
+    source_obj['service_types'] = ['tile', 'wms', 'image']
+    source = MapSource.from_obj(source_obj, autoload=False)
+    assert source.read_columns == ['geometry', 'x', 'y', 'pop_est', 'name']
+
+    source.load()
+    assert set(source.data.columns) == {'geometry', 'pop_est', 'name'}
+
+
+def test_parquet_partition_index(tmp_path):
+    filepath, df = _points_parquet(tmp_path)
+
+    index = parquet_partition_index(filepath, 'x', 'y')
+    assert list(index['row_group']) == list(range(10))
+    assert index['xmin'][0] == df['x'][0]
+    assert index['xmax'][9] == df['x'].iloc[-1]
+
+    np.testing.assert_array_equal(select_partitions(index, 10, 10, 20, 20), [1])
+    assert len(select_partitions(index, 200, 200, 300, 300)) == 0
+
+    assert parquet_partition_index(filepath, 'x', 'missing') is None
+
+
+def test_load_vector_partitions_by_row_group(tmp_path):
+    filepath, df = _points_parquet(tmp_path)
+
+    loaded = load_vector(filepath, [], False, None, None, (10, 10, 20, 20),
+                         xfield='x', yfield='y')
+    assert loaded.npartitions == 1
+    assert len(loaded.compute()) == ((df.x >= 10) & (df.x <= 20)).sum()
+
+
+def test_load_vector_arrow_memory_mapped(tmp_path):
+    n = 1000
+    df = pd.DataFrame(dict(x=np.linspace(0, 100, n), y=np.linspace(0, 100, n),
+                           value=np.arange(n), name=np.arange(n).astype(str)))
+    filepath = str(tmp_path / 'points.arrow')
+    feather.write_feather(df, filepath, compression='uncompressed', chunksize=n)
+
+    allocated = pa.total_allocated_bytes()
+    loaded = load_vector(filepath, [], False, None, None, None, columns=['x', 'y', 'value'])
+
+    # numeric columns are views of the memory-mapped file
+    assert pa.total_allocated_bytes() == allocated
+    assert not loaded['x'].values.flags.writeable
+    pd.testing.assert_frame_equal(loaded, df[['x', 'y', 'value']])
+
+    # the columns are in the order asked for
+    loaded = load_vector(filepath, [], False, None, None, None, columns=['value', 'x', 'y'])
+    assert list(loaded.columns) == ['value', 'x', 'y']
+
+    loaded = load_vector(filepath, [], False, None, None, (10, 10, 20, 20))
+    expected = df[(df.x >= 10) & (df.x <= 20) & (df.y >= 10) & (df.y <= 20)]
+    pd.testing.assert_frame_equal(loaded, expected)
+
+
+def test_load_vector_geo_arrow(tmp_path):
+    all_countries = gpd.read_file(gpd.datasets.get_path('naturalearth_lowres'))
+    filepath = str(tmp_path / 'countries.feather')
+    all_countries.to_feather(filepath)
+
+    loaded = load_vector(filepath, [], False, None, 'geometry', (0, 40, 10, 50),
+                         columns=['name'])
+    assert isinstance(loaded, gpd.GeoDataFrame)
+    assert list(loaded.columns) == ['name', 'geometry']
+    expected = all_countries.cx[0:10, 40:50]
+    assert sorted(loaded['name']) == sorted(expected['name'])
@@ -0,0 +1,158 @@
+import os
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from mapshader.core import render_map
+from mapshader.services import get_services
+from mapshader.shared_data import attach_source
+from mapshader.shared_data import preload_shared_data
+from mapshader.shared_data import publish_source
+from mapshader.sources import MapSource
+from mapshader.sources import elevation_source
+from mapshader.sources import world_countries_source
+
+
+def _points_source(tmp_path):
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(dict(x=rng.uniform(-2e7, 2e7, 1000), y=rng.uniform(-2e7, 2e7, 1000),
+                           value=rng.random(1000)))
+    filepath = str(tmp_path / 'points.parquet')
+    df.to_parquet(filepath)
+    return dict(
+        name='Points', key='points', geometry_type='point', filepath=filepath,
+        xfield='x', yfield='y', zfield='value', agg_func='sum', geometry_field=None,
+        service_types=['tile'], preload=True,
+        transforms=[dict(name='load_in_memory'),
+                    dict(name='compact_points', args=dict(xfield='x', yfield='y'))],
+    )
+
+
+def test_publish_attach_points(tmp_path):
+    shared_dir = str(tmp_path / 'shared')
+    source_obj = _points_source(tmp_path)
+
+    source = MapSource.from_obj(source_obj).load()
+    assert publish_source(source, shared_dir)
+    assert len(os.listdir(shared_dir)) == 1
+
+    attached = MapSource.from_obj(source_obj, autoload=False)
+    assert attach_source(attached, shared_dir)
+    assert attached.is_loaded
+    # the data is a read-only view of the published file
+    assert not attached.data['x'].values.flags.writeable
+    pd.testing.assert_frame_equal(attached.data, source.data.reset_index(drop=True))
+
+    expected = render_map(source, x=1, y=0, z=1)
+    img = render_map(attached, x=1, y=0, z=1)
+    np.testing.assert_array_equal(img.data, expected.data)
+
+    # sources with other options are not attached
+    source_obj['transforms'] = source_obj['transforms'][:1]
+    assert not attach_source(MapSource.from_obj(source_obj, autoload=False), shared_dir)
+
+
+def test_publish_attach_raster(tmp_path):
+    shared_dir = str(tmp_path / 'shared')
+    source = MapSource.from_obj(elevation_source()).load()
+    assert publish_source(source, shared_dir)
+
+    attached = MapSource.from_obj(elevation_source(), autoload=False)
+    assert attach_source(attached, shared_dir)
+    assert not attached.data.values.flags.writeable
+    np.testing.assert_array_equal(attached.data.values, source.data.values)
+    np.testing.assert_array_equal(attached.data.x, source.data.x)
+    assert attached.data.rio.crs == source.data.rio.crs
+    assert sorted(attached.overviews) == sorted(source.overviews)
+
+    expected = render_map(source, x=0, y=0, z=0)
+    img = render_map(attached, x=0, y=0, z=0)
+    np.testing.assert_array_equal(img.data, expected.data)
+
+
+def test_publish_attach_breaks(tmp_path, monkeypatch):
+    shared_dir = str(tmp_path / 'shared')
+    source_obj = elevation_source()
+    source_obj['shade_how'] = 'eq_hist'
+    source_obj['span'] = None
+    source = MapSource.from_obj(source_obj).load()
+    assert publish_source(source, shared_dir)
+
+    # attaching processes reuse the breaks sampled by the publishing one
+    def fail(*args, **kwargs):
+        raise AssertionError('sampled the breaks again')
+    monkeypatch.setattr('mapshader.core._sample_values', fail)
+    attached = MapSource.from_obj(source_obj, autoload=False)
+    assert attach_source(attached, shared_dir)
+    assert attached.statistics == source.statistics
+
+    expected = render_map(source, x=1, y=1, z=2, height=256, width=256)
+    img = render_map(attached, x=1, y=1, z=2, height=256, width=256)
+    np.testing.assert_array_equal(img.data, expected.data)
+
+
+def test_publish_attach_hillshade(tmp_path, monkeypatch):
+    shared_dir = str(tmp_path / 'shared')
+    source_obj = elevation_source()
+    source_obj['extras'] = ['hillshade']
+    source = MapSource.from_obj(source_obj).load()
+    assert source.hillshade_overviews
+    assert publish_source(source, shared_dir)
+
+    # attaching processes map the pyramid rather than computing it
+    def fail(*args, **kwargs):
+        raise AssertionError('computed the hillshade pyramid again')
+    monkeypatch.setattr('mapshader.core._tile_hillshade', fail)
+    attached = MapSource.from_obj(source_obj, autoload=False)
+    assert attach_source(attached, shared_dir)
+    assert sorted(attached.hillshade_overviews) == sorted(source.hillshade_overviews)
+    for z, level in source.hillshade_overviews.items():
+        assert sorted(attached.hillshade_overviews[z]) == sorted(level)
+        for tile, expected in level.items():
+            hillshade = attached.hillshade_overviews[z][tile]
+            assert not hillshade.values.flags.writeable
+            xr.testing.assert_identical(hillshade, expected)
+
+    img = render_map(attached, x=1, y=1, z=2, height=256, width=256)
+    monkeypatch.undo()
+    expected = render_map(source, x=1, y=1, z=2, height=256, width=256)
+    np.testing.assert_array_equal(img.data, expected.data)
+
+    # a pyramid computed with another span is not attached
+    source_obj['span'] = (100, 200)
+    restyled = MapSource.from_obj(source_obj, autoload=False)
+    assert attach_source(restyled, shared_dir)
+    tile = next(iter(restyled.hillshade_overviews[2]))
+    assert restyled.hillshade_overviews[2][tile].values.flags.writeable
+
+
+def test_geometry_data_not_published(tmp_path, capsys):
+    source = MapSource.from_obj(world_countries_source()).load()
+    capsys.readouterr()
+    assert not publish_source(source, str(tmp_path))
+    # skipped sources are logged as loaded by every process
+    assert 'Not publishing World Countries' in capsys.readouterr().out
+
+
+def test_get_services_shared_data(tmp_path):
+    shared_dir = str(tmp_path / 'shared')
+    sources = [_points_source(tmp_path)]
+
+    services = list(get_services(sources=sources, shared_data_dir=shared_dir))
+    assert services[0].source.is_loaded
+    assert len(os.listdir(shared_dir)) == 1
+
+    services = list(get_services(sources=sources, shared_data_dir=shared_dir))
+    assert not services[0].source.data['x'].values.flags.writeable
+
+
+def test_preload_shared_data(tmp_path):
+    shared_dir = str(tmp_path / 'shared')
+    sources = [_points_source(tmp_path)]
+
+    preload_shared_data(shared_dir, sources=sources)
+    assert len(os.listdir(shared_dir)) == 1
+
+    source = MapSource.from_obj(sources[0], autoload=False)
+    assert attach_source(source, shared_dir)
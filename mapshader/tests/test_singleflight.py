@@ -0,0 +1,62 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+import time
+
+import pytest
+
+from mapshader.singleflight import AsyncSingleFlight, SingleFlight
+
+
+def test_single_flight_coalesces_concurrent_calls():
+    flight = SingleFlight()
+    started = Event()
+    calls = []
+
+    def render(key):
+        calls.append(key)
+        started.set()
+        time.sleep(0.2)
+        return f'tile {key}'
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        first = executor.submit(flight.do, 'a', render, 'a')
+        started.wait()
+        others = [executor.submit(flight.do, 'a', render, 'a') for _ in range(3)]
+        results = [f.result() for f in [first] + others]
+
+    assert results == ['tile a'] * 4
+    assert calls == ['a']
+    assert flight.stats() == dict(leaders=1, coalesced=3, in_flight=0)
+
+    # once finished, a new call renders again
+    assert flight.do('a', render, 'a') == 'tile a'
+    assert calls == ['a', 'a']
+
+
+def test_single_flight_shares_errors():
+    flight = SingleFlight()
+
+    def fail():
+        raise ValueError('bad tile')
+
+    with pytest.raises(ValueError):
+        flight.do('a', fail)
+    assert flight.stats()['in_flight'] == 0
+
+
+def test_async_single_flight_coalesces_concurrent_calls():
+    flight = AsyncSingleFlight()
+    calls = []
+
+    async def render(key):
+        calls.append(key)
+        await asyncio.sleep(0.05)
+        return f'tile {key}'
+
+    async def main():
+        return await asyncio.gather(*[flight.do(k, render, k) for k in 'aaab'])
+
+    assert asyncio.run(main()) == ['tile a', 'tile a', 'tile a', 'tile b']
+    assert calls == ['a', 'b']
+    assert flight.stats() == dict(leaders=2, coalesced=2, in_flight=0)
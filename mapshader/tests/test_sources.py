@@ -1,20 +1,33 @@
+from concurrent.futures import ThreadPoolExecutor
 from os import path
+from threading import Event
+import time
 
+import numpy as np
+import pandas as pd
+import pyarrow.feather as feather
 import xarray as xr
 
 import pytest
 
 import geopandas as gpd
 
+import mapshader.sources
+
 from mapshader.sources import MapSource
+from mapshader.sources import SharedTransforms
+from mapshader.sources import SourceNotReadyError
+from mapshader.sources import load_sources
 from mapshader.sources import VectorSource
 
+from mapshader.sources import world_boundaries_source
 from mapshader.sources import world_countries_source
 from mapshader.sources import world_cities_source
 from mapshader.sources import nybb_source
 from mapshader.sources import elevation_source
 
 from mapshader.core import to_raster
+from mapshader.services import get_services
 
 HERE = path.abspath(path.dirname(__file__))
 FIXTURES_DIR = path.join(HERE, 'fixtures')
@@ -63,3 +76,148 @@ def test_create_map_source_with_existing_geodataframe():
 
     arr = to_raster(source, width=100)
     assert isinstance(arr, xr.DataArray)
+
+
+def test_concurrent_load_runs_once(monkeypatch):
+    source = MapSource.from_obj(nybb_source())
+    finish_load = source._finish_load
+    calls = []
+
+    def slow_finish_load():
+        calls.append(1)
+        time.sleep(0.2)
+        finish_load()
+
+    monkeypatch.setattr(source, '_finish_load', slow_finish_load)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(lambda _: source.load(), range(4)))
+
+    assert len(calls) == 1
+    assert all(r is source for r in results)
+    assert source.is_loaded
+    assert source.load_state == 'loaded'
+
+
+def test_load_timeout_while_loading(monkeypatch):
+    source = MapSource.from_obj(nybb_source())
+    finish_load = source._finish_load
+    started = Event()
+
+    def slow_finish_load():
+        started.set()
+        time.sleep(0.5)
+        finish_load()
+
+    monkeypatch.setattr(source, '_finish_load', slow_finish_load)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(source.load)
+        started.wait()
+        assert source.load_state == 'loading'
+        with pytest.raises(SourceNotReadyError):
+            source.load(timeout=0)
+        future.result()
+
+    assert source.load_state == 'loaded'
+
+
+def test_failed_load_state():
+    source_obj = nybb_source()
+    source_obj['filepath'] = path.join(FIXTURES_DIR, 'missing.shp')
+    source = MapSource.from_obj(source_obj)
+
+    with pytest.raises(Exception):
+        source.load()
+    assert source.load_state == 'failed'
+    assert source.load_error
+    assert not source.is_loaded
+
+
+def test_autoload_deferred():
+    source = MapSource.from_obj(world_countries_source(), autoload=False)
+    assert source.needs_preload
+    assert not source.is_loaded
+
+    source = MapSource.from_obj(world_countries_source())
+    assert source.is_loaded
+
+
+@pytest.mark.parametrize("background", [False, True])
+def test_load_sources(background):
+    sources = [MapSource.from_obj(func(), autoload=False) for func in DEFAULT_SOURCES_FUNCS]
+
+    futures = load_sources(sources, max_workers=2, background=background)
+    assert [f.result() for f in futures] == sources
+    assert all(s.is_loaded for s in sources)
+
+
+def test_get_services_background_load():
+    services = list(get_services(load_workers=2, background_load=True))
+    preloaded = [s.source for s in services if s.source.needs_preload]
+    assert preloaded
+
+    # requests wait for a source that is still loading in the background
+    for source in preloaded:
+        assert source.load().is_loaded
+
+
+def test_fields_memory_mapped(tmp_path):
+    n = 100
+    df = pd.DataFrame(dict(x=np.arange(n, dtype='f8'), y=np.arange(n, dtype='f8'),
+                           value=np.arange(n), name=np.arange(n).astype(str)))
+    filepath = str(tmp_path / 'points.arrow')
+    feather.write_feather(df, filepath, compression='uncompressed', chunksize=n)
+
+    # the fields are read from the memory-mapped file without copying
+    source = MapSource.from_obj(dict(
+        name='Points', key='points', geometry_type='point', filepath=filepath,
+        xfield='x', yfield='y', zfield='value', geometry_field=None,
+        fields=['value', 'x', 'y'],
+    )).load()
+    assert list(source.data.columns) == ['value', 'x', 'y']
+    assert not source.data['x'].values.flags.writeable
+
+
+def test_shared_transforms(monkeypatch):
+    loads = []
+
+    def counting_load_vector(*args, **kwargs):
+        loads.append(args[0])
+        return load_vector(*args, **kwargs)
+
+    load_vector = mapshader.sources.load_vector
+    monkeypatch.setattr(mapshader.sources, 'load_vector', counting_load_vector)
+
+    def create_sources():
+        # countries share the select and reproject transforms, boundaries
+        # only share the select transform with them
+        countries_obj = world_countries_source()
+        other_countries_obj = world_countries_source()
+        other_countries_obj['key'] = 'other-world-countries'
+        other_countries_obj['transforms'] = countries_obj['transforms'][:2]
+        return [MapSource.from_obj(obj, autoload=False) for obj in
+                (countries_obj, other_countries_obj, world_boundaries_source())]
+
+    unshared = create_sources()
+    for source in unshared:
+        source.load()
+    assert len(loads) == 3
+
+    sources = create_sources()
+    shared, = SharedTransforms.share(sources)
+    assert [t['name'] for t in shared.transforms] == ['select_by_attributes']
+    assert shared.users == 2
+    assert sources[0]._shared is sources[1]._shared
+    assert sources[0]._shared.parent is shared
+    assert sources[2]._shared is shared
+
+    loads.clear()
+    load_sources(sources, max_workers=3)
+    assert len(loads) == 1
+    assert shared.users == 0
+
+    # shared data is not modified by the transforms of other sources
+    for source, unshared_source in zip(sources, unshared):
+        assert source.data.equals(unshared_source.data)
+        assert sorted(source.overviews) == sorted(unshared_source.overviews)
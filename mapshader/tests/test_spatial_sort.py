@@ -0,0 +1,93 @@
+import json
+from os import path
+
+from click.testing import CliRunner
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+import pytest
+
+from mapshader.commands.spatial_sort import spatial_sort
+from mapshader.io import load_vector
+from mapshader.io import parquet_partition_index
+from mapshader.spatial_sort import spatial_codes
+from mapshader.spatial_sort import INDEX_SUFFIX
+
+
+def test_hilbert_codes_are_adjacent():
+    # consecutive hilbert codes are neighbouring cells
+    bits = 3
+    n = 1 << bits
+    x, y = np.meshgrid(np.arange(n), np.arange(n))
+    codes = spatial_codes(x.ravel() + 0.5, y.ravel() + 0.5, 'hilbert', (0, 0, n, n), bits)
+
+    assert sorted(codes) == list(range(n * n))
+    order = np.argsort(codes)
+    steps = np.abs(np.diff(x.ravel()[order])) + np.abs(np.diff(y.ravel()[order]))
+    assert (steps == 1).all()
+
+
+def test_morton_codes():
+    codes = spatial_codes([0.5, 1.5, 0.5, 1.5], [0.5, 0.5, 1.5, 1.5], 'morton', (0, 0, 4, 4), 2)
+    np.testing.assert_array_equal(codes, [0, 1, 2, 3])
+
+
+def test_invalid_curve():
+    with pytest.raises(ValueError):
+        spatial_codes([0], [0], 'peano')
+
+
+@pytest.mark.parametrize("curve", ['hilbert', 'morton'])
+def test_spatial_sort_points(tmp_path, curve):
+    rng = np.random.default_rng(0)
+    n = 10000
+    df = pd.DataFrame(dict(x=rng.uniform(-2e7, 2e7, n), y=rng.uniform(-2e7, 2e7, n),
+                           value=np.arange(n)))
+    input_file = str(tmp_path / 'points.parquet')
+    output_file = str(tmp_path / 'sorted.parquet')
+    df.to_parquet(input_file)
+
+    result = CliRunner().invoke(spatial_sort, [
+        input_file, '-o', output_file, '--curve', curve,
+        '--xfield', 'x', '--yfield', 'y', '--row_group_size', '1000',
+    ], standalone_mode=False)
+    assert result.exception is None
+
+    sorted_df = pd.read_parquet(output_file)
+    assert sorted(sorted_df['value']) == list(range(n))
+
+    with open(output_file + INDEX_SUFFIX) as f:
+        index = json.load(f)
+    assert len(index['row_groups']) == 10
+
+    # sorted row groups cover a small part of the extent each
+    partition_index = parquet_partition_index(output_file, 'x', 'y')
+    areas = ((partition_index.xmax - partition_index.xmin) *
+             (partition_index.ymax - partition_index.ymin))
+    assert areas.max() < 0.5 * 4e7 * 4e7
+
+    region = (0, 0, 1e7, 1e7)
+    loaded = load_vector(output_file, [], False, None, None, region, xfield='x', yfield='y')
+    assert loaded.npartitions < 10
+    expected = df[(df.x >= 0) & (df.x <= 1e7) & (df.y >= 0) & (df.y <= 1e7)]
+    assert sorted(loaded.compute()['value']) == sorted(expected['value'])
+
+
+def test_spatial_sort_polygons(tmp_path):
+    input_file = gpd.datasets.get_path('naturalearth_lowres')
+    output_file = str(tmp_path / 'countries.parquet')
+
+    result = CliRunner().invoke(spatial_sort, [
+        input_file, '-o', output_file, '--row_group_size', '20',
+    ], standalone_mode=False)
+    assert result.exception is None
+    assert path.exists(output_file + INDEX_SUFFIX)
+
+    countries = gpd.read_parquet(output_file)
+    assert countries.crs.to_epsg() == 3857
+
+    # the sidecar index covers the polygon bounds
+    partition_index = parquet_partition_index(output_file, 'x', 'y')
+    assert len(partition_index) == int(np.ceil(len(countries) / 20))
+    assert partition_index.xmin.min() == countries.total_bounds[0]
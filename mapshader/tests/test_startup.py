@@ -0,0 +1,39 @@
+import json
+import subprocess
+import sys
+
+import pytest
+
+
+def _imported_modules(statement):
+    # modules imported by a statement in a fresh interpreter
+    script = f'{statement}\nimport json, sys\nprint(json.dumps(sorted(sys.modules)))'
+    output = subprocess.run([sys.executable, '-W', 'ignore', '-c', script],
+                            check=True, capture_output=True, text=True).stdout
+    return set(json.loads(output.splitlines()[-1]))
+
+
+@pytest.mark.parametrize("command", [
+    'build_raster_overviews', 'examples', 'serve', 'spatial_sort', 'tif_to_netcdf', 'tile',
+])
+def test_commands_import_lazily(command):
+    modules = _imported_modules(f'import mapshader.commands.{command}')
+    heavy = {'bokeh', 'datashader', 'geopandas', 'flask', 'xarray', 'numba'}
+    assert not heavy & modules
+
+
+def test_sources_do_not_import_bokeh():
+    modules = _imported_modules('import mapshader.sources')
+    assert 'bokeh' not in modules
+
+
+def test_services_import_lazily():
+    # the rendering and shared data stacks are imported when used
+    modules = _imported_modules('import mapshader.services')
+    assert not {'mapshader.core', 'mapshader.shared_data', 'pyarrow.feather'} & modules
+
+
+def test_server_does_not_import_tiling():
+    modules = _imported_modules('import mapshader.flask_app')
+    assert 'mapshader.tile_utils' not in modules
+    assert 'bokeh.plotting' not in modules
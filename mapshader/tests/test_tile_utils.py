@@ -1,6 +1,11 @@
+import json
+from os import path
+
 import pytest
 
 import numpy as np
+import pandas as pd
+import dask.dataframe as dd
 
 import datashader as ds
 import geopandas as gpd
@@ -8,13 +13,15 @@ from pyproj import CRS
 import spatialpandas as spd
 from shapely.geometry import Polygon, Point, LineString
 
-from mapshader.sources import VectorSource, RasterSource
+from mapshader.sources import MapSource, VectorSource, RasterSource
+from mapshader.sources import nybb_source
 
 from mapshader.tile_utils import (
     get_tile,
     render_tiles_by_extent,
     get_tiles_by_extent,
     list_tiles,
+    save_tiles_to_outpath,
 )
 
 ZOOM_LEVELS_1_8 = range(1, 8)
@@ -352,3 +359,25 @@ def test_list_tiles_line_vector(line_vector_source):
 def test_list_tiles_line_raster(line_raster_source):
     line_source, minz, maxz = line_raster_source
     _test_list_tiles_line_geometry(line_source, minz, maxz)
+
+
+@pytest.mark.parametrize("empty_tiles", ['skip', 'blob'])
+def test_save_tiles_to_outpath_coverage(tmp_path, empty_tiles):
+    source = MapSource.from_obj(nybb_source()).load()
+    outpath = str(tmp_path)
+
+    # (0, 3, 3) is over the Pacific Ocean and renders empty
+    tiles_df = pd.DataFrame(dict(x=[0, 0], y=[0, 3], z=[0, 3], q=['', '002']))
+    tiles_ddf = dd.from_pandas(tiles_df, npartitions=2)
+
+    result = save_tiles_to_outpath(source, tiles_ddf, outpath, empty_tiles=empty_tiles)
+    assert result['written'].tolist() == [True, False]
+
+    assert path.isfile(path.join(outpath, '0', '0', '0.png'))
+    assert not path.exists(path.join(outpath, '3'))
+    assert path.isfile(path.join(outpath, 'empty.png')) == (empty_tiles == 'blob')
+
+    with open(path.join(outpath, 'coverage.json')) as f:
+        coverage = json.load(f)
+    assert coverage['tiles'] == [[0, 0, 0]]
+    assert coverage['total'] == 2
@@ -0,0 +1,126 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from mapshader.sources import MapSource
+from mapshader.sources import VectorSource
+from mapshader.sources import elevation_source
+from mapshader.sources import world_countries_source
+from mapshader.transform_cache import read_statistics
+from mapshader.transform_cache import read_transformed
+from mapshader.transform_cache import transform_cache_key
+from mapshader.transform_cache import write_transformed
+from mapshader.transforms import compact_points
+from mapshader.transforms import xy_origin
+
+
+def test_transform_cache_key(tmp_path):
+    data_path = tmp_path / 'data.csv'
+    data_path.write_text('x,y\n0,0\n')
+    transforms = [dict(name='reproject_vector', args=dict(epsg=3857))]
+
+    key = transform_cache_key(str(data_path), transforms)
+    assert key == transform_cache_key(str(data_path), transforms)
+    assert key != transform_cache_key(str(data_path), [])
+    assert key != transform_cache_key(str(data_path), transforms, fields=['x'])
+
+    data_path.write_text('x,y\n0,0\n1,1\n')
+    assert key != transform_cache_key(str(data_path), transforms)
+
+    assert transform_cache_key(str(tmp_path / 'missing.csv'), transforms) is None
+
+
+def test_vector_transform_cache(tmp_path, monkeypatch):
+    source_obj = world_countries_source()
+    source_obj['cache_dir'] = str(tmp_path)
+
+    source = MapSource.from_obj(source_obj).load()
+    entries = os.listdir(tmp_path)
+    assert len(entries) == 1
+    assert entries[0].startswith('world-countries.')
+
+    cached = MapSource.from_obj(source_obj)
+    # the transforms are not applied again to the cached data
+    cached._apply_transforms = None
+    cached.load()
+
+    assert type(cached.data) is type(source.data)
+    assert cached.data.equals(source.data)
+    assert sorted(cached.overviews) == sorted(source.overviews)
+    for level, overview in source.overviews.items():
+        assert cached.overviews[level].equals(overview)
+
+    # the cached data is indexed like freshly loaded data
+    indexed = []
+    monkeypatch.setattr(VectorSource, '_index_partitions',
+                        lambda self, data_path: indexed.append(data_path))
+    cached = MapSource.from_obj(source_obj).load()
+    assert indexed == [cached._data_path()]
+
+    # changing the transforms replaces the stale entry
+    source_obj['transforms'] = source_obj['transforms'][1:]
+    MapSource.from_obj(source_obj).load()
+    new_entries = os.listdir(tmp_path)
+    assert len(new_entries) == 1
+    assert new_entries != entries
+
+
+def test_raster_transform_cache(tmp_path):
+    source_obj = elevation_source()
+    source_obj['cache_dir'] = str(tmp_path)
+
+    source = MapSource.from_obj(source_obj).load()
+    entry_dir = os.path.join(tmp_path, os.listdir(tmp_path)[0])
+    data, overviews = read_transformed(entry_dir)
+
+    assert data.name == source.data.name
+    assert data.dims == source.data.dims
+    np.testing.assert_array_equal(data.x, source.data.x)
+    np.testing.assert_array_equal(data.y, source.data.y)
+    np.testing.assert_array_equal(data.values, source.data.values)
+    assert data.rio.crs == source.data.rio.crs
+    assert sorted(overviews) == sorted(source.overviews)
+
+
+def test_breaks_transform_cache(tmp_path, monkeypatch):
+    source_obj = elevation_source()
+    source_obj['cache_dir'] = str(tmp_path)
+    source_obj['shade_how'] = 'eq_hist'
+    source_obj['span'] = None
+
+    source = MapSource.from_obj(source_obj).load()
+    entry_dir = os.path.join(tmp_path, os.listdir(tmp_path)[0])
+    assert len(read_statistics(entry_dir)['breaks']['breaks']) == 8
+
+    # loading the cached data reuses the breaks sampled before
+    def fail(*args, **kwargs):
+        raise AssertionError('sampled the breaks again')
+    monkeypatch.setattr('mapshader.core._sample_values', fail)
+    cached = MapSource.from_obj(source_obj).load()
+    assert cached.statistics[('breaks', 2, 256)] == source.statistics[('breaks', 2, 256)]
+
+    # breaks of other classes are sampled and stored along the ones before
+    monkeypatch.undo()
+    source_obj['shade_how'] = 'linear'
+    source_obj['extras'] = ['quantile']
+    quantile = MapSource.from_obj(source_obj).load()
+    assert ('breaks', 2, 4) in quantile.statistics
+    assert len(read_statistics(entry_dir)['breaks']['breaks']) == 16
+
+    # breaks of other aggregates are not reused
+    source_obj['agg_func'] = 'max'
+    other = MapSource.from_obj(source_obj).load()
+    assert ('breaks', 2, 256) not in other.statistics
+
+
+def test_compacted_points_transform_cache(tmp_path):
+    df = pd.DataFrame(dict(x=np.arange(10.) + 1e6, y=np.arange(10.) - 1e6))
+    compacted = compact_points(df, 'x', 'y')
+
+    entry_dir = str(tmp_path / 'entry')
+    assert write_transformed(entry_dir, compacted, {})
+    data, _ = read_transformed(entry_dir)
+
+    assert data.equals(compacted)
+    assert tuple(xy_origin(data)) == (1e6, -1e6)
@@ -1,20 +1,96 @@
-# import json
-# from os import path
+import numpy as np
+import pandas as pd
+import xarray as xr
 
-# from io import BytesIO
+import pytest
 
-# import pytest
+from mapshader.sources import MapSource
+from mapshader.sources import elevation_source
+from mapshader.transforms import compact_points
+from mapshader.transforms import get_transform_by_name
+from mapshader.transforms import plan_transforms
+from mapshader.transforms import xy_origin
+from mapshader.transforms import XY_ORIGIN_ATTR
 
-# import xarray as xr
 
-# from datashader.transfer_functions import Image
+def _stage_names(stages):
+    return [[t['name'] for t in stage] for stage in stages]
 
-# from mapshader.sources import MapSource
-# from mapshader.core import render_map
-# from mapshader.core import render_geojson
 
-# from mapshader.sources import elevation_source
+def test_plan_fuses_raster_transforms():
+    transforms = elevation_source()['transforms']
+    stages = plan_transforms(transforms, 'float64')
+    assert _stage_names(stages) == [
+        ['squeeze', 'cast', 'orient_array', 'flip_coords'],
+        ['reproject_raster'],
+        ['build_raster_overviews'],
+    ]
 
-# from mapshader.tests.data import DEFAULT_SOURCES_FUNCS
 
-# TODO: add transform tests (test_transforms.py)
+def test_plan_defers_widening_cast():
+    transforms = elevation_source()['transforms']
+    stages = plan_transforms(transforms, 'float32')
+    assert _stage_names(stages) == [
+        ['squeeze', 'orient_array', 'flip_coords'],
+        ['reproject_raster'],
+        ['cast'],
+        ['build_raster_overviews'],
+    ]
+
+
+@pytest.mark.parametrize("dtype", ['int16', None])
+def test_plan_keeps_cast_in_place(dtype):
+    transforms = elevation_source()['transforms']
+    stages = plan_transforms(transforms, dtype)
+    assert [t for stage in stages for t in stage] == transforms
+
+
+def test_plan_runs_deferred_cast_before_other_transforms():
+    transforms = [dict(name='cast', args=dict(dtype='float64')),
+                  dict(name='squeeze', args=dict(dim='band')),
+                  dict(name='cast', args=dict(dtype='float16')),
+                  dict(name='reproject_raster', args=dict(epsg=3857))]
+    stages = plan_transforms(transforms, 'float32')
+    assert [t for stage in stages for t in stage] == [transforms[1], transforms[0],
+                                                      transforms[2], transforms[3]]
+
+
+def test_planned_transforms_match_sequential():
+    source_obj = elevation_source()
+    arr = xr.open_rasterio(source_obj['filepath']).astype('float32')
+
+    expected = arr.copy()
+    for trans in source_obj['transforms']:
+        if 'overviews' not in trans['name']:
+            func = get_transform_by_name(trans['name'])
+            expected = func(expected, **trans.get('args', {}))
+
+    source_obj['filepath'] = None
+    source_obj['data'] = arr.copy()
+    source = MapSource.from_obj(source_obj).load()
+
+    assert source.data.dtype == expected.dtype
+    np.testing.assert_array_equal(source.data.values, expected.values)
+    assert source.transform_peak_memory > 0
+
+
+def test_compact_points():
+    n = 1000
+    df = pd.DataFrame(dict(x=np.linspace(-1e7, -9e6, n), y=np.linspace(4e6, 5e6, n),
+                           z=np.arange(n, dtype='float64'), id=np.arange(n, dtype='int64'),
+                           category=np.array(['a', 'b'], dtype=object)[np.arange(n) % 2]))
+    compacted = compact_points(df.copy(), 'x', 'y', 'z')
+
+    assert compacted.attrs[XY_ORIGIN_ATTR] == (-1e7, 4e6)
+    assert compacted['x'].dtype == 'float32'
+    assert compacted['z'].dtype == 'float32'
+    assert compacted['id'].dtype == 'uint16'
+    assert compacted['category'].dtype == 'category'
+    assert compacted.memory_usage(deep=True).sum() < df.memory_usage(deep=True).sum() / 2
+
+    x0, y0 = xy_origin(compacted)
+    np.testing.assert_allclose(compacted['x'] + x0, df['x'], atol=0.1)
+    np.testing.assert_allclose(compacted['y'] + y0, df['y'], atol=0.1)
+
+    # compacting again keeps the origin of the extent
+    assert xy_origin(compact_points(compacted, 'x', 'y', 'z')) == (x0, y0)
@@ -15,7 +15,7 @@ try:
 except ImportError:
     import urllib as urlrequest  # NOQA
 
-from .core import render_tile
+from .core import render_tile, write_coverage_index, write_empty_tile
 
 EARTH_RADIUS = 6378137
 MIN_LAT = -85.05112878
@@ -33,7 +33,7 @@ templates = {}
 templates["osm"] = "https://c.tile.openstreetmap.org/{{z}}/{{x}}/{{y}}.png"
 
 
-ngjit = jit(nopython=True, nogil=True)
+ngjit = jit(nopython=True, nogil=True, cache=True)
 
 
 def normalize_url_template(template):
@@ -465,27 +465,45 @@ def list_tiles(source, npartitions=200):
     return tiles_ddf
 
 
-def save_tiles_to_outpath(source, tiles_ddf, outpath):
+def save_tiles_to_outpath(source, tiles_ddf, outpath, tile_format='png', empty_tiles='skip'):
     """
     Save tile images of a source object to an output location.
 
+    Fully transparent tiles are not encoded unless ``empty_tiles`` is
+    ``write``, and a ``coverage.json`` index listing the written tiles
+    is saved next to them.
+
     Parameters
     ----------
     source (MapSource): source object.
     tiles_ddf (dask.DataFrame): table of tiles to generate.
     outpath (str): output location, can be a folder in local disk, or an S3 bucket.
+    tile_format (str): image format of the tiles.
+    empty_tiles (str): ``skip``, ``blob`` or ``write``, see ``core.render_tile``.
 
     Returns
     -------
-    None
+    tiles_df: pandas.DataFrame
+        The tiles with a boolean ``written`` column.
     """
 
     def tile_partition(df, output_location, source=None):
         def tile_row(row):
-            _ = render_tile(source, output_location, x=row["x"], y=row["y"], z=row["z"])
-            return True
+            output = render_tile(source, output_location, x=row["x"], y=row["y"], z=row["z"],
+                                 tile_format=tile_format, empty_tiles=empty_tiles)
+            return output is not None
+
+        written = df.apply(tile_row, axis=1) if len(df) else pd.Series([], dtype=bool)
+        return df.assign(written=written.astype(bool))
 
-        return df.apply(tile_row, axis=1)
+    if empty_tiles == 'blob':
+        write_empty_tile(outpath, tile_format)
 
     # Map render_tile across tile partitions
-    tiles_ddf.map_partitions(tile_partition, source=source, output_location=outpath).compute()
+    meta = tiles_ddf._meta.assign(written=pd.Series([], dtype=bool))
+    tiles_df = tiles_ddf.map_partitions(
+        tile_partition, source=source, output_location=outpath, meta=meta
+    ).compute()
+
+    write_coverage_index(tiles_df, outpath, tile_format, empty_tiles)
+    return tiles_df
@@ -0,0 +1,257 @@
+import hashlib
+import json
+import os
+import shutil
+import sys
+import uuid
+
+import pandas as pd
+import geopandas as gpd
+import spatialpandas
+import spatialpandas.io
+import xarray as xr
+
+
+# Bump when the layout of cache entries changes so old entries are ignored.
+CACHE_VERSION = 1
+
+MANIFEST_FILENAME = 'manifest.json'
+
+STATISTICS_FILENAME = 'statistics.json'
+
+
+def transform_cache_key(data_path, transforms, **params):
+    """
+    Hash a data file and the transforms applied to it into a cache key.
+
+    The file is identified by its absolute path, modification time and
+    size rather than by its content, so computing the key does not read
+    the (possibly large) file.
+
+    Parameters
+    ----------
+    data_path : str
+        Path to the local data file.
+    transforms : list of dict
+        The transforms applied to the data.
+    **params
+        Any other loading options that change the transformed data,
+        e.g. the selected fields.
+
+    Returns
+    -------
+    key : str or None
+        Hex digest of the inputs, or None if ``data_path`` is not a
+        local file and cannot be cached.
+    """
+    if not os.path.isfile(data_path):
+        return None
+
+    stat = os.stat(data_path)
+    inputs = dict(
+        version=CACHE_VERSION,
+        path=os.path.abspath(data_path),
+        mtime=stat.st_mtime_ns,
+        size=stat.st_size,
+        transforms=transforms,
+        params=params,
+    )
+    canonical = json.dumps(inputs, sort_keys=True, default=str)
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
+def _data_kind(data):
+    if isinstance(data, spatialpandas.GeoDataFrame):
+        return 'spatialpandas', '.parquet'
+    elif isinstance(data, gpd.GeoDataFrame):
+        return 'geopandas', '.parquet'
+    elif isinstance(data, pd.DataFrame):
+        return 'pandas', '.parquet'
+    elif isinstance(data, xr.DataArray):
+        return 'xarray', '.nc'
+    return None, None
+
+
+def _write_data(data, kind, filepath):
+    if kind == 'xarray':
+        # the variable name is usually the source file path, which is
+        # not a valid netCDF variable name
+        data.rename('data').to_netcdf(filepath)
+    else:
+        data.to_parquet(filepath)
+
+
+def _read_data(kind, filepath, name=None, attrs=None):
+    if kind == 'spatialpandas':
+        return spatialpandas.io.read_parquet(filepath)
+    elif kind == 'geopandas':
+        return gpd.read_parquet(filepath)
+    elif kind == 'pandas':
+        data = pd.read_parquet(filepath)
+        # parquet does not keep the attributes, e.g. of compacted points
+        data.attrs.update(attrs or {})
+        return data
+    else:
+        arr = xr.open_dataset(filepath, decode_coords='all')['data']
+        arr.name = name
+        return arr
+
+
+def read_transformed(entry_dir):
+    """
+    Read transformed data and overviews from a cache entry.
+
+    Parameters
+    ----------
+    entry_dir : str
+        The cache entry directory.
+
+    Returns
+    -------
+    data, overviews : tuple or None
+        The cached data and overviews dict, or None if there is no
+        complete entry in ``entry_dir``.
+    """
+    manifest_path = os.path.join(entry_dir, MANIFEST_FILENAME)
+    if not os.path.isfile(manifest_path):
+        return None
+
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+
+    kind = manifest['kind']
+    name = manifest.get('name')
+    attrs = manifest.get('attrs')
+    data = _read_data(kind, os.path.join(entry_dir, manifest['data']), name, attrs)
+    overviews = {}
+    for level, filename in manifest['overviews']:
+        overviews[level] = _read_data(kind, os.path.join(entry_dir, filename), name, attrs)
+
+    return data, overviews
+
+
+def write_transformed(entry_dir, data, overviews):
+    """
+    Write transformed data and overviews to a cache entry.
+
+    The entry is written to a temporary directory first and renamed
+    into place, so readers never see a partially written entry.
+
+    Parameters
+    ----------
+    entry_dir : str
+        The cache entry directory.
+    data : spatialpandas.GeoDataFrame, geopandas.GeoDataFrame,
+           pandas.DataFrame or xarray.DataArray
+        The transformed data.
+    overviews : dict
+        The transformed overviews, keyed by level.
+
+    Returns
+    -------
+    written : bool
+        Whether the entry was written. Data of other types, such as
+        lazy dask collections, is not cached.
+    """
+    kind, ext = _data_kind(data)
+    if kind is None:
+        print(f'Not caching transformed data of type {type(data).__name__}', file=sys.stdout)
+        return False
+
+    if any(_data_kind(overview)[0] != kind for overview in overviews.values()):
+        print('Not caching overviews of a different type than the data', file=sys.stdout)
+        return False
+
+    parent_dir = os.path.dirname(os.path.abspath(entry_dir))
+    os.makedirs(parent_dir, exist_ok=True)
+    tmp_dir = os.path.join(parent_dir, f'.tmp-{uuid.uuid4().hex}')
+    os.makedirs(tmp_dir)
+
+    try:
+        manifest = dict(version=CACHE_VERSION, kind=kind, data='data' + ext, overviews=[],
+                        name=data.name if kind == 'xarray' else None,
+                        attrs=dict(data.attrs) if kind == 'pandas' else None)
+        _write_data(data, kind, os.path.join(tmp_dir, manifest['data']))
+        for level, overview in overviews.items():
+            filename = f'overview_{level}{ext}'
+            _write_data(overview, kind, os.path.join(tmp_dir, filename))
+            manifest['overviews'].append([level, filename])
+
+        with open(os.path.join(tmp_dir, MANIFEST_FILENAME), 'w') as f:
+            json.dump(manifest, f, default=str)
+
+        if os.path.isdir(entry_dir):
+            # replace an entry being rebuilt, e.g. to recreate overviews
+            stale_dir = tmp_dir + '-stale'
+            os.rename(entry_dir, stale_dir)
+            shutil.rmtree(stale_dir, ignore_errors=True)
+        os.rename(tmp_dir, entry_dir)
+    except OSError:
+        # another process finished writing the same entry first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if not os.path.isdir(entry_dir):
+            raise
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    return True
+
+
+def read_statistics(entry_dir):
+    """
+    Read the statistics stored with a cache entry by ``write_statistics``,
+    None if there are none.
+    """
+    try:
+        with open(os.path.join(entry_dir, STATISTICS_FILENAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_statistics(entry_dir, statistics):
+    """
+    Store statistics computed from the data of a cache entry, such as the
+    breaks of its colormap, replacing the ones stored before.
+
+    Parameters
+    ----------
+    entry_dir : str
+        The cache entry directory, which must exist.
+    statistics : dict
+        The statistics, serializable to json.
+    """
+    tmp_path = os.path.join(entry_dir, f'.tmp-{uuid.uuid4().hex}')
+    with open(tmp_path, 'w') as f:
+        json.dump(statistics, f, default=str)
+    os.replace(tmp_path, os.path.join(entry_dir, STATISTICS_FILENAME))
+
+
+def entry_name(source_key, key):
+    """
+    Get the name of the cache entry of a source for a cache key.
+    """
+    return f'{source_key or "source"}.{key}'
+
+
+def prune_entries(cache_dir, source_key, keep):
+    """
+    Remove the stale entries of a source from the cache directory.
+
+    Parameters
+    ----------
+    cache_dir : str
+        The cache directory.
+    source_key : str
+        The source key.
+    keep : str
+        Name of the current entry, which is kept.
+    """
+    if not os.path.isdir(cache_dir):
+        return
+
+    prefix = entry_name(source_key, '')
+    for name in os.listdir(cache_dir):
+        if name.startswith(prefix) and len(name) == len(keep) and name != keep:
+            shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
@@ -2,6 +2,9 @@ import sys
 import rioxarray  # NOQA - always import before xarray...
 import xarray as xr
 import dask.array as da
+import dask.dataframe as dd
+import numpy as np
+import pandas as pd
 import datashader as ds
 import geopandas as gpd
 import spatialpandas
@@ -438,6 +441,83 @@ def load_in_memory(df):
     return df
 
 
+# Data frame attribute holding the (x, y) origin of compacted coordinates.
+XY_ORIGIN_ATTR = 'xy_origin'
+
+
+def xy_origin(data):
+    """
+    Get the origin point coordinates are stored relative to, which is
+    ``(0, 0)`` unless the data was compacted with ``compact_points``.
+    """
+    return getattr(data, 'attrs', {}).get(XY_ORIGIN_ATTR, (0.0, 0.0))
+
+
+def compact_points(df, xfield='x', yfield='y', zfield=None, max_category_ratio=0.5):
+    """
+    Reduce the memory held by in-memory point data.
+
+    The x and y fields are stored as float32 offsets from the origin of
+    the data extent, which is kept in ``df.attrs`` and added back when
+    rendering. Within a Web Mercator extent of a few thousand kilometers
+    the offsets keep sub-meter precision. A numeric z field is downcast
+    to the smallest type holding its values, other integer fields are
+    downcast losslessly, and string fields with few distinct values are
+    dictionary encoded as categoricals.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame or dask.dataframe.DataFrame
+        The point data, computed into memory if lazy.
+    xfield, yfield : str, default=x, y
+        The coordinate fields.
+    zfield : str, optional
+        The field aggregated when rendering.
+    max_category_ratio : float, default=0.5
+        Largest ratio of distinct values to rows of a string field to
+        encode it as a categorical.
+
+    Returns
+    -------
+    compacted_df : pandas.DataFrame
+        The compacted data.
+    """
+    if isinstance(df, dd.DataFrame):
+        df = df.compute()
+
+    nbytes = df.memory_usage(deep=True).sum()
+    x0, y0 = xy_origin(df)
+    df = df.copy()
+
+    if len(df):
+        # shift an already compacted origin to the extent origin
+        xmin, ymin = df[xfield].min(), df[yfield].min()
+        df[xfield] = (df[xfield] - xmin).astype('float32')
+        df[yfield] = (df[yfield] - ymin).astype('float32')
+        x0, y0 = float(x0 + xmin), float(y0 + ymin)
+
+    for column in df.columns:
+        if column in (xfield, yfield):
+            continue
+        values = df[column]
+        if column == zfield and pd.api.types.is_float_dtype(values):
+            df[column] = pd.to_numeric(values, downcast='float')
+        elif pd.api.types.is_integer_dtype(values) and not pd.api.types.is_bool_dtype(values):
+            downcast = 'unsigned' if len(values) and values.min() >= 0 else 'integer'
+            df[column] = pd.to_numeric(values, downcast=downcast)
+        elif (pd.api.types.is_object_dtype(values)
+              and values.nunique() <= max_category_ratio * len(values)):
+            df[column] = values.astype('category')
+
+    df.attrs[XY_ORIGIN_ATTR] = (x0, y0)
+
+    compacted_nbytes = df.memory_usage(deep=True).sum()
+    print(f'\tCompacted points from {nbytes / 2**20:.1f} MB to '
+          f'{compacted_nbytes / 2**20:.1f} MB, '
+          f'saving {(nbytes - compacted_nbytes) / 2**20:.1f} MB', file=sys.stdout)
+    return df
+
+
 _transforms = {
     'reproject_raster': reproject_raster,
     'reproject_vector': reproject_vector,
@@ -454,9 +534,105 @@ _transforms = {
     'polygon_to_line': polygon_to_line,
     'raster_to_categorical_points': raster_to_categorical_points,
     'load_in_memory': load_in_memory,
+    'compact_points': compact_points,
 }
 
 
+# Raster transforms that only relabel, reorder or convert the values of an
+# array, which run as a single pass over each chunk of a dask array.
+FUSABLE_RASTER_TRANSFORMS = ('squeeze', 'cast', 'orient_array', 'flip_coords')
+
+# Raster transforms that materialize and resample the whole array. They
+# resample with nearest neighbour by default, which gives the same values
+# before and after a cast between float types.
+RESAMPLING_RASTER_TRANSFORMS = ('reproject_raster',)
+
+
+def _is_widening_float_cast(trans, dtype):
+    if trans['name'] != 'cast' or dtype is None:
+        return False
+    target = np.dtype(trans.get('args', {}).get('dtype'))
+    return (np.issubdtype(dtype, np.floating) and np.issubdtype(target, np.floating)
+            and target.itemsize > dtype.itemsize)
+
+
+def plan_transforms(transforms, dtype=None):
+    """
+    Compile a list of transforms into a plan of stages.
+
+    Adjacent fusable raster transforms (``squeeze``, ``cast``,
+    ``orient_array`` and ``flip_coords``) form a single stage, which dask
+    runs in one pass when the array is first materialized. Casts to a
+    wider float type are moved after the next ``reproject_raster``, so the
+    reprojection reads and writes the narrower type and only its output
+    is widened. Casts from integer types stay in place, as they decide
+    how nodata is filled in.
+
+    Parameters
+    ----------
+    transforms : list of dict
+        The transforms to be applied over the data.
+    dtype : numpy.dtype, optional
+        Data type of the raster the transforms are applied to. Transforms
+        of other data are not reordered.
+
+    Returns
+    -------
+    stages : list of list of dict
+        The transforms, grouped in stages in the order they run.
+    """
+    transforms = list(transforms)
+    dtype = None if dtype is None else np.dtype(dtype)
+
+    planned = []
+    deferred = None
+    for trans in transforms:
+        name = trans['name']
+        if deferred is None and _is_widening_float_cast(trans, dtype):
+            deferred = trans
+            continue
+
+        # a deferred cast moves past fusable transforms and the next
+        # resampling transform, anything else (including another cast)
+        # runs it first
+        resampling = name in RESAMPLING_RASTER_TRANSFORMS
+        if deferred is not None and not resampling and (
+                name == 'cast' or name not in FUSABLE_RASTER_TRANSFORMS):
+            planned.append(deferred)
+            dtype = np.dtype(deferred['args']['dtype'])
+            deferred = None
+
+        planned.append(trans)
+        if name == 'cast':
+            dtype = np.dtype(trans['args']['dtype'])
+
+        if deferred is not None and resampling:
+            planned.append(deferred)
+            deferred = None
+
+    if deferred is not None:
+        planned.append(deferred)
+
+    stages = []
+    for trans in planned:
+        if (stages and trans['name'] in FUSABLE_RASTER_TRANSFORMS
+                and stages[-1][-1]['name'] in FUSABLE_RASTER_TRANSFORMS):
+            stages[-1].append(trans)
+        else:
+            stages.append([trans])
+    return stages
+
+
+def in_memory_nbytes(data):
+    """
+    Get the number of bytes held in memory by raster data, which is 0 for
+    lazy dask arrays.
+    """
+    if isinstance(data, xr.DataArray) and not isinstance(data.data, da.Array):
+        return data.nbytes
+    return 0
+
+
 def get_transform_by_name(name: str):
     """
     Get transform function by their name.
@@ -61,6 +61,7 @@ setup_args = dict(
         examples=mapshader.commands.examples:examples
         tif_to_netcdf=mapshader.commands.tif_to_netcdf:tif_to_netcdf
         serve=mapshader.commands.serve:serve
+        spatial_sort=mapshader.commands.spatial_sort:spatial_sort
         tile=mapshader.commands.tile:tile
     ''',
 )